@@ -12,13 +12,35 @@
 # 2) Паркінг: можна обрати кнопкою або вписати текстом
 
 import os
+import re
+import csv
 import json
+import math
+import sys
+import heapq
+import time
+import bisect
+import random
+import shlex
+import shutil
+import tarfile
 import asyncio
+import logging
+import multiprocessing
 import sqlite3
+import threading
+import queue
+import weakref
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Iterator, List, Callable, AsyncIterator
+from zoneinfo import ZoneInfo
 
-from aiogram import Bot, Dispatcher, Router, F, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -28,11 +50,14 @@ from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import FSInputFile
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 
 try:
-    from openpyxl import Workbook
+    from openpyxl import Workbook, load_workbook
 except ImportError:
     Workbook = None
+    load_workbook = None
 
 
 # =========================
@@ -52,7 +77,124 @@ if ALLOWED_USER_IDS_RAW:
         if part.isdigit():
             ALLOWED_USER_IDS.add(int(part))
 
-APP_TZ = timezone.utc  # за потреби можна змінити
+# адміністратори (/backup та інші службові команди)
+# ALLOWED_USER_IDS / ADMIN_USER_IDS лише засівають таблицю users при старті,
+# далі ролями керують командами /user і /users
+ADMIN_USER_IDS_RAW = (os.getenv("ADMIN_USER_IDS") or "").strip()
+ADMIN_USER_IDS = set()
+if ADMIN_USER_IDS_RAW:
+    for part in ADMIN_USER_IDS_RAW.split(","):
+        part = part.strip()
+        if part.isdigit():
+            ADMIN_USER_IDS.add(int(part))
+
+APP_TZ_NAME = (os.getenv("APP_TZ") or "").strip()
+APP_TZ = ZoneInfo(APP_TZ_NAME) if APP_TZ_NAME else timezone.utc  # напр. APP_TZ=Europe/Bratislava
+
+# Архів старих status_events (окремі SQLite-файли по роках)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(DATA_DIR, "archive"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365") or 0)  # 0 = не архівувати
+ARCHIVE_EVERY_HOURS = float(os.getenv("ARCHIVE_EVERY_HOURS", "24") or 24)
+ARCHIVE_BATCH = 5000
+
+# Онлайн-бекапи БД (sqlite3 backup API, стиснені, з ротацією)
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(DATA_DIR, "backups"))
+BACKUP_EVERY_HOURS = float(os.getenv("BACKUP_EVERY_HOURS", "6") or 6)
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14") or 14)
+
+# Планувальник: щоденний підсумок у групу + знімки статистики
+DIGEST_AT = [t.strip() for t in (os.getenv("DIGEST_AT") or "20:00").split(",") if t.strip()]  # HH:MM у APP_TZ
+STATS_SNAPSHOT_MINUTES = float(os.getenv("STATS_SNAPSHOT_MINUTES", "5") or 5)
+SCHEDULER_TICK = 30  # секунд
+
+# Черга відправок у Telegram (ліміти Bot API: ~30/с загалом, ~20/хв у групу)
+SEND_PER_SECOND = float(os.getenv("SEND_PER_SECOND", "25") or 25)
+GROUP_SEND_INTERVAL = float(os.getenv("GROUP_SEND_INTERVAL", "3") or 3)
+PRIVATE_SEND_INTERVAL = 1.0
+
+# Імпорт CSV/XLSX (/import)
+IMPORT_BATCH = 2000
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # ліміт getFile у Bot API
+
+# Застарілі пропозиції: статус не мінявся STALE_AFTER_DAYS днів
+STALE_STATUSES = ("active", "unknown")
+STALE_AFTER_DAYS = int(os.getenv("STALE_AFTER_DAYS", "60") or 0)  # 0 = вимкнено
+STALE_ACTION = (os.getenv("STALE_ACTION") or "notify").strip().lower()  # notify | expire
+STALE_EXPIRE_TO = "removed"
+STALE_REMIND_DAYS = 7
+STALE_BATCH = 200
+STALE_EVERY_MINUTES = 60
+SYSTEM_USERNAME = "system"
+SYSTEM_USER_ID = 0
+
+# Покинуті чернетки (/new без публікації чи скасування) і TTL стану FSM
+FSM_TTL_HOURS = float(os.getenv("FSM_TTL_HOURS", "24") or 24)
+DRAFT_TTL_HOURS = float(os.getenv("DRAFT_TTL_HOURS", "48") or 48)  # має бути > FSM_TTL_HOURS
+DRAFT_GC_BATCH = 500
+DRAFT_GC_EVERY_MINUTES = 60
+
+ROLES = ("admin", "broker")
+ROLE_REFRESH_SECONDS = float(os.getenv("ROLE_REFRESH_SECONDS", "5") or 5)
+
+# Дедуплікація апдейтів (повторна доставка після падіння/редеплою)
+UPDATE_RING_SIZE = 10000
+UPDATE_WATERMARK_FLUSH_SECONDS = 1.0
+# Telegram після тижня тиші може почати update_id з випадкового числа
+UPDATE_WATERMARK_MAX_AGE = timedelta(days=6)
+
+# Важкі хендлери (export/stats/bulk/import...) — не більше HEAVY_CONCURRENCY одночасно,
+# решта чекає в черзі (до HEAVY_QUEUE_MAX); кліки та кроки майстра йдуть повз чергу
+HEAVY_CONCURRENCY = int(os.getenv("HEAVY_CONCURRENCY", "2") or 2)
+HEAVY_QUEUE_MAX = int(os.getenv("HEAVY_QUEUE_MAX", "20") or 20)
+
+# /stats: у зведенні лише топ маклерів, решта — сторінками (ліміт повідомлення 4096 символів)
+STATS_TOP_N = 10
+STATS_PAGE_CHARS = 3500
+STATS_PAGE_ROWS = 20  # маклерів на сторінці (і кнопок деталізації)
+
+# /subscribe: збережені пошуки, сповіщення в особисті при публікації
+SUB_MAX_PER_USER = 20
+
+# Автопідказки місто/район/вулиця у майстрі
+AC_MAX_KEYS = 20000  # на один індекс; далі витісняються найрідші
+AC_SUGGEST = 6  # кнопок з підказками
+AC_SCAN = 300  # скільки ключів з префіксом переглядаємо, щоб вибрати найчастіші
+AC_MIN_CHARS = 2
+
+# /profile: семплінг стеків окремим потоком лише на час профілювання
+PROFILE_INTERVAL = 0.01  # секунд між знімками потоків
+PROFILE_TASK_EVERY = 10  # asyncio-задачі знімаємо кожен N-й раз (дорожче)
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 12
+
+# Ринок оренди: KLL-скетчі квантилів rent по (місто, район, тип житла, категорія)
+RENT_SKETCH_K = 128  # точність/розмір скетча; до ~k значень у групі — точно
+RENT_MIN_SAMPLES = 5  # менше — порівняння з ринком не показуємо
+RENT_SKETCH_REBUILD_HOURS = 24  # повний перерахунок (підхоплює правки і видалення)
+
+# Excel-експорт: черга задач у БД, виконання в окремих процесах (openpyxl тримає GIL)
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(DATA_DIR, "exports"))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "1") or 1)
+EXPORT_PROGRESS_EVERY = 2000  # рядків між оновленнями прогресу в БД
+EXPORT_POLL_SECONDS = 3.0  # як часто перемальовувати повідомлення з прогресом
+
+# Inline-режим (@bot запит) — потрібно увімкнути в @BotFather: /setinline
+INLINE_STATUSES = ("active", "unknown", "reserve")
+INLINE_PAGE = 20
+INLINE_MAX_RESULTS = 200
+INLINE_CACHE_SIZE = 512
+INLINE_CACHE_TTL = 30.0  # секунд, кеш у процесі
+INLINE_CACHE_TIME = 10  # секунд, кеш на боці Telegram
+INLINE_DEBOUNCE = 0.3  # секунд: відповідаємо лише на останній запит користувача
+
+# Куди публікувати: "<chat_id>[ ключ=значення|значення ...]; ..." (ключі: city, category, district)
+# напр. PUBLISH_TARGETS="-1001111; -1002222 city=Bratislava|Trnava; -1003333 category=Продаж"
+# без змінної — лише GROUP_CHAT_ID
+PUBLISH_TARGETS_RAW = (os.getenv("PUBLISH_TARGETS") or "").strip()
+PUBLISH_TARGET_KEYS = ("city", "category", "district")
+PUBLISH_CONCURRENCY = 4
+
+log = logging.getLogger("bot")
 
 
 STATUS = {
@@ -79,9 +221,48 @@ def db_conn() -> sqlite3.Connection:
     return con
 
 
+def _ensure_column(cur: sqlite3.Cursor, table: str, column: str, decl: str) -> bool:
+    """ALTER TABLE ADD COLUMN, якщо колонки ще немає (міграція старих БД). True = додано."""
+    cur.execute(f"PRAGMA table_info({table});")
+    if any(r["name"] == column for r in cur.fetchall()):
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+    return True
+
+
+def _backfill_durations(cur: sqlite3.Cursor):
+    """Одноразово (при створенні status_durations) відновлює відрізки з наявних status_events."""
+    cur.execute(
+        """
+        SELECT se.offer_id, se.status, se.at_ts, o.broker_username
+        FROM status_events se
+        JOIN offers o ON o.id = se.offer_id
+        ORDER BY se.offer_id ASC, se.at_ts ASC, se.id ASC;
+        """
+    )
+    rows = []
+    prev = None
+    for r in cur.fetchall():
+        if prev and prev["offer_id"] == r["offer_id"]:
+            if prev["status"] == r["status"]:
+                continue
+            rows[-1][4:] = [r["at_ts"], r["at_ts"] - rows[-1][3], r["status"]]
+        rows.append([r["offer_id"], r["broker_username"], r["status"], r["at_ts"], None, None, None])
+        prev = r
+    cur.executemany(
+        """
+        INSERT INTO status_durations (offer_id, broker, status, entered_ts, left_ts, duration, next_status)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """,
+        rows,
+    )
+
+
 def init_db():
     con = db_conn()
     cur = con.cursor()
+    # WAL: довгі читання (експорт в окремому процесі) не блокують записи бота
+    cur.execute("PRAGMA journal_mode=WAL;")
 
     cur.execute(
         """
@@ -124,6 +305,316 @@ def init_db():
         );
         """
     )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_status_events_offer ON status_events(offer_id);")
+
+    # денні підсумки для подій, що вже переїхали в архів (щоб /stats не «худнула»)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS status_rollups (
+            day TEXT NOT NULL,
+            username TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, username, status)
+        );
+        """
+    )
+
+    # дублікати: нормалізована адреса + file_unique_id фото
+    if _ensure_column(cur, "offers", "address_key", "TEXT"):
+        cur.execute("SELECT id, street, city, housing_type FROM offers;")
+        cur.executemany(
+            "UPDATE offers SET address_key = ? WHERE id = ?;",
+            [(address_key(r["street"], r["city"], r["housing_type"]), r["id"]) for r in cur.fetchall()],
+        )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_offers_address_key ON offers(address_key, current_status);")
+    # звідки пропозиція: 'bot' (майстер /new) або 'import' (масовий імпорт)
+    _ensure_column(cur, "offers", "source", "TEXT DEFAULT 'bot'")
+
+    # час останньої зміни статусу (= останній status_events.at) для пошуку застарілих
+    if _ensure_column(cur, "offers", "status_changed_at", "TEXT"):
+        cur.execute(
+            """
+            UPDATE offers SET status_changed_at = COALESCE(
+                (SELECT MAX(se.at) FROM status_events se WHERE se.offer_id = offers.id),
+                created_at
+            );
+            """
+        )
+    _ensure_column(cur, "offers", "stale_notified_at", "TEXT")
+    # epoch-двійники для пошуку застарілих: ISO-рядки з різними зсувами не порівнюються коректно
+    if _ensure_column(cur, "offers", "status_changed_ts", "INTEGER"):
+        cur.execute("UPDATE offers SET status_changed_ts = CAST(strftime('%s', status_changed_at) AS INTEGER);")
+    if _ensure_column(cur, "offers", "stale_notified_ts", "INTEGER"):
+        cur.execute("UPDATE offers SET stale_notified_ts = CAST(strftime('%s', stale_notified_at) AS INTEGER);")
+    # оптимістичне версіонування: кожна зміна статусу = version + 1 (compare-and-swap)
+    _ensure_column(cur, "offers", "version", "INTEGER NOT NULL DEFAULT 0")
+    cur.execute("DROP INDEX IF EXISTS idx_offers_stale;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_offers_stale_ts ON offers(current_status, status_changed_ts);")
+
+    # цілі epoch-секунди поруч з ISO-рядками: фільтри періодів не залежать від зсуву APP_TZ
+    if _ensure_column(cur, "offers", "created_ts", "INTEGER"):
+        cur.execute("UPDATE offers SET created_ts = CAST(strftime('%s', created_at) AS INTEGER);")
+    if _ensure_column(cur, "status_events", "at_ts", "INTEGER"):
+        cur.execute("UPDATE status_events SET at_ts = CAST(strftime('%s', at) AS INTEGER);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_offers_created_ts ON offers(created_ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_status_events_at_ts ON status_events(at_ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_status_events_user ON status_events(username, at_ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_offers_drafts ON offers(is_published, created_ts);")
+
+    # аналітика: відрізки «пропозиція перебувала в статусі з entered_ts до left_ts»,
+    # дописуються інкрементально при кожній зміні статусу (див. record_transitions)
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'status_durations';")
+    durations_existed = cur.fetchone() is not None
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS status_durations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            offer_id INTEGER NOT NULL,
+            broker TEXT,
+            status TEXT NOT NULL,
+            entered_ts INTEGER NOT NULL,
+            left_ts INTEGER,
+            duration INTEGER,
+            next_status TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_durations_offer ON status_durations(offer_id, status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_durations_entered ON status_durations(status, entered_ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_durations_left ON status_durations(left_ts);")
+
+    # повнотекстовий індекс для inline-пошуку; тригери тримають його в синхроні з offers
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'offers_fts';")
+    fts_existed = cur.fetchone() is not None
+    cur.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS offers_fts USING fts5(body, tokenize='unicode61 remove_diacritics 2');"
+    )
+    fts_body = (
+        "COALESCE({t}.seq, '') || ' ' || COALESCE({t}.category, '') || ' ' || COALESCE({t}.housing_type, '') || ' ' || "
+        "COALESCE({t}.street, '') || ' ' || COALESCE({t}.city, '') || ' ' || COALESCE({t}.district, '') || ' ' || "
+        "COALESCE({t}.rent, '') || ' ' || COALESCE({t}.advantages, '')"
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS offers_fts_ai AFTER INSERT ON offers BEGIN
+            INSERT INTO offers_fts (rowid, body) VALUES (new.id, {fts_body.format(t="new")});
+        END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS offers_fts_au
+        AFTER UPDATE OF seq, category, housing_type, street, city, district, rent, advantages ON offers BEGIN
+            DELETE FROM offers_fts WHERE rowid = old.id;
+            INSERT INTO offers_fts (rowid, body) VALUES (new.id, {fts_body.format(t="new")});
+        END;
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS offers_fts_ad AFTER DELETE ON offers BEGIN
+            DELETE FROM offers_fts WHERE rowid = old.id;
+        END;
+        """
+    )
+    if not fts_existed:
+        cur.execute(f"INSERT INTO offers_fts (rowid, body) SELECT id, {fts_body.format(t='offers')} FROM offers;")
+
+    # скетчі ринку оренди; rent_sketched = пропозиція вже врахована
+    _ensure_column(cur, "offers", "rent_sketched", "INTEGER NOT NULL DEFAULT 0")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rent_sketches (
+            city TEXT NOT NULL,
+            district TEXT NOT NULL,
+            housing_type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            sketch TEXT NOT NULL,
+            PRIMARY KEY (city, district, housing_type, category)
+        );
+        """
+    )
+
+    # черга Excel-експортів (переживає рестарт) і хто чекає на результат
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT NOT NULL,
+            label TEXT,
+            start_ts INTEGER,
+            end_ts INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            rows_total INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT,
+            finished_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_export_jobs_status ON export_jobs(status, id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS export_waiters (
+            job_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            PRIMARY KEY (job_id, chat_id)
+        );
+        """
+    )
+
+    # копії опублікованої пропозиції в усіх цільових чатах
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'publications';")
+    publications_existed = cur.fetchone() is not None
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS publications (
+            offer_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            album_message_ids TEXT,
+            PRIMARY KEY (offer_id, chat_id)
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_publications_msg ON publications(chat_id, message_id);")
+    # будь-яке повідомлення пропозиції в чаті (текст + кожне фото альбому) -> offer_id
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'publication_messages';")
+    messages_existed = cur.fetchone() is not None
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS publication_messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            offer_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    if not publications_existed:
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO publications (offer_id, chat_id, message_id)
+            SELECT id, published_chat_id, published_message_id FROM offers
+            WHERE is_published = 1 AND published_chat_id IS NOT NULL AND published_message_id IS NOT NULL;
+            """
+        )
+    if not messages_existed:
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO publication_messages (chat_id, message_id, offer_id)
+            SELECT chat_id, message_id, offer_id FROM publications;
+            """
+        )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO publication_messages (chat_id, message_id, offer_id)
+            SELECT p.chat_id, j.value, p.offer_id
+            FROM publications p, json_each(COALESCE(p.album_message_ids, '[]')) j;
+            """
+        )
+    if not durations_existed:
+        _backfill_durations(cur)
+
+    # ролі користувачів + лічильник версії (для інвалідації кешу в усіх воркерах)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            role TEXT NOT NULL DEFAULT 'broker',
+            active INTEGER NOT NULL DEFAULT 1,
+            username TEXT,
+            updated_at TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """
+    )
+    cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('users_version', '0');")
+    cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('subscriptions_version', '0');")
+    cur.execute("SELECT value FROM meta WHERE key = 'address_key_version';")
+    row = cur.fetchone()
+    if not row or int(row["value"]) < ADDRESS_KEY_VERSION:
+        cur.execute("SELECT id, street, city, housing_type FROM offers;")
+        cur.executemany(
+            "UPDATE offers SET address_key = ? WHERE id = ?;",
+            [(address_key(r["street"], r["city"], r["housing_type"]), r["id"]) for r in cur.fetchall()],
+        )
+        cur.execute(
+            """
+            INSERT INTO meta (key, value) VALUES ('address_key_version', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value;
+            """,
+            (str(ADDRESS_KEY_VERSION),),
+        )
+
+    # збережені пошуки /subscribe; '' у city/category/housing_type — «будь-яке»,
+    # значення нормалізовані norm_text (кошики SubscriptionIndex)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            city TEXT NOT NULL DEFAULT '',
+            category TEXT NOT NULL DEFAULT '',
+            housing_type TEXT NOT NULL DEFAULT '',
+            rent_max REAL,
+            parking INTEGER NOT NULL DEFAULT 0,
+            query TEXT,
+            created_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id);")
+    seed = [(uid, "admin") for uid in ADMIN_USER_IDS] + [(uid, "broker") for uid in ALLOWED_USER_IDS - ADMIN_USER_IDS]
+    if seed:
+        cur.executemany(
+            "INSERT OR IGNORE INTO users (user_id, role, active, updated_at) VALUES (?, ?, 1, ?);",
+            [(uid, role, now_iso()) for uid, role in seed],
+        )
+        if cur.rowcount > 0:
+            cur.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'users_version';")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS offer_photos (
+            offer_id INTEGER NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            PRIMARY KEY (offer_id, file_unique_id)
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_offer_photos_unique ON offer_photos(file_unique_id);")
+
+    # планувальник: коли кожна задача востаннє відпрацювала (переживає рестарти)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            last_run TEXT
+        );
+        """
+    )
+    # готові агрегати для /stats (рахуються у фоні)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_snapshots (
+            period TEXT PRIMARY KEY,
+            label TEXT,
+            computed_at TEXT,
+            data_json TEXT
+        );
+        """
+    )
 
     con.commit()
     con.close()
@@ -133,18 +624,41 @@ def now_iso() -> str:
     return datetime.now(tz=APP_TZ).isoformat(timespec="seconds")
 
 
-def next_seq() -> int:
-    con = db_conn()
-    cur = con.cursor()
+def to_ts(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+
+def iso_to_ts(iso: str) -> int:
+    return to_ts(datetime.fromisoformat(iso))
+
+
+def local_day(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=APP_TZ).strftime("%Y-%m-%d")
+
+
+def next_seq(cur: sqlite3.Cursor) -> int:
+    # лише всередині BEGIN IMMEDIATE разом з INSERT — інакше паралельні /new та /import
+    # прочитають однаковий MAX(seq)
     cur.execute("SELECT COALESCE(MAX(seq), 0) + 1 AS next_seq FROM offers;")
-    row = cur.fetchone()
-    con.close()
-    return int(row["next_seq"])
+    return int(cur.fetchone()["next_seq"])
+
+
+# колонки, які можна міняти через update_offer (імена йдуть у SQL)
+OFFER_COLUMNS = {
+    "category", "housing_type", "street", "city", "district", "advantages", "rent", "deposit",
+    "commission", "parking", "move_in_from", "viewings_from", "broker_username", "broker_user_id",
+    "photos_json", "current_status", "is_published", "published_chat_id", "published_message_id",
+    "address_key", "source", "status_changed_at", "stale_notified_at", "rent_sketched",
+    "status_changed_ts", "stale_notified_ts",
+}
 
 
 def update_offer(offer_id: int, **fields):
     if not fields:
         return
+    bad = set(fields) - OFFER_COLUMNS
+    if bad:
+        raise ValueError(f"unknown offer columns: {sorted(bad)}")
     keys = list(fields.keys())
     vals = [fields[k] for k in keys]
     sets = ", ".join([f"{k} = ?" for k in keys])
@@ -164,20 +678,82 @@ def get_offer(offer_id: int) -> Optional[sqlite3.Row]:
     return row
 
 
-def set_status(offer_id: int, status: str, username: str, user_id: int):
+def set_status(
+    offer_id: int,
+    status: str,
+    username: str,
+    user_id: int,
+    expected_version: Optional[int] = None,
+) -> Optional[sqlite3.Row]:
+    """
+    Статус + подія + відрізок аналітики в одній транзакції з compare-and-swap по version.
+    Повертає закомічений рядок offers; None — немає пропозиції або expected_version застаріла.
+    """
     if status not in STATUS:
-        return
-
-    update_offer(offer_id, current_status=status)
+        return None
 
+    at = now_iso()
     con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO status_events (offer_id, at, status, username, user_id) VALUES (?, ?, ?, ?, ?);",
-        (offer_id, now_iso(), status, username, user_id),
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        cur = con.cursor()
+        cur.execute("SELECT version FROM offers WHERE id = ?;", (offer_id,))
+        row = cur.fetchone()
+        version = int(row["version"] or 0) if row else None
+        if version is None or (expected_version is not None and version != expected_version):
+            con.rollback()
+            return None
+
+        cur.execute(
+            """
+            UPDATE offers SET current_status = ?, status_changed_at = ?, status_changed_ts = ?, version = ?
+            WHERE id = ? AND version = ?;
+            """,
+            (status, at, iso_to_ts(at), version + 1, offer_id, version),
+        )
+        if cur.rowcount != 1:
+            con.rollback()
+            return None
+
+        cur.execute(
+            "INSERT INTO status_events (offer_id, at, at_ts, status, username, user_id) VALUES (?, ?, ?, ?, ?, ?);",
+            (offer_id, at, iso_to_ts(at), status, username, user_id),
+        )
+        record_transitions(cur, [offer_id], status, iso_to_ts(at))
+
+        cur.execute("SELECT * FROM offers WHERE id = ?;", (offer_id,))
+        committed = cur.fetchone()
+        con.commit()
+        return committed
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+
+def record_transitions(cur: sqlite3.Cursor, offer_ids: List[int], status: str, at_ts: int):
+    """
+    Інкрементально веде status_durations у транзакції виклику: закриває відкритий
+    відрізок (якщо статус справді змінився) і відкриває новий з маклером-власником.
+    """
+    cur.executemany(
+        """
+        UPDATE status_durations SET left_ts = ?, duration = ? - entered_ts, next_status = ?
+        WHERE offer_id = ? AND left_ts IS NULL AND status != ?;
+        """,
+        [(at_ts, at_ts, status, oid, status) for oid in offer_ids],
+    )
+    cur.executemany(
+        """
+        INSERT INTO status_durations (offer_id, broker, status, entered_ts)
+        SELECT id, broker_username, ?, ? FROM offers
+        WHERE id = ? AND NOT EXISTS (
+            SELECT 1 FROM status_durations WHERE offer_id = ? AND left_ts IS NULL
+        );
+        """,
+        [(status, at_ts, oid, oid) for oid in offer_ids],
     )
-    con.commit()
-    con.close()
 
 
 def create_offer(broker_username: str, broker_user_id: int) -> int:
@@ -185,24 +761,29 @@ def create_offer(broker_username: str, broker_user_id: int) -> int:
     Створює пропозицію зі статусом ❔ Невідома
     і одразу записує подію в status_events (для статистики).
     """
-    seq = next_seq()
     created = now_iso()
 
     con = db_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO offers (
-            seq, created_at, category, housing_type, street, city, district, advantages,
-            rent, deposit, commission, parking, move_in_from, viewings_from,
-            broker_username, broker_user_id, photos_json, current_status, is_published
-        ) VALUES (?, ?, '', '', '', '', '', '', '', '', '', '', '', '', ?, ?, '[]', ?, 0);
-        """,
-        (seq, created, broker_username, broker_user_id, "unknown"),
-    )
-    con.commit()
-    offer_id = cur.lastrowid
-    con.close()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        cur = con.cursor()
+        cur.execute(
+            """
+            INSERT INTO offers (
+                seq, created_at, category, housing_type, street, city, district, advantages,
+                rent, deposit, commission, parking, move_in_from, viewings_from,
+                broker_username, broker_user_id, photos_json, current_status, is_published, created_ts
+            ) VALUES (?, ?, '', '', '', '', '', '', '', '', '', '', '', '', ?, ?, '[]', ?, 0, ?);
+            """,
+            (next_seq(cur), created, broker_username, broker_user_id, "unknown", iso_to_ts(created)),
+        )
+        offer_id = cur.lastrowid
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
 
     # ✅ одразу рахуємо як "Невідома" в статистику
     set_status(offer_id, "unknown", username=broker_username, user_id=broker_user_id)
@@ -210,61 +791,1011 @@ def create_offer(broker_username: str, broker_user_id: int) -> int:
     return offer_id
 
 
-def add_photo(offer_id: int, file_id: str):
-    offer = get_offer(offer_id)
-    if not offer:
-        return
+def add_photo(offer_id: int, file_id: str, file_unique_id: Optional[str] = None):
+    # дописуємо в JSON-масив одним UPDATE — фото альбому приходять паралельно
+    con = db_conn()
     try:
-        photos = json.loads(offer["photos_json"] or "[]")
-    except Exception:
-        photos = []
-    photos.append(file_id)
-    update_offer(offer_id, photos_json=json.dumps(photos, ensure_ascii=False))
+        con.execute(
+            """
+            UPDATE offers SET photos_json = json_insert(COALESCE(NULLIF(photos_json, ''), '[]'), '$[#]', ?)
+            WHERE id = ?;
+            """,
+            (file_id, offer_id),
+        )
+        if file_unique_id:
+            con.execute(
+                """
+                INSERT OR IGNORE INTO offer_photos (offer_id, file_unique_id)
+                SELECT id, ? FROM offers WHERE id = ?;
+                """,
+                (file_unique_id, offer_id),
+            )
+        con.commit()
+    finally:
+        con.close()
+
+
+def delete_draft(offer_id: int):
+    """Прибирає неопубліковану пропозицію разом з подіями й аналітикою."""
+    con = db_conn()
+    try:
+        cur = con.cursor()
+        # опубліковану (скажімо, після подвійного кліку) не чіпаємо разом з її історією
+        cur.execute("DELETE FROM offers WHERE id = ? AND is_published = 0;", (offer_id,))
+        if cur.rowcount:
+            for table in ("status_events", "status_durations", "offer_photos"):
+                cur.execute(f"DELETE FROM {table} WHERE offer_id = ?;", (offer_id,))
+        con.commit()
+    finally:
+        con.close()
+
+
+def iter_offers(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[sqlite3.Row]:
+    """Пропозиції за created_ts у [start, end) (без меж — усі), за seq, потоково."""
+    con = db_conn()
+    try:
+        if start and end:
+            yield from con.execute(
+                "SELECT * FROM offers WHERE created_ts >= ? AND created_ts < ? ORDER BY seq ASC;",
+                (to_ts(start), to_ts(end)),
+            )
+        else:
+            yield from con.execute("SELECT * FROM offers ORDER BY seq ASC;")
+    finally:
+        con.close()
 
 
 # =========================
-# HELPERS
+# STORAGE
 # =========================
-def is_allowed(user_id: int) -> bool:
-    if not ALLOWED_USER_IDS:
-        return True
-    return user_id in ALLOWED_USER_IDS
+# Пропозиції, події статусів, статистика і курсори експорту — через Storage (хендлери
+# не чіпають sqlite на event loop). Бекенд один — SqliteStorage: публікації, архів, бекапи,
+# FTS, скетчі, ролі й черги задач теж у SQLite і посилаються на offers.id, тож спільна БД
+# для кількох інстансів потребує переїзду всіх цих таблиць, а не лише іншого Storage.
 
 
-def esc(s: str) -> str:
-    return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+class Storage(ABC):
+    """
+    Інтерфейс сховища. Рядки — мапінги з тими самими ключами, що й колонки offers/status_events.
+    Бекенд без якогось методу падає вже на створенні, а не на першому виклику.
+    """
 
+    async def init(self):
+        pass
 
-def offer_title(seq: int) -> str:
-    return f"🏡 <b>ПРОПОЗИЦІЯ #{seq:04d}</b>"
+    async def close(self):
+        pass
 
+    @abstractmethod
+    async def create_offer(self, broker_username: str, broker_user_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def get_offer(self, offer_id: int):
+        ...
+
+    @abstractmethod
+    async def update_offer(self, offer_id: int, **fields):
+        ...
+
+    @abstractmethod
+    async def add_photo(self, offer_id: int, file_id: str, file_unique_id: Optional[str] = None):
+        ...
+
+    @abstractmethod
+    async def delete_draft(self, offer_id: int):
+        ...
+
+    @abstractmethod
+    async def set_status(
+        self, offer_id: int, status: str, username: str, user_id: int, expected_version: Optional[int] = None
+    ):
+        ...
+
+    @abstractmethod
+    async def stats_for_range(self, start: datetime, end: datetime, label: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def broker_stats(self, username: str, start: datetime, end: datetime) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    async def count_export_rows(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+        ...
+
+    @abstractmethod
+    def iter_offers(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> AsyncIterator[Any]:
+        ...
+
+    @abstractmethod
+    def iter_status_events(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> AsyncIterator[Any]:
+        ...
+
+
+async def _iter_in_thread(make_iter: Callable[[], Iterator[Any]], batch: int = 500) -> AsyncIterator[Any]:
+    """Синхронний генератор (sqlite-курсор) в окремому потоці, віддає пачками через чергу."""
+    q: queue.Queue = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            buf = []
+            for row in make_iter():
+                buf.append(row)
+                if len(buf) >= batch:
+                    if not put(buf):
+                        return
+                    buf = []
+            if buf and not put(buf):
+                return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    threading.Thread(target=worker, name="storage-iter", daemon=True).start()
+    try:
+        while True:
+            item = await asyncio.to_thread(q.get)
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            for row in item:
+                yield row
+    finally:
+        stop.set()
 
-def offer_text(offer: sqlite3.Row) -> str:
-    seq = int(offer["seq"])
-    status = (offer["current_status"] or "unknown").strip()
-    st = STATUS.get(status, "❔ Невідома")
 
-    def line(emoji: str, label: str, key: str):
-        val = offer[key] or "—"
-        return f"{emoji} <b>{label}:</b> {esc(str(val))}"
+class SqliteStorage(Storage):
+    """Поточні sqlite-функції цього модуля, винесені з event loop у потоки."""
 
-    broker = offer["broker_username"] or "—"
-    if broker and not broker.startswith("@"):
-        broker = f"@{broker}"
+    async def create_offer(self, broker_username: str, broker_user_id: int) -> int:
+        return await asyncio.to_thread(create_offer, broker_username, broker_user_id)
 
-    parts = [
-        offer_title(seq),
-        f"📊 <b>Статус:</b> {st}",
-        "",
-        line("🏷️", "Категорія", "category"),
-        line("🏠", "Тип житла", "housing_type"),
-        line("📍", "Вулиця", "street"),
-        line("🏙️", "Місто", "city"),
-        line("🗺️", "Район", "district"),
-        line("✨", "Переваги", "advantages"),
-        line("💶", "Оренда", "rent"),
-        line("🔐", "Депозит", "deposit"),
-        line("🤝", "Комісія", "commission"),
+    async def get_offer(self, offer_id: int):
+        return await asyncio.to_thread(get_offer, offer_id)
+
+    async def update_offer(self, offer_id: int, **fields):
+        await asyncio.to_thread(update_offer, offer_id, **fields)
+
+    async def add_photo(self, offer_id: int, file_id: str, file_unique_id: Optional[str] = None):
+        await asyncio.to_thread(add_photo, offer_id, file_id, file_unique_id)
+
+    async def delete_draft(self, offer_id: int):
+        await asyncio.to_thread(delete_draft, offer_id)
+
+    async def set_status(
+        self, offer_id: int, status: str, username: str, user_id: int, expected_version: Optional[int] = None
+    ):
+        return await asyncio.to_thread(set_status, offer_id, status, username, user_id, expected_version)
+
+    async def stats_for_range(self, start: datetime, end: datetime, label: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(stats_for_range, start, end, label)
+
+    async def broker_stats(self, username: str, start: datetime, end: datetime) -> Dict[str, int]:
+        return await asyncio.to_thread(broker_stats, username, start, end)
+
+    async def count_export_rows(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+        return await asyncio.to_thread(count_export_rows, start, end)
+
+    def iter_offers(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> AsyncIterator[Any]:
+        return _iter_in_thread(lambda: iter_offers(start, end))
+
+    def iter_status_events(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> AsyncIterator[Any]:
+        return _iter_in_thread(lambda: iter_status_events(start, end))
+
+
+storage: Storage = SqliteStorage()
+
+
+# =========================
+# DUPLICATES
+# =========================
+DUPLICATE_STATUSES = ("active", "reserve")
+
+_HOUSE_NUM_RE = re.compile(r"\b\d+\s?[a-zа-яіїєґ]?(?:\s?/\s?(?:\d+\s?)?[a-zа-яіїєґ]?)?(?!\w)")
+# змінилось правило address_key — init_db один раз перераховує ключі наявних пропозицій
+ADDRESS_KEY_VERSION = 2
+# службові слова, які маклери пишуть по-різному (або не пишуть зовсім)
+_STREET_NOISE = {"ul", "ulica", "вул", "вулиця", "ул", "улица", "str", "street", "nam", "namestie"}
+
+
+def norm_text(s: Optional[str]) -> str:
+    """lowercase + без діакритики + стиснуті пробіли: 'Petržalka ' -> 'petrzalka'."""
+    s = unicodedata.normalize("NFKD", (s or "").lower())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = re.sub(r"[^\w/]+", " ", s)
+    return " ".join(s.split())
+
+
+def address_key(street: Optional[str], city: Optional[str], housing_type: Optional[str]) -> Optional[str]:
+    """Ключ 'місто|вулиця|номер|тип' для пошуку повторно виставлених квартир."""
+    street_n = norm_text(street)
+    city_n = norm_text(city)
+    if not street_n or not city_n:
+        return None
+    street_name, house = street_parts(street_n)
+    return "|".join([city_n, street_name, house, norm_text(housing_type)])
+
+
+def street_parts(street_n: str) -> Tuple[str, str]:
+    """Нормалізована вулиця -> (назва без службових слів, номер будинку)."""
+    m = _HOUSE_NUM_RE.search(street_n)
+    house = re.sub(r"\s+", "", m.group(0)).rstrip("/") if m else ""
+    street_name = " ".join(w for w in _HOUSE_NUM_RE.sub(" ", street_n).split() if w not in _STREET_NOISE)
+    return street_name, house
+
+
+def refresh_address_key(offer_id: int) -> Optional[str]:
+    offer = get_offer(offer_id)
+    if not offer:
+        return None
+    key = address_key(offer["street"], offer["city"], offer["housing_type"])
+    update_offer(offer_id, address_key=key)
+    return key
+
+
+def find_duplicates(offer_id: int) -> List[Tuple[sqlite3.Row, str]]:
+    """
+    Активні/резервні пропозиції з тим самим address_key або спільними фото.
+    Обидва запити — пошук по індексу (idx_offers_address_key / idx_offer_photos_unique).
+    """
+    offer = get_offer(offer_id)
+    if not offer:
+        return []
+
+    marks = ",".join("?" * len(DUPLICATE_STATUSES))
+    found: Dict[int, Tuple[sqlite3.Row, str]] = {}
+
+    con = db_conn()
+    cur = con.cursor()
+    if offer["address_key"]:
+        cur.execute(
+            f"""
+            SELECT id, seq, current_status FROM offers
+            WHERE address_key = ? AND current_status IN ({marks}) AND id != ?;
+            """,
+            (offer["address_key"], *DUPLICATE_STATUSES, offer_id),
+        )
+        for r in cur.fetchall():
+            found[r["id"]] = (r, "адреса")
+
+    cur.execute(
+        f"""
+        SELECT DISTINCT o.id, o.seq, o.current_status
+        FROM offer_photos mine
+        JOIN offer_photos other ON other.file_unique_id = mine.file_unique_id AND other.offer_id != mine.offer_id
+        JOIN offers o ON o.id = other.offer_id
+        WHERE mine.offer_id = ? AND o.current_status IN ({marks});
+        """,
+        (offer_id, *DUPLICATE_STATUSES),
+    )
+    for r in cur.fetchall():
+        if r["id"] in found:
+            found[r["id"]] = (r, "адреса + фото")
+        else:
+            found[r["id"]] = (r, "фото")
+    con.close()
+
+    return sorted(found.values(), key=lambda x: int(x[0]["seq"] or 0))
+
+
+def duplicates_warning(offer_id: int) -> Optional[str]:
+    dups = find_duplicates(offer_id)
+    if not dups:
+        return None
+    lines = ["⚠️ <b>Схоже, ця квартира вже є:</b>"]
+    for r, why in dups[:10]:
+        st = STATUS.get(r["current_status"] or "unknown", "❔ Невідома")
+        lines.append(f"• #{int(r['seq']):04d} — {st} (збіг: {why})")
+    return "\n".join(lines)
+
+
+# =========================
+# ARCHIVE (COLD STORAGE)
+# =========================
+# перенос в архів і бекап не перетинаються: інакше подія може потрапити
+# в знімок і гарячої БД, і архіву (або в жоден)
+_archive_lock = threading.Lock()
+
+
+def archive_path(year: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"status_events_{year}.db")
+
+
+def archive_files(start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[str]:
+    """Архівні файли (по роках), що перетинаються з періодом [start, end)."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    out = []
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (name.startswith("status_events_") and name.endswith(".db")):
+            continue
+        year = name[len("status_events_"):-len(".db")]
+        # ±1 рік: межі років у файлах рахувались у APP_TZ на момент архівації
+        if start and year < str(start.year - 1):
+            continue
+        if end and year > str(end.year + 1):
+            continue
+        out.append(os.path.join(ARCHIVE_DIR, name))
+    return out
+
+
+def _archive_batch(con: sqlite3.Connection, year: str, rows: List[sqlite3.Row]):
+    """
+    Переносить пачку подій одного року в архівний файл.
+    Архів, підсумки і видалення з гарячої БД — в одній транзакції,
+    тож повторний запуск після збою нічого не задвоїть.
+    """
+    con.execute("ATTACH DATABASE ? AS arch;", (archive_path(year),))
+    try:
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS arch.status_events (
+                id INTEGER PRIMARY KEY,
+                offer_id INTEGER,
+                offer_seq INTEGER,
+                at TEXT,
+                at_ts INTEGER,
+                status TEXT,
+                username TEXT,
+                user_id INTEGER
+            );
+            """
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS arch.idx_archive_at_ts ON status_events(at_ts);")
+        con.execute("CREATE INDEX IF NOT EXISTS arch.idx_archive_offer ON status_events(offer_id, at_ts);")
+
+        con.executemany(
+            """
+            INSERT OR IGNORE INTO arch.status_events (id, offer_id, offer_seq, at, at_ts, status, username, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            [
+                (r["id"], r["offer_id"], r["offer_seq"], r["at"], r["at_ts"], r["status"], r["username"], r["user_id"])
+                for r in rows
+            ],
+        )
+
+        # день у APP_TZ з at_ts — так само, як межі періодів у stats_for_range
+        rollup = Counter((local_day(r["at_ts"] or 0), r["username"] or "", r["status"]) for r in rows)
+        con.executemany(
+            """
+            INSERT INTO status_rollups (day, username, status, cnt) VALUES (?, ?, ?, ?)
+            ON CONFLICT(day, username, status) DO UPDATE SET cnt = cnt + excluded.cnt;
+            """,
+            [(day, u, st, c) for (day, u, st), c in rollup.items()],
+        )
+
+        con.executemany("DELETE FROM status_events WHERE id = ?;", [(r["id"],) for r in rows])
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.execute("DETACH DATABASE arch;")
+
+
+def archive_status_events() -> int:
+    """Переносить події, старші за ARCHIVE_AFTER_DAYS, в архів. Повертає кількість перенесених."""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+
+    cutoff = datetime.now(tz=APP_TZ) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    moved = 0
+    con = db_conn()
+    try:
+        while True:
+            cur = con.cursor()
+            cur.execute(
+                """
+                SELECT se.id, se.offer_id, o.seq AS offer_seq, se.at, se.at_ts, se.status, se.username, se.user_id
+                FROM status_events se
+                LEFT JOIN offers o ON o.id = se.offer_id
+                WHERE se.at_ts < ?
+                ORDER BY se.at_ts ASC
+                LIMIT ?;
+                """,
+                (to_ts(cutoff), ARCHIVE_BATCH),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            by_year: Dict[str, List[sqlite3.Row]] = {}
+            for r in rows:
+                year = datetime.fromtimestamp(r["at_ts"] or 0, tz=APP_TZ).strftime("%Y")
+                by_year.setdefault(year, []).append(r)
+            with _archive_lock:
+                for year, items in by_year.items():
+                    _archive_batch(con, year, items)
+            moved += len(rows)
+    finally:
+        con.close()
+    return moved
+
+
+def iter_status_events(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[sqlite3.Row]:
+    """
+    Події статусів за часом: спершу архівні файли (read-only, потоково),
+    потім гаряча БД. Архів завжди старіший, тож порядок зберігається.
+    """
+    ranged = bool(start and end)
+    params = (to_ts(start), to_ts(end)) if ranged else ()
+
+    for path in archive_files(start, end):
+        acon = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+        acon.row_factory = sqlite3.Row
+        try:
+            where = "WHERE at_ts >= ? AND at_ts < ?" if ranged else ""
+            yield from acon.execute(
+                f"SELECT at, offer_seq, status, username, user_id FROM status_events {where} ORDER BY at_ts ASC;",
+                params,
+            )
+        finally:
+            acon.close()
+
+    con = db_conn()
+    try:
+        where = "WHERE se.at_ts >= ? AND se.at_ts < ?" if ranged else ""
+        yield from con.execute(
+            f"""
+            SELECT se.at, o.seq AS offer_seq, se.status, se.username, se.user_id
+            FROM status_events se
+            LEFT JOIN offers o ON o.id = se.offer_id
+            {where}
+            ORDER BY se.at_ts ASC;
+            """,
+            params,
+        )
+    finally:
+        con.close()
+
+
+# =========================
+# BACKUPS
+# =========================
+_backup_lock = asyncio.Lock()
+
+
+def list_backups() -> List[str]:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    # .db.gz — старі бекапи лише гарячої БД; ротуються разом з новими .tar.gz
+    names = sorted(
+        n for n in os.listdir(BACKUP_DIR)
+        if n.startswith("database_") and n.endswith((".db.gz", ".tar.gz"))
+    )
+    return [os.path.join(BACKUP_DIR, n) for n in names]
+
+
+def latest_backup() -> Optional[str]:
+    backups = list_backups()
+    return backups[-1] if backups else None
+
+
+def rotate_backups():
+    for path in list_backups()[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _snapshot(src: sqlite3.Connection, dst_path: str):
+    # одним кроком (pages=-1) з read-снапшоту WAL: writer-и не чекають, а покроковий
+    # backup починався б спочатку після кожного чужого запису і на живій БД не закінчувався
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def backup_db() -> str:
+    """
+    Узгоджений знімок БД і архівних файлів через sqlite3 backup API (викликати в потоці),
+    потім tar.gz + ротація.
+    У бекапі: <DB_PATH>.name і archive/status_events_<рік>.db.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    ts = datetime.now(tz=APP_TZ).strftime("%Y-%m-%d_%H-%M-%S")
+    tmp_dir = os.path.join(BACKUP_DIR, f".database_{ts}.tmp")
+    tar_path = os.path.join(BACKUP_DIR, f"database_{ts}.tar.gz")
+
+    try:
+        os.makedirs(os.path.join(tmp_dir, "archive"))
+        members = [os.path.basename(DB_PATH)]
+        with _archive_lock:
+            _snapshot(db_conn(), os.path.join(tmp_dir, members[0]))
+            for path in archive_files():
+                name = os.path.join("archive", os.path.basename(path))
+                src = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+                _snapshot(src, os.path.join(tmp_dir, name))
+                members.append(name)
+
+        with tarfile.open(tar_path + ".part", "w:gz") as tar:
+            for name in members:
+                tar.add(os.path.join(tmp_dir, name), arcname=name)
+        os.replace(tar_path + ".part", tar_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            os.remove(tar_path + ".part")
+        except OSError:
+            pass
+
+    rotate_backups()
+    return tar_path
+
+
+async def make_backup() -> str:
+    async with _backup_lock:
+        return await asyncio.to_thread(backup_db)
+
+
+# =========================
+# SEND QUEUE
+# =========================
+class SendQueue:
+    """
+    Черга викликів Bot API з обмеженням швидкості: глобально (SEND_PER_SECOND)
+    і по чату (група — раз на GROUP_SEND_INTERVAL с). У кожного чату своя FIFO,
+    а купа (next_at, чат) вибирає чат, який готовий найраніше, — тож довгий /bulk
+    в одній групі не затримує особисті повідомлення й інші чати.
+    На RetryAfter відкладає лише цей чат. submit() повертає Future з результатом виклику.
+    """
+
+    def __init__(self):
+        self.chats: Dict[int, deque] = {}
+        self.ready: List[Tuple[float, int, int]] = []  # купа (next_at, порядок, chat_id) чатів з чергою
+        self.next_at: Dict[int, float] = {}
+        self.last_global = 0.0
+        self.wakeup = asyncio.Event()
+        self._order = 0
+        self._pending = 0
+
+    def _schedule(self, chat_id: int, at: float):
+        self._order += 1
+        heapq.heappush(self.ready, (at, self._order, chat_id))
+
+    def submit(self, chat_id: int, factory) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        q = self.chats.get(chat_id)
+        if q is None:
+            q = self.chats[chat_id] = deque()
+            self._schedule(chat_id, self.next_at.get(chat_id, 0.0))
+        q.append((factory, fut))
+        self._pending += 1
+        self.wakeup.set()
+        return fut
+
+    def pending(self) -> int:
+        return self._pending
+
+    async def _wait(self, timeout: Optional[float]):
+        # будить submit(): новий чат може бути готовий раніше за поточну голову купи
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.ready:
+                await self._wait(None)
+                continue
+            at, _, chat_id = self.ready[0]
+            wait = max(at, self.last_global + 1.0 / SEND_PER_SECOND) - loop.time()
+            if wait > 0:
+                await self._wait(wait)
+                continue
+
+            heapq.heappop(self.ready)
+            q = self.chats[chat_id]
+            factory, fut = q[0]
+            if not fut.cancelled():
+                now = loop.time()
+                self.last_global = now
+                self.next_at[chat_id] = now + (GROUP_SEND_INTERVAL if chat_id < 0 else PRIVATE_SEND_INTERVAL)
+                try:
+                    result = await factory()
+                except TelegramRetryAfter as e:
+                    # лишаємо виклик першим у черзі чату, сам чат — на паузу
+                    self.next_at[chat_id] = loop.time() + e.retry_after
+                    self._schedule(chat_id, self.next_at[chat_id])
+                    continue
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(result)
+
+            q.popleft()
+            self._pending -= 1
+            if q:
+                self._schedule(chat_id, self.next_at.get(chat_id, 0.0))
+            else:
+                del self.chats[chat_id]
+
+
+send_queue = SendQueue()
+
+# =========================
+# UPDATE DEDUP
+# =========================
+class UpdateDedup(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: відкидає вже оброблені update_id до хендлерів.
+    Гаряча перевірка — set у пам'яті (кільце на UPDATE_RING_SIZE) + поріг floor
+    зі збереженого в БД watermark. Watermark пишеться у фоні раз на секунду
+    і не обганяє незавершені апдейти (важливо при паралельній обробці).
+    """
+
+    def __init__(self, size: int = UPDATE_RING_SIZE):
+        self.size = size
+        self.ring: deque = deque()
+        self.seen: set = set()
+        self.in_flight: set = set()
+        self.max_seen = 0
+        self.floor = 0
+        self.persisted = 0
+        self.dropped = 0
+        self.last_seen_at = time.monotonic()
+
+    def _remember(self, update_id: int):
+        self.ring.append(update_id)
+        self.seen.add(update_id)
+        if len(self.ring) > self.size:
+            self.seen.discard(self.ring.popleft())
+
+    def watermark(self) -> int:
+        """Найбільший id, до якого (включно) все вже оброблено."""
+        if self.in_flight:
+            return max(self.floor, min(self.in_flight) - 1)
+        return max(self.floor, self.max_seen)
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        update_id = event.update_id
+        if update_id <= self.floor and time.monotonic() - self.last_seen_at > UPDATE_WATERMARK_MAX_AGE.total_seconds():
+            # тиждень тиші: Telegram міг почати нумерацію заново
+            self.floor = 0
+        if update_id <= self.floor or update_id in self.seen:
+            self.dropped += 1
+            log.info("duplicate update %s dropped", update_id)
+            return None
+
+        self._remember(update_id)
+        self.last_seen_at = time.monotonic()
+        self.in_flight.add(update_id)
+        self.max_seen = max(self.max_seen, update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(update_id)
+
+
+update_dedup = UpdateDedup()
+
+
+class HeavyGate(BaseMiddleware):
+    """
+    Inner-middleware на router.message / router.callback_query.
+    Хендлери з flags={"heavy": True} проходять не більше `limit` одночасно,
+    решта стоїть у FIFO-черзі й отримує «ви #N у черзі». Усе інше (кліки статусів,
+    кроки майстра) йде напряму — важкий хвіст не додає їм затримки.
+    """
+
+    def __init__(self, limit: int = HEAVY_CONCURRENCY, max_queue: int = HEAVY_QUEUE_MAX):
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting: deque = deque()
+
+    def _release(self):
+        # слот передається першому живому в черзі, лічильник не змінюється
+        while self.waiting:
+            fut = self.waiting.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @staticmethod
+    async def _notify(event, text: str):
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text, show_alert=False)
+            else:
+                await event.answer(text)
+        except Exception:
+            pass
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        if not get_flag(data, "heavy"):
+            return await handler(event, data)
+        # чужих не ставимо в чергу — хендлер одразу відповість «Доступ заборонено»
+        user = getattr(event, "from_user", None)
+        if user is None or not is_allowed(user.id):
+            return await handler(event, data)
+
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+        else:
+            if len(self.waiting) >= self.max_queue:
+                await self._notify(event, "⏳ Забагато важких запитів, спробуй за хвилину.")
+                return None
+            fut = asyncio.get_running_loop().create_future()
+            self.waiting.append(fut)
+            await self._notify(event, f"⏳ Черга важких запитів: ти #{len(self.waiting)}.")
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut in self.waiting:
+                    self.waiting.remove(fut)
+                elif fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+
+        try:
+            return await handler(event, data)
+        finally:
+            self._release()
+
+
+heavy_gate = HeavyGate()
+
+
+def load_update_watermark() -> int:
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT value FROM meta WHERE key = 'update_watermark';")
+    row = cur.fetchone()
+    con.close()
+    if not row or not row["value"]:
+        return 0
+    try:
+        update_id, saved_at = row["value"].split("@", 1)
+        if datetime.now(tz=APP_TZ) - datetime.fromisoformat(saved_at) > UPDATE_WATERMARK_MAX_AGE:
+            return 0
+        return int(update_id)
+    except ValueError:
+        return 0
+
+
+def save_update_watermark(update_id: int):
+    con = db_conn()
+    con.execute(
+        """
+        INSERT INTO meta (key, value) VALUES ('update_watermark', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value;
+        """,
+        (f"{update_id}@{now_iso()}",),
+    )
+    con.commit()
+    con.close()
+
+
+async def flush_update_watermark():
+    wm = update_dedup.watermark()
+    if wm > update_dedup.persisted:
+        await asyncio.to_thread(save_update_watermark, wm)
+        update_dedup.persisted = wm
+
+
+async def update_watermark_loop():
+    while True:
+        await asyncio.sleep(UPDATE_WATERMARK_FLUSH_SECONDS)
+        try:
+            await flush_update_watermark()
+        except Exception:
+            log.exception("update watermark flush failed")
+
+
+# посилання на фонові задачі, щоб їх не зібрав GC посеред роботи
+_background: set = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+# Кнопки: відповідаємо на callback одразу після перевірок і запису в БД (крутилка зникає),
+# а відправки в Bot API (повідомлення, альбоми, перемальовування) доробляє фонова задача.
+async def ack(call: types.CallbackQuery, text: Optional[str] = None, show_alert: bool = False):
+    try:
+        await call.answer(text, show_alert=show_alert)
+    except Exception as e:
+        log.info("callback %r answer failed: %s", call.data, e)
+
+
+def followup(call: types.CallbackQuery, coro, what: str = "Дію") -> asyncio.Task:
+    """
+    Фонове продовження обробки кнопки — лише відправки в Bot API; записи в БД робимо до ack.
+    Деталі помилки йдуть у лог, користувачу — коротке повідомлення.
+    """
+
+    async def run():
+        try:
+            await coro
+        except Exception:
+            log.exception("callback %r follow-up failed", call.data)
+            try:
+                await call.bot.send_message(call.from_user.id, f"❗️{what} не вдалося показати. Спробуй ще раз.")
+            except Exception:
+                pass
+
+    return spawn(run())
+
+
+async def save_step(call: types.CallbackQuery, offer_id: int, **fields) -> bool:
+    """Запис кроку майстра до ack: якщо не вдався, лишаємось на кроці й кажемо про це."""
+    try:
+        await storage.update_offer(offer_id, **fields)
+    except Exception:
+        log.exception("offer %s: saving %s failed", offer_id, sorted(fields))
+        await ack(call, "❗️Не вдалося зберегти, спробуй ще раз.", show_alert=True)
+        return False
+    return True
+
+
+# =========================
+# ROLES
+# =========================
+class RoleCache:
+    """
+    Активні користувачі {user_id: role} у пам'яті — перевірка прав без БД.
+    Кожен воркер раз на ROLE_REFRESH_SECONDS звіряє meta.users_version
+    і перечитує таблицю лише коли версія змінилась.
+    """
+
+    def __init__(self):
+        self.roles: Dict[int, str] = {}
+        self.version = -1
+
+    def role(self, user_id: int) -> Optional[str]:
+        return self.roles.get(user_id)
+
+    def refresh(self, force: bool = False) -> bool:
+        con = db_conn()
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT value FROM meta WHERE key = 'users_version';")
+            row = cur.fetchone()
+            version = int(row["value"]) if row else 0
+            if not force and version == self.version:
+                return False
+            cur.execute("SELECT user_id, role FROM users WHERE active = 1;")
+            self.roles = {int(r["user_id"]): r["role"] for r in cur.fetchall()}
+            self.version = version
+            return True
+        finally:
+            con.close()
+
+
+role_cache = RoleCache()
+
+
+def set_user_role(user_id: int, role: Optional[str], username: Optional[str] = None):
+    """role=None — деактивувати. Версію піднімаємо в тій самій транзакції."""
+    con = db_conn()
+    try:
+        if role is None:
+            con.execute("UPDATE users SET active = 0, updated_at = ? WHERE user_id = ?;", (now_iso(), user_id))
+        else:
+            con.execute(
+                """
+                INSERT INTO users (user_id, role, active, username, updated_at) VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    role = excluded.role, active = 1,
+                    username = COALESCE(excluded.username, users.username), updated_at = excluded.updated_at;
+                """,
+                (user_id, role, username, now_iso()),
+            )
+        con.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'users_version';")
+        con.commit()
+    finally:
+        con.close()
+    role_cache.refresh()
+
+
+def list_users() -> List[sqlite3.Row]:
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT * FROM users ORDER BY active DESC, role ASC, user_id ASC;")
+    rows = cur.fetchall()
+    con.close()
+    return rows
+
+
+async def role_refresh_loop():
+    while True:
+        await asyncio.sleep(ROLE_REFRESH_SECONDS)
+        try:
+            if await asyncio.to_thread(role_cache.refresh):
+                log.info("roles reloaded: %s users", len(role_cache.roles))
+        except Exception:
+            log.exception("roles refresh failed")
+
+
+# =========================
+# HELPERS
+# =========================
+def is_allowed(user_id: int) -> bool:
+    # порожня таблиця users — закрито для всіх (перших засіває ADMIN_USER_IDS / ALLOWED_USER_IDS)
+    return user_id in role_cache.roles
+
+
+def is_admin(user_id: int) -> bool:
+    return role_cache.role(user_id) == "admin"
+
+
+def group_chat_id() -> Optional[int]:
+    try:
+        return int(GROUP_CHAT_ID_RAW)
+    except ValueError:
+        return None
+
+
+def esc(s: str) -> str:
+    return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def offer_title(seq: int) -> str:
+    return f"🏡 <b>ПРОПОЗИЦІЯ #{seq:04d}</b>"
+
+
+def offer_text(offer: sqlite3.Row) -> str:
+    seq = int(offer["seq"])
+    status = (offer["current_status"] or "unknown").strip()
+    st = STATUS.get(status, "❔ Невідома")
+
+    def line(emoji: str, label: str, key: str):
+        val = offer[key] or "—"
+        return f"{emoji} <b>{label}:</b> {esc(str(val))}"
+
+    broker = offer["broker_username"] or "—"
+    if broker and not broker.startswith("@"):
+        broker = f"@{broker}"
+
+    parts = [
+        offer_title(seq),
+        f"📊 <b>Статус:</b> {st}",
+        "",
+        line("🏷️", "Категорія", "category"),
+        line("🏠", "Тип житла", "housing_type"),
+        line("📍", "Вулиця", "street"),
+        line("🏙️", "Місто", "city"),
+        line("🗺️", "Район", "district"),
+        line("✨", "Переваги", "advantages"),
+        line("💶", "Оренда", "rent"),
+        line("🔐", "Депозит", "deposit"),
+        line("🤝", "Комісія", "commission"),
         line("🚗", "Паркінг", "parking"),
         line("📦", "Заселення від", "move_in_from"),
         line("👀", "Огляди від", "viewings_from"),
@@ -273,883 +1804,4120 @@ def offer_text(offer: sqlite3.Row) -> str:
     return "\n".join(parts)
 
 
-def kb_category() -> InlineKeyboardMarkup:
+def kb_category() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="Оренда", callback_data="cat:Оренда"),
+                InlineKeyboardButton(text="Продаж", callback_data="cat:Продаж"),
+            ]
+        ]
+    )
+
+
+def kb_housing_type() -> InlineKeyboardMarkup:
+    rows = [
+        [
+            InlineKeyboardButton(text="Кімната", callback_data="ht:Кімната"),
+            InlineKeyboardButton(text="1-кімн.", callback_data="ht:1-кімн."),
+        ],
+        [
+            InlineKeyboardButton(text="2-кімн.", callback_data="ht:2-кімн."),
+            InlineKeyboardButton(text="3-кімн.", callback_data="ht:3-кімн."),
+        ],
+        [
+            InlineKeyboardButton(text="Будинок", callback_data="ht:Будинок"),
+            InlineKeyboardButton(text="Студія", callback_data="ht:Студія"),
+        ],
+        [
+            InlineKeyboardButton(text="Інше…", callback_data="ht_other"),
+        ],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def kb_parking() -> InlineKeyboardMarkup:
+    # кнопки лишаємо + дозволяємо текстом у цьому ж кроці
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="Є", callback_data="park:Є"),
+                InlineKeyboardButton(text="Немає", callback_data="park:Немає"),
+            ]
+        ]
+    )
+
+
+def kb_photos_done() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Готово", callback_data="photos_done")]
+        ]
+    )
+
+
+def kb_preview_actions() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="📣 Публікувати", callback_data="pub"),
+                InlineKeyboardButton(text="✏️ Редагувати", callback_data="edit"),
+            ],
+            [InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel")],
+        ]
+    )
+
+
+def kb_status_buttons(offer_id: int, version: Optional[int] = None) -> InlineKeyboardMarkup:
+    # статус "Невідома" не робимо кнопкою — це стартовий стан,
+    # далі маклер переводить у потрібний статус.
+    # version у callback_data — версія, яку бачив маклер (для compare-and-swap)
+    v = f":{version}" if version is not None else ""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🟢 Актуально", callback_data=f"st:{offer_id}:active{v}"),
+                InlineKeyboardButton(text="🟡 Резерв", callback_data=f"st:{offer_id}:reserve{v}"),
+            ],
+            [
+                InlineKeyboardButton(text="⚫️ Знято", callback_data=f"st:{offer_id}:removed{v}"),
+                InlineKeyboardButton(text="✅ Угода закрита", callback_data=f"st:{offer_id}:closed{v}"),
+            ],
+        ]
+    )
+
+
+# локи на рівні пропозиції: кліки по одній пропозиції йдуть по черзі,
+# різні пропозиції — паралельно; лок зникає разом з останнім, хто його тримає
+_offer_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def offer_lock(offer_id: int) -> asyncio.Lock:
+    lock = _offer_locks.get(offer_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _offer_locks[offer_id] = lock
+    return lock
+
+
+# =========================
+# FSM
+# =========================
+class OfferFSM(StatesGroup):
+    CATEGORY = State()
+    HOUSING_TYPE = State()
+    HOUSING_TYPE_OTHER = State()
+    STREET = State()
+    CITY = State()
+    DISTRICT = State()
+    ADVANTAGES = State()
+    RENT = State()
+    DEPOSIT = State()
+    COMMISSION = State()
+    PARKING = State()
+    MOVE_IN_FROM = State()
+    VIEWINGS_FROM = State()
+    PHOTOS = State()
+    PREVIEW = State()
+    PUBLISHING = State()  # publish_offer у фоні: кнопки превʼю вже не діють
+    EDIT_CHOOSE = State()
+    EDIT_VALUE = State()
+
+
+STREET_PROMPT = "📍 Напиши <b>вулицю</b> (або адресу коротко):"
+# поле з автопідказками -> стан, у якому його питаємо
+PLACE_STATES = {"street": OfferFSM.STREET, "city": OfferFSM.CITY, "district": OfferFSM.DISTRICT}
+# поле -> (наступний стан, наступне поле з підказками або None, питання)
+PLACE_STEPS = {
+    "street": (OfferFSM.CITY, "city", "🏙️ Напиши <b>місто</b>:"),
+    "city": (OfferFSM.DISTRICT, "district", "🗺️ Напиши <b>район</b>:"),
+    "district": (OfferFSM.ADVANTAGES, None, "✨ Напиши <b>переваги</b> (коротко):"),
+}
+
+
+EDIT_FIELDS = [
+    (1, "Категорія", "category"),
+    (2, "Тип житла", "housing_type"),
+    (3, "Вулиця", "street"),
+    (4, "Місто", "city"),
+    (5, "Район", "district"),
+    (6, "Переваги", "advantages"),
+    (7, "Оренда", "rent"),
+    (8, "Депозит", "deposit"),
+    (9, "Комісія", "commission"),
+    (10, "Паркінг", "parking"),
+    (11, "Заселення від", "move_in_from"),
+    (12, "Огляди від", "viewings_from"),
+    (13, "Маклер", "broker_username"),
+]
+
+
+def edit_list_text(seq: int) -> str:
+    lines = [
+        f"✏️ <b>Редагування #{seq:04d}</b>",
+        "Напиши номер пункту 1–13, який хочеш змінити.",
+        "",
+        "<b>Список:</b>",
+    ]
+    for num, name, _ in EDIT_FIELDS:
+        lines.append(f"{num}. {name}")
+    return "\n".join(lines)
+
+
+# =========================
+# AUTOCOMPLETE
+# =========================
+class PrefixIndex:
+    """
+    Відсортований масив нормалізованих ключів + bisect: пошук за префіксом
+    без проходу по всьому списку. Кожен ключ пам'ятає канонічне написання
+    (найчастіше на момент завантаження) і частоту. Розмір обмежений max_keys.
+    """
+
+    def __init__(self, max_keys: int = AC_MAX_KEYS):
+        self.max_keys = max_keys
+        self.keys: List[str] = []
+        self.display: Dict[str, str] = {}
+        self.count: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key: str, display: str, n: int = 1):
+        if not key:
+            return
+        if key in self.count:
+            self.count[key] += n
+            return
+        bisect.insort(self.keys, key)
+        self.display[key] = display
+        self.count[key] = n
+        if len(self.keys) > self.max_keys:
+            self._evict()
+
+    def _evict(self):
+        """Лишаємо 90% найчастіших ключів."""
+        keep = set(sorted(self.keys, key=lambda k: -self.count[k])[: self.max_keys * 9 // 10])
+        self.keys = [k for k in self.keys if k in keep]
+        self.display = {k: self.display[k] for k in self.keys}
+        self.count = {k: self.count[k] for k in self.keys}
+
+    def get(self, key: str) -> Optional[str]:
+        return self.display.get(key)
+
+    def suggest(self, prefix: str, limit: int = AC_SUGGEST) -> List[str]:
+        i = bisect.bisect_left(self.keys, prefix)
+        found = []
+        for key in self.keys[i:i + AC_SCAN]:
+            if not key.startswith(prefix):
+                break
+            found.append(key)
+        found.sort(key=lambda k: -self.count[k])
+        return [self.display[k] for k in found[:limit]]
+
+
+AC_SEP = "\x1f"  # район шукаємо в межах міста: ключ "місто␟район"
+ac_index: Dict[str, PrefixIndex] = {"street": PrefixIndex(), "city": PrefixIndex(), "district": PrefixIndex()}
+_HOUSE_NUM_RAW_RE = re.compile(_HOUSE_NUM_RE.pattern, re.IGNORECASE)
+
+
+def _street_name_display(street: str) -> str:
+    return " ".join(_HOUSE_NUM_RAW_RE.sub(" ", street).split()).strip(" ,")
+
+
+def ac_key(field: str, value: Optional[str], city: Optional[str] = None) -> str:
+    if field == "street":
+        return street_parts(norm_text(value))[0]
+    if field == "district":
+        return norm_text(city) + AC_SEP + norm_text(value)
+    return norm_text(value)
+
+
+def ac_add(field: str, value: Optional[str], city: Optional[str] = None, n: int = 1):
+    value = (value or "").strip()
+    if not value or (field == "district" and not norm_text(city)):
+        return
+    key = ac_key(field, value, city)
+    if not key or key.endswith(AC_SEP):
+        return
+    ac_index[field].add(key, _street_name_display(value) if field == "street" else value, n)
+
+
+def ac_canonical(field: str, value: str, city: Optional[str] = None) -> Optional[str]:
+    """Відоме канонічне написання для value (для вулиці — з тим самим номером будинку)."""
+    key = ac_key(field, value, city)
+    if not key or key.endswith(AC_SEP):
+        return None
+    display = ac_index[field].get(key)
+    if display is None:
+        return None
+    if field == "street":
+        house = street_parts(norm_text(value))[1]
+        m = _HOUSE_NUM_RAW_RE.search(value)
+        return f"{display} {m.group(0).strip() if m else house}".strip()
+    return display
+
+
+def ac_suggest(field: str, value: str, city: Optional[str] = None) -> List[str]:
+    if field == "district":
+        if not norm_text(city):
+            return []
+        prefix = norm_text(city) + AC_SEP + norm_text(value)
+    else:
+        prefix = ac_key(field, value, city)
+        if not prefix and value:
+            return []
+    options = ac_index[field].suggest(prefix)
+    if field == "street" and value:
+        m = _HOUSE_NUM_RAW_RE.search(value)
+        if m:
+            options = [f"{o} {m.group(0).strip()}" for o in options]
+    return options
+
+
+def load_autocomplete():
+    """Заповнює індекси з уже збережених пропозицій (канонічне = найчастіше написання)."""
+    spellings: Dict[str, Counter] = {f: Counter() for f in ac_index}
+    con = db_conn()
+    try:
+        for r in con.execute("SELECT street, city, district FROM offers WHERE city IS NOT NULL AND city != '';"):
+            for field in ac_index:
+                value = (r[field] or "").strip()
+                if not value:
+                    continue
+                if field == "street":
+                    value = _street_name_display(value)
+                spellings[field][(ac_key(field, value, r["city"]), value)] += 1
+    finally:
+        con.close()
+
+    for field, counter in spellings.items():
+        index = PrefixIndex()
+        totals: Counter = Counter()
+        best: Dict[str, Tuple[int, str]] = {}
+        for (key, value), n in counter.items():
+            if not key or key.endswith(AC_SEP):
+                continue
+            totals[key] += n
+            if n > best.get(key, (0, ""))[0]:
+                best[key] = (n, value)
+        for key, n in totals.most_common(AC_MAX_KEYS):
+            index.add(key, best[key][1], n)
+        ac_index[field] = index
+
+
+def kb_suggestions(options: List[str], keep: Optional[str] = None) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=o[:60], callback_data=f"ac:{i}")] for i, o in enumerate(options)]
+    if keep:
+        rows.append([InlineKeyboardButton(text=f"✍️ Залишити «{keep[:40]}»", callback_data="ac:keep")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# =========================
+# ROUTER
+# =========================
+router = Router()
+router.message.middleware(heavy_gate)
+router.callback_query.middleware(heavy_gate)
+
+
+@router.message(Command("start"))
+async def cmd_start(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
+        return
+
+    txt = (
+        "👋 Привіт!\n\n"
+        "Команди:\n"
+        "• /new — створити пропозицію\n"
+        "• /stats [week|quarter|2026-01-01..2026-03-31] — статистика\n"
+        "• /funnel [період] — час у статусах і конверсія\n"
+        "• /prices [місто, район, тип] — ціни на ринку\n"
+        "• /subscribe, /subscriptions, /unsubscribe — сповіщення про нові пропозиції\n\n"
+        "Підказка: фото додавай у кінці, заверши кнопкою ✅ Готово або /done."
+    )
+    if is_admin(message.from_user.id):
+        txt += (
+            "\n\n<b>Адміністратор:</b>\n"
+            "• /export [all|day|week|month|quarter|year|від..до] — Excel\n"
+            "• /bulk — масова зміна статусів\n"
+            "• /import — імпорт CSV/XLSX\n"
+            "• /users, /user — ролі\n"
+            "• /backup, /gc — обслуговування\n"
+            "• /profile &lt;секунди&gt; — профіль процесу"
+        )
+    await message.answer(txt)
+
+
+@router.message(Command("new"))
+async def cmd_new(message: types.Message, state: FSMContext):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
+        return
+
+    username = message.from_user.username or str(message.from_user.id)
+    if username and not username.startswith("@"):
+        username = f"@{username}"
+
+    offer_id = await storage.create_offer(broker_username=username, broker_user_id=message.from_user.id)
+    await state.set_data({"offer_id": offer_id})
+    await state.set_state(OfferFSM.CATEGORY)
+
+    await message.answer("Обери категорію:", reply_markup=kb_category())
+
+
+# ---------- CATEGORY ----------
+@router.callback_query(OfferFSM.CATEGORY, F.data.startswith("cat:"))
+async def cb_category(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+
+    category = call.data.split(":", 1)[1].strip()
+    if not await save_step(call, offer_id, category=category):
+        return
+    await state.set_state(OfferFSM.HOUSING_TYPE)
+    await ack(call)
+    followup(call, call.message.answer("Обери тип житла:", reply_markup=kb_housing_type()), "Наступний крок")
+
+
+# ---------- HOUSING TYPE ----------
+@router.callback_query(OfferFSM.HOUSING_TYPE, F.data.startswith("ht:"))
+async def cb_housing_type(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+
+    ht = call.data.split(":", 1)[1].strip()
+    if not await save_step(call, offer_id, housing_type=ht):
+        return
+    await state.set_state(OfferFSM.STREET)
+    options = await _prepare_place(state, "street")
+    await ack(call)
+    followup(call, _send_place_prompt(call.message, STREET_PROMPT, options), "Наступний крок")
+
+
+@router.callback_query(OfferFSM.HOUSING_TYPE, F.data == "ht_other")
+async def cb_housing_type_other(call: types.CallbackQuery, state: FSMContext):
+    await state.set_state(OfferFSM.HOUSING_TYPE_OTHER)
+    await ack(call)
+    await call.message.answer("🏠 Напиши свій варіант <b>типу житла</b>:")
+
+
+@router.message(OfferFSM.HOUSING_TYPE_OTHER)
+async def msg_housing_type_other(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+
+    ht = (message.text or "").strip()
+    if not ht:
+        await message.answer("Напиши текстом тип житла.")
+        return
+
+    await storage.update_offer(offer_id, housing_type=ht)
+    await state.set_state(OfferFSM.STREET)
+    await _ask_place(message, state, "street", STREET_PROMPT)
+
+
+# ---------- TEXT STEPS ----------
+async def _save_and_next_text(message: types.Message, state: FSMContext, field: str, next_state: State, prompt: str):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    val = (message.text or "").strip()
+    await storage.update_offer(offer_id, **{field: val})
+    await state.set_state(next_state)
+    await message.answer(prompt)
+
+
+# місто / район / вулиця: точний збіг з відомим значенням -> канонічне написання,
+# інакше, якщо є схожі за префіксом, — кнопки з підказками
+async def _prepare_place(state: FSMContext, field: str) -> List[str]:
+    """Стан для кроку місця; для міста/району — найчастіші значення для кнопок."""
+    options: List[str] = []
+    if field in ("city", "district"):
+        data = await state.get_data()
+        city = (await storage.get_offer(data["offer_id"]))["city"] if field == "district" else None
+        options = ac_suggest(field, "", city)
+    await state.update_data(ac_field=field, ac_raw=None, ac_options=options)
+    return options
+
+
+async def _send_place_prompt(message: types.Message, prompt: str, options: List[str]):
+    await message.answer(prompt, reply_markup=kb_suggestions(options) if options else None)
+
+
+async def _ask_place(message: types.Message, state: FSMContext, field: str, prompt: str):
+    """Питання наступного кроку; для міста/району — кнопки з найчастішими значеннями."""
+    await _send_place_prompt(message, prompt, await _prepare_place(state, field))
+
+
+async def _store_place(state: FSMContext, field: str, val: str) -> Tuple[str, List[str]]:
+    """Зберігає місце й переводить майстер на наступний крок. Повертає (питання, підказки)."""
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    await storage.update_offer(offer_id, **{field: val})
+    offer = await storage.get_offer(offer_id)
+    ac_add(field, val, offer["city"] if offer else None)
+
+    next_state, next_field, prompt = PLACE_STEPS[field]
+    await state.set_state(next_state)
+    if next_field:
+        return prompt, await _prepare_place(state, next_field)
+    await state.update_data(ac_field=None, ac_raw=None, ac_options=[])
+    return prompt, []
+
+
+async def _save_place(message: types.Message, state: FSMContext, field: str, val: str):
+    prompt, options = await _store_place(state, field, val)
+    await _send_place_prompt(message, prompt, options)
+
+
+async def _place_step(message: types.Message, state: FSMContext, field: str):
+    val = (message.text or "").strip()
+    city = None
+    if field == "district":
+        data = await state.get_data()
+        city = (await storage.get_offer(data["offer_id"]))["city"]
+
+    canonical = ac_canonical(field, val, city)
+    if canonical:
+        await _save_place(message, state, field, canonical)
+        return
+
+    options = ac_suggest(field, val, city) if len(norm_text(val)) >= AC_MIN_CHARS else []
+    if not options:
+        await _save_place(message, state, field, val)
+        return
+
+    await state.update_data(ac_field=field, ac_raw=val, ac_options=options)
+    await message.answer("🔎 Можливо, мав на увазі:", reply_markup=kb_suggestions(options, keep=val))
+
+
+@router.message(OfferFSM.STREET)
+async def msg_street(message: types.Message, state: FSMContext):
+    await _place_step(message, state, "street")
+
+
+@router.message(OfferFSM.CITY)
+async def msg_city(message: types.Message, state: FSMContext):
+    await _place_step(message, state, "city")
+
+
+@router.message(OfferFSM.DISTRICT)
+async def msg_district(message: types.Message, state: FSMContext):
+    await _place_step(message, state, "district")
+
+
+@router.callback_query(F.data.startswith("ac:"))
+async def cb_suggestion(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    field = data.get("ac_field")
+    current = await state.get_state()
+    if field not in PLACE_STATES or current != PLACE_STATES[field].state:
+        await call.answer("Підказка вже неактуальна", show_alert=False)
+        return
+
+    choice = call.data.split(":", 1)[1]
+    options = data.get("ac_options") or []
+    if choice == "keep" and data.get("ac_raw"):
+        val = data["ac_raw"]
+    elif choice.isdigit() and int(choice) < len(options):
+        val = options[int(choice)]
+    else:
+        await call.answer("Помилка", show_alert=False)
+        return
+    # друге натискання, поки зберігаємо перше, — вже не підказка
+    await state.update_data(ac_field=None)
+    try:
+        prompt, options = await _store_place(state, field, val)
+    except Exception:
+        log.exception("suggestion %r: saving %s failed", call.data, field)
+        await state.update_data(ac_field=field)
+        await ack(call, "❗️Не вдалося зберегти, спробуй ще раз.", show_alert=True)
+        return
+    await ack(call)
+
+    async def rest():
+        try:
+            await call.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        await call.message.answer(f"✅ {esc(val)}")
+        await _send_place_prompt(call.message, prompt, options)
+
+    followup(call, rest(), "Наступний крок")
+
+
+@router.message(OfferFSM.ADVANTAGES)
+async def msg_advantages(message: types.Message, state: FSMContext):
+    await _save_and_next_text(message, state, "advantages", OfferFSM.RENT, "💶 Напиши <b>оренду</b> (наприклад 350€):")
+
+
+@router.message(OfferFSM.RENT)
+async def msg_rent(message: types.Message, state: FSMContext):
+    await _save_and_next_text(message, state, "rent", OfferFSM.DEPOSIT, "🔐 Напиши <b>депозит</b>:")
+
+
+@router.message(OfferFSM.DEPOSIT)
+async def msg_deposit(message: types.Message, state: FSMContext):
+    await _save_and_next_text(message, state, "deposit", OfferFSM.COMMISSION, "🤝 Напиши <b>комісію</b>:")
+
+
+@router.message(OfferFSM.COMMISSION)
+async def msg_commission(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    await storage.update_offer(offer_id, commission=(message.text or "").strip())
+    await state.set_state(OfferFSM.PARKING)
+    await message.answer(
+        "🚗 Паркінг: обери кнопкою або <b>напиши текстом</b> (наприклад: 'підземний 50€')",
+        reply_markup=kb_parking(),
+    )
+
+
+# Паркінг кнопкою
+@router.callback_query(OfferFSM.PARKING, F.data.startswith("park:"))
+async def cb_parking(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    parking = call.data.split(":", 1)[1].strip()
+    if not await save_step(call, offer_id, parking=parking):
+        return
+    await state.set_state(OfferFSM.MOVE_IN_FROM)
+    await ack(call)
+    followup(call, call.message.answer("📦 Напиши <b>заселення від</b> (наприклад 'вже' або дата):"), "Наступний крок")
+
+
+# Паркінг текстом
+@router.message(OfferFSM.PARKING)
+async def msg_parking_text(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    parking = (message.text or "").strip()
+    if not parking:
+        await message.answer("Напиши текстом паркінг або обери кнопкою.", reply_markup=kb_parking())
+        return
+
+    await storage.update_offer(offer_id, parking=parking)
+    await state.set_state(OfferFSM.MOVE_IN_FROM)
+    await message.answer("📦 Напиши <b>заселення від</b> (наприклад 'вже' або дата):")
+
+
+@router.message(OfferFSM.MOVE_IN_FROM)
+async def msg_move_in(message: types.Message, state: FSMContext):
+    await _save_and_next_text(message, state, "move_in_from", OfferFSM.VIEWINGS_FROM, "👀 Напиши <b>огляди від</b>:")
+
+
+@router.message(OfferFSM.VIEWINGS_FROM)
+async def msg_viewings(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    await storage.update_offer(offer_id, viewings_from=(message.text or "").strip())
+
+    await state.set_state(OfferFSM.PHOTOS)
+    await message.answer("📸 Надішли фото. Коли закінчиш — натисни ✅ Готово або /done.", reply_markup=kb_photos_done())
+
+
+# ---------- PHOTOS ----------
+@router.message(OfferFSM.PHOTOS, F.photo)
+async def msg_photo(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+
+    photo = message.photo[-1]
+    await storage.add_photo(offer_id, photo.file_id, photo.file_unique_id)
+
+    offer = await storage.get_offer(offer_id)
+    try:
+        photos = json.loads(offer["photos_json"] or "[]")
+    except Exception:
+        photos = []
+    await message.answer(f"📸 Фото додано ({len(photos)}). Натисни ✅ Готово або /done.", reply_markup=kb_photos_done())
+
+
+@router.message(OfferFSM.PHOTOS, Command("done"))
+async def cmd_done_photos(message: types.Message, state: FSMContext):
+    await finish_photos_and_preview(message, state)
+
+
+@router.callback_query(OfferFSM.PHOTOS, F.data == "photos_done")
+async def cb_done_photos(call: types.CallbackQuery, state: FSMContext):
+    # стан міняємо до ack — повторний клік уже не пройде фільтр PHOTOS і не дасть друге превʼю
+    await state.set_state(OfferFSM.PREVIEW)
+    await ack(call)
+    followup(call, finish_photos_and_preview(call.message, state), "Попередній перегляд")
+
+
+@router.message(OfferFSM.PHOTOS)
+async def msg_photos_other(message: types.Message, state: FSMContext):
+    t = (message.text or "").strip().lower()
+    if t in ("готово", "done"):
+        await finish_photos_and_preview(message, state)
+        return
+    await message.answer("📸 Надішли фото або натисни ✅ Готово (/done).", reply_markup=kb_photos_done())
+
+
+async def finish_photos_and_preview(message: types.Message, state: FSMContext):
+    # до першого await з I/O: подвійний /done не пройде фільтр PHOTOS
+    await state.set_state(OfferFSM.PREVIEW)
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        await message.answer("❗️Пропозицію не знайдено.")
+        await state.clear()
+        return
+
+    await asyncio.to_thread(refresh_address_key, offer_id)
+
+    try:
+        photos = json.loads(offer["photos_json"] or "[]")
+    except Exception:
+        photos = []
+
+    if photos:
+        media = [types.InputMediaPhoto(media=p) for p in photos[:10]]
+        await message.answer_media_group(media=media)
+
+    warning = await asyncio.to_thread(duplicates_warning, offer_id)
+    if warning:
+        await message.answer(warning)
+
+    market = await asyncio.to_thread(market_position_text, offer)
+    if market:
+        await message.answer(market)
+
+    await message.answer(offer_text(offer), reply_markup=kb_preview_actions())
+    await message.answer("👉 Це фінальний вигляд. Обери дію:", reply_markup=kb_preview_actions())
+
+
+# ---------- PREVIEW ACTIONS ----------
+@router.callback_query(OfferFSM.PREVIEW, F.data == "cancel")
+async def cb_cancel(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data.get("offer_id")
+    if offer_id:
+        # під lock публікації: поки publish_offer шле альбом, чернетку не видаляємо
+        async with offer_lock(offer_id):
+            # клік пройшов фільтр PREVIEW, але «Опублікувати» встигло раніше
+            if await state.get_state() == OfferFSM.PUBLISHING.state:
+                await ack(call, "⏳ Ще публікую, зачекай…")
+                return
+            offer = await storage.get_offer(offer_id)
+            if offer and int(offer["is_published"] or 0) == 1:
+                await state.clear()
+                await ack(call, "ℹ️ Уже опубліковано.")
+                return
+            # якщо скасовано до публікації — прибираємо і offer, і status_events (опубліковану delete_draft не чіпає)
+            try:
+                await storage.delete_draft(offer_id)
+            except Exception:
+                log.exception("offer %s: deleting draft failed", offer_id)
+                await ack(call, "❗️Не вдалося скасувати, спробуй ще раз.", show_alert=True)
+                return
+    await state.clear()
+    await ack(call)
+    followup(call, call.message.answer("❌ Скасовано."), "Скасування")
+
+
+@router.callback_query(OfferFSM.PREVIEW, F.data == "edit")
+async def cb_edit(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    async with offer_lock(offer_id):
+        if await state.get_state() == OfferFSM.PUBLISHING.state:
+            await ack(call, "⏳ Ще публікую, зачекай…")
+            return
+        offer = await storage.get_offer(offer_id)
+        if not offer:
+            await state.clear()
+            await ack(call, "❗️Пропозицію не знайдено.", show_alert=True)
+            return
+        if int(offer["is_published"] or 0) == 1:
+            await state.clear()
+            await ack(call, "ℹ️ Уже опубліковано.")
+            return
+        await state.set_state(OfferFSM.EDIT_CHOOSE)
+    await ack(call)
+    await call.message.answer(edit_list_text(int(offer["seq"])))
+
+
+@router.callback_query(OfferFSM.PREVIEW, F.data == "pub")
+async def cb_publish(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        await state.clear()
+        await ack(call, "❗️Пропозицію не знайдено.", show_alert=True)
+        return
+
+    if int(offer["is_published"] or 0) == 1:
+        await ack(call, "ℹ️ Уже опубліковано.")
+        return
+
+    targets = publish_targets_for(offer)
+    if not targets:
+        await ack(call, "❗️Не задано GROUP_CHAT_ID / PUBLISH_TARGETS в Railway (Variables).", show_alert=True)
+        return
+
+    # до ack: «Скасувати»/«Редагувати»/повторне «Опублікувати» з превʼю вже не спрацюють
+    await state.set_state(OfferFSM.PUBLISHING)
+    await ack(call, "⏳ Публікую…")
+    followup(call, publish_offer(call, state, offer_id, targets), "Публікацію")
+
+
+@router.callback_query(OfferFSM.PUBLISHING)
+async def cb_publishing(call: types.CallbackQuery):
+    await ack(call, "⏳ Ще публікую, зачекай…")
+
+
+async def publish_offer(call: types.CallbackQuery, state: FSMContext, offer_id: int, targets: List[int]):
+    try:
+        published = await _publish_locked(call, offer_id, targets)
+    except Exception:
+        await state.set_state(OfferFSM.PREVIEW)
+        raise
+    if published is None:
+        # пропозиції вже немає або її опублікували раніше
+        await state.clear()
+        return
+    offer, ok, failed = published
+    if not ok:
+        # превʼю знову активне: можна повторити, редагувати чи скасувати
+        await state.set_state(OfferFSM.PREVIEW)
+        return
+    await asyncio.to_thread(sketch_offer_rents, [offer_id])
+    spawn(notify_subscribers(call.bot, offer_id))
+
+    text = f"✅ Пропозицію #{int(offer['seq']):04d} опубліковано ({len(ok)}/{len(targets)})."
+    if failed:
+        text += "\n❗️Не вдалося: " + ", ".join(f"<code>{c}</code>" for c, _ in failed)
+    await call.message.answer(text)
+    await state.clear()
+
+
+async def _publish_locked(call: types.CallbackQuery, offer_id: int, targets: List[int]):
+    """(offer, ok, failed); None — пропозиції вже немає або її встиг опублікувати інший клік."""
+    async with offer_lock(offer_id):
+        offer = await storage.get_offer(offer_id)
+        if not offer or int(offer["is_published"] or 0) == 1:
+            return None
+
+        results = await publish_everywhere(call.bot, offer, targets)
+        ok = [(chat_id, r) for chat_id, r in results if not isinstance(r, Exception)]
+        failed = [(chat_id, r) for chat_id, r in results if isinstance(r, Exception)]
+
+        if not ok:
+            await call.message.answer(
+                "❗️Не вдалося опублікувати:\n" + "\n".join(f"<code>{c}</code>: {esc(str(e))}" for c, e in failed)
+            )
+            return offer, ok, failed
+
+        first_chat, (first_msg, _) = ok[0]
+        await storage.update_offer(
+            offer_id,
+            is_published=1,
+            published_chat_id=first_chat,
+            published_message_id=first_msg,
+        )
+    return offer, ok, failed
+
+
+# ---------- EDIT FLOW ----------
+@router.message(OfferFSM.EDIT_CHOOSE)
+async def msg_edit_choose(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        await message.answer("❗️Пропозицію не знайдено.")
+        await state.clear()
+        return
+
+    text = (message.text or "").strip()
+    if not text.isdigit():
+        await message.answer("Напиши номер пункту 1–13 (наприклад 2).")
+        return
+
+    num = int(text)
+    field_map = {n: (name, key) for n, name, key in EDIT_FIELDS}
+    if num not in field_map:
+        await message.answer("Невірний номер. Напиши 1–13.")
+        return
+
+    name, key = field_map[num]
+    await state.update_data({"edit_field_key": key, "edit_field_name": name})
+
+    if key == "category":
+        await state.set_state(OfferFSM.CATEGORY)
+        await message.answer("Обери категорію:", reply_markup=kb_category())
+        return
+
+    if key == "housing_type":
+        await state.set_state(OfferFSM.HOUSING_TYPE)
+        await message.answer("Обери тип житла:", reply_markup=kb_housing_type())
+        return
+
+    if key == "parking":
+        await state.set_state(OfferFSM.PARKING)
+        await message.answer("🚗 Паркінг: обери кнопкою або напиши текстом.", reply_markup=kb_parking())
+        return
+
+    await state.set_state(OfferFSM.EDIT_VALUE)
+    await message.answer(f"✏️ Впиши нове значення для <b>{esc(name)}</b>:")
+
+
+@router.message(OfferFSM.EDIT_VALUE)
+async def msg_edit_value(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    offer_id = data["offer_id"]
+    key = data.get("edit_field_key")
+
+    offer = await storage.get_offer(offer_id)
+    if not offer or not key:
+        await message.answer("❗️Немає даних для редагування.")
+        await state.clear()
+        return
+
+    val = (message.text or "").strip()
+
+    if key == "broker_username":
+        if val and not val.startswith("@"):
+            val = f"@{val}"
+
+    if key in PLACE_STATES:
+        city = val if key == "city" else offer["city"]
+        val = ac_canonical(key, val, city) or val
+        ac_add(key, val, city)
+
+    await storage.update_offer(offer_id, **{key: val})
+    if key in ("street", "city", "housing_type"):
+        await asyncio.to_thread(refresh_address_key, offer_id)
+
+    offer2 = await storage.get_offer(offer_id)
+    await state.set_state(OfferFSM.PREVIEW)
+
+    await message.answer("✅ Оновлено. Ось новий вигляд:")
+    warning = await asyncio.to_thread(duplicates_warning, offer_id)
+    if warning:
+        await message.answer(warning)
+    await message.answer(offer_text(offer2), reply_markup=kb_preview_actions())
+
+
+# ---------- STATUS BUTTONS (GROUP) ----------
+@router.callback_query(F.data.startswith("st:"))
+async def cb_status(call: types.CallbackQuery):
+    parts = call.data.split(":")
+    # st:<id>:<status>[:<version>] — старі повідомлення без версії теж приймаємо
+    if len(parts) not in (3, 4) or not parts[1].isdigit():
+        await call.answer("Помилка", show_alert=False)
+        return
+
+    offer_id = int(parts[1])
+    status = parts[2]
+    seen_version = int(parts[3]) if len(parts) == 4 and parts[3].isdigit() else None
+
+    if status not in STATUS:
+        await call.answer("Невірний статус", show_alert=False)
+        return
+
+    if not is_allowed(call.from_user.id):
+        await call.answer("⛔️ Нема доступу", show_alert=True)
+        return
+
+    username = call.from_user.username or str(call.from_user.id)
+    if username and not username.startswith("@"):
+        username = f"@{username}"
+
+    # CAS у БД — частина перевірки (від нього залежить відповідь), решта — після ack
+    committed = await storage.set_status(
+        offer_id, status, username=username, user_id=call.from_user.id, expected_version=seen_version
+    )
+    if committed is None:
+        current = await storage.get_offer(offer_id)
+        if not current:
+            await ack(call, "Пропозицію не знайдено")
+            return
+        await ack(call, f"⚠️ Статус уже змінили: {STATUS.get(current['current_status'], '❔')}")
+    else:
+        await ack(call, "✅ Оновлено")
+    followup(call, render_status_change(call, offer_id, refresh_copies=committed is not None), "Оновлення повідомлення")
+
+
+async def render_status_change(call: types.CallbackQuery, offer_id: int, refresh_copies: bool):
+    # під lock і завжди з актуального рядка: порядок фонових задач не важливий
+    async with offer_lock(offer_id):
+        shown = await storage.get_offer(offer_id)
+        if not shown:
+            return
+        try:
+            await call.bot.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=offer_text(shown),
+                reply_markup=kb_status_buttons(offer_id, int(shown["version"] or 0)),
+            )
+        except TelegramBadRequest:
+            pass  # "message is not modified"
+    # поза lock: черга тримає темп по чатах, а копії однаково беруть актуальний рядок
+    if refresh_copies:
+        await refresh_all_copies(call.bot, offer_id, skip=(call.message.chat.id, call.message.message_id))
+
+
+# =========================
+# STATS
+# =========================
+PERIODS = ("day", "week", "month", "quarter", "year")
+PERIOD_TITLES = {"day": "День", "week": "Тиждень", "month": "Місяць", "quarter": "Квартал", "year": "Рік"}
+PERIOD_USAGE = "day|week|month|quarter|year або діапазон 2026-01-01..2026-03-31 (чи 2026-01..2026-03)"
+
+
+def _add_months(dt: datetime, months: int) -> datetime:
+    m = dt.month - 1 + months
+    return dt.replace(year=dt.year + m // 12, month=m % 12 + 1)
+
+
+def _period_bounds(period: str, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Межі [start, end) поточного періоду в APP_TZ (опівночі за місцевим часом)."""
+    now = now or datetime.now(tz=APP_TZ)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "day":
+        return midnight, midnight + timedelta(days=1)
+    if period == "week":
+        start = midnight - timedelta(days=midnight.weekday())
+        return start, start + timedelta(days=7)
+    if period == "month":
+        start = midnight.replace(day=1)
+        return start, _add_months(start, 1)
+    if period == "quarter":
+        start = midnight.replace(month=3 * ((now.month - 1) // 3) + 1, day=1)
+        return start, _add_months(start, 3)
+    if period == "year":
+        start = midnight.replace(month=1, day=1)
+        return start, start.replace(year=start.year + 1)
+    raise ValueError("Unknown period")
+
+
+def period_label(period: str, start: datetime) -> str:
+    if period == "day":
+        return start.strftime("%Y-%m-%d")
+    if period == "week":
+        y, w, _ = start.isocalendar()
+        return f"{y}-W{w:02d}"
+    if period == "month":
+        return start.strftime("%Y-%m")
+    if period == "quarter":
+        return f"{start.year}-Q{(start.month - 1) // 3 + 1}"
+    return start.strftime("%Y")
+
+
+def _parse_range_edge(s: str, is_end: bool) -> datetime:
+    """'2026-03-31' або '2026-03' у APP_TZ; для кінця — перший момент ПІСЛЯ (межа не включна)."""
+    s = s.strip()
+    try:
+        d = datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=APP_TZ)
+        return d + timedelta(days=1) if is_end else d
+    except ValueError:
+        d = datetime.strptime(s, "%Y-%m").replace(tzinfo=APP_TZ)
+        return _add_months(d, 1) if is_end else d
+
+
+def resolve_period(arg: str) -> Tuple[datetime, datetime, str]:
+    """'week' / 'quarter' / '2026-01-01..2026-03-31' -> (start, end, label). ValueError на сміття."""
+    arg = (arg or "").strip().lower()
+    if arg in PERIODS:
+        start, end = _period_bounds(arg)
+        return start, end, period_label(arg, start)
+    if ".." in arg:
+        a, b = arg.split("..", 1)
+        start = _parse_range_edge(a, is_end=False)
+        end = _parse_range_edge(b, is_end=True)
+        if end <= start:
+            raise ValueError("empty range")
+        return start, end, f"{a.strip()}..{b.strip()}"
+    raise ValueError(arg)
+
+
+def stats_for_range(start: datetime, end: datetime, label: str) -> Dict[str, Any]:
+    start_ts = to_ts(start)
+    end_ts = to_ts(end)
+
+    con = db_conn()
+    cur = con.cursor()
+
+    cur.execute(
+        """
+        SELECT status, COUNT(*) as cnt
+        FROM status_events
+        WHERE at_ts >= ? AND at_ts < ?
+        GROUP BY status;
+        """,
+        (start_ts, end_ts),
+    )
+    rows = cur.fetchall()
+    total = {k: 0 for k in STATUS_ORDER}
+    for r in rows:
+        st = r["status"]
+        if st in total:
+            total[st] = int(r["cnt"])
+
+    cur.execute(
+        """
+        SELECT username, status, COUNT(*) as cnt
+        FROM status_events
+        WHERE at_ts >= ? AND at_ts < ?
+        GROUP BY username, status
+        ORDER BY username ASC;
+        """,
+        (start_ts, end_ts),
+    )
+    rows2 = cur.fetchall()
+    per_broker: Dict[str, Dict[str, int]] = {}
+    for r in rows2:
+        u = r["username"] or "—"
+        st = r["status"]
+        if st not in STATUS:
+            continue
+        per_broker.setdefault(u, {k: 0 for k in STATUS_ORDER})
+        per_broker[u][st] = int(r["cnt"])
+
+    # події, що вже в архіві, рахуємо з денних підсумків
+    cur.execute(
+        """
+        SELECT username, status, SUM(cnt) AS cnt
+        FROM status_rollups
+        WHERE day >= ? AND day < ?
+        GROUP BY username, status;
+        """,
+        (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")),
+    )
+    for r in cur.fetchall():
+        st = r["status"]
+        if st not in STATUS:
+            continue
+        u = r["username"] or "—"
+        total[st] += int(r["cnt"])
+        per_broker.setdefault(u, {k: 0 for k in STATUS_ORDER})
+        per_broker[u][st] += int(r["cnt"])
+    per_broker = dict(sorted(per_broker.items()))
+
+    con.close()
+
+    return {"label": label, "total": total, "per_broker": per_broker}
+
+
+def broker_stats(username: str, start: datetime, end: datetime) -> Dict[str, int]:
+    """Зміни статусів одного маклера за [start, end) — для деталізації в /stats."""
+    con = db_conn()
+    cur = con.cursor()
+    counts = {k: 0 for k in STATUS_ORDER}
+    cur.execute(
+        """
+        SELECT status, COUNT(*) AS cnt FROM status_events
+        WHERE username = ? AND at_ts >= ? AND at_ts < ?
+        GROUP BY status;
+        """,
+        (username, to_ts(start), to_ts(end)),
+    )
+    rows = cur.fetchall()
+    cur.execute(
+        """
+        SELECT status, SUM(cnt) AS cnt FROM status_rollups
+        WHERE username = ? AND day >= ? AND day < ?
+        GROUP BY status;
+        """,
+        (username, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")),
+    )
+    rows += cur.fetchall()
+    con.close()
+    for r in rows:
+        if r["status"] in counts:
+            counts[r["status"]] += int(r["cnt"])
+    return counts
+
+
+def stats_for_period(period: str, now: Optional[datetime] = None) -> Dict[str, Any]:
+    start, end = _period_bounds(period, now)
+    return stats_for_range(start, end, period_label(period, start))
+
+
+def save_stats_snapshot(period: str, d: Dict[str, Any]):
+    con = db_conn()
+    con.execute(
+        """
+        INSERT INTO stats_snapshots (period, label, computed_at, data_json) VALUES (?, ?, ?, ?)
+        ON CONFLICT(period) DO UPDATE SET
+            label = excluded.label, computed_at = excluded.computed_at, data_json = excluded.data_json;
+        """,
+        (period, d["label"], now_iso(), json.dumps(d, ensure_ascii=False)),
+    )
+    con.commit()
+    con.close()
+
+
+def load_stats_snapshot(period: str) -> Optional[Dict[str, Any]]:
+    """Готовий знімок, якщо він для поточного дня/місяця/року; інакше None."""
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT label, computed_at, data_json FROM stats_snapshots WHERE period = ?;", (period,))
+    row = cur.fetchone()
+    con.close()
+    if not row:
+        return None
+
+    start, _ = _period_bounds(period)
+    if row["label"] != period_label(period, start):
+        return None
+    try:
+        d = json.loads(row["data_json"])
+    except Exception:
+        return None
+    d["computed_at"] = row["computed_at"]
+    return d
+
+
+def refresh_stats_snapshots():
+    for period in ("day", "month", "year"):
+        save_stats_snapshot(period, stats_for_period(period))
+
+
+def cached_stats(period: str) -> Dict[str, Any]:
+    return load_stats_snapshot(period) or stats_for_period(period)
+
+
+def _stats_block(title: str, d: Dict[str, Any]) -> str:
+    t = d["total"]
+    return (
+        f"<b>{title} ({d['label']})</b>\n"
+        f"{STATUS['unknown']}: {t['unknown']}\n"
+        f"{STATUS['active']}: {t['active']}\n"
+        f"{STATUS['reserve']}: {t['reserve']}\n"
+        f"{STATUS['removed']}: {t['removed']}\n"
+        f"{STATUS['closed']}: {t['closed']}\n"
+    )
+
+
+def broker_line(broker: str, counts: Dict[str, int]) -> str:
+    short = " · ".join(f"{STATUS[k].split()[0]} {counts[k]}" for k in STATUS_ORDER if counts.get(k))
+    return f"{esc(broker)}: {short or '—'}"
+
+
+def ranked_brokers(d: Dict[str, Any]) -> List[Tuple[str, Dict[str, int]]]:
+    """Маклери за активністю (кількість змін статусів), при рівності — за іменем."""
+    return sorted(d["per_broker"].items(), key=lambda kv: (-sum(kv[1].values()), kv[0]))
+
+
+def _top_block(title: str, d: Dict[str, Any]) -> str:
+    ranked = ranked_brokers(d)
+    lines = [f"🏆 <b>{title} — топ маклерів ({d['label']})</b>"]
+    if not ranked:
+        lines.append("— немає змін статусів")
+    for i, (broker, counts) in enumerate(ranked[:STATS_TOP_N], 1):
+        lines.append(f"{i}. {broker_line(broker, counts)}")
+    if len(ranked) > STATS_TOP_N:
+        lines.append(f"<i>…і ще {len(ranked) - STATS_TOP_N}</i>")
+    return "\n".join(lines)
+
+
+def paginate_lines(lines: List[str], budget: int, max_rows: int) -> List[Tuple[int, int]]:
+    """Межі сторінок [start, end): не більше max_rows рядків і budget символів на сторінку."""
+    pages: List[Tuple[int, int]] = []
+    start = size = 0
+    for i, line in enumerate(lines):
+        n = len(line) + 1
+        if i > start and (size + n > budget or i - start >= max_rows):
+            pages.append((start, i))
+            start, size = i, 0
+        size += n
+    pages.append((start, len(lines)))
+    return pages
+
+
+def _stats_cb(*parts: Any) -> Optional[str]:
+    # callback_data — до 64 байт; довгі імена маклерів лишаються без кнопки
+    data = ":".join(str(p) for p in parts)
+    return data if len(data.encode()) <= 64 else None
+
+
+def kb_stats_overview(periods: Tuple[str, ...]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text=f"🧑‍💼 {PERIOD_TITLES.get(p, 'Період')}", callback_data=f"sts:{p}:0")
+            for p in periods
+            if _stats_cb("sts", p, 0)
+        ]]
+    )
+
+
+def format_range_stats(title: str, d: Dict[str, Any]) -> str:
+    return "\n".join([
+        "📊 <b>Статистика (зміни статусів)</b>\n",
+        _stats_block(title, d),
+        _top_block(title, d),
+    ])
+
+
+def format_stats() -> str:
+    day = cached_stats("day")
+    month = cached_stats("month")
+    year = cached_stats("year")
+    block = _stats_block
+
+    computed = [d.get("computed_at") for d in (day, month, year) if d.get("computed_at")]
+    header = "📊 <b>Статистика (зміни статусів)</b>"
+    if computed:
+        header += f"\n<i>станом на {esc(min(computed)[11:16])}</i>"
+
+    parts = [
+        header + "\n",
+        block("День", day),
+        block("Місяць", month),
+        block("Рік", year),
+        "",
+        _top_block("Місяць", month),
+        "",
+        "<i>Усі маклери — кнопками нижче.</i>",
+    ]
+    return "\n".join(parts)
+
+
+async def period_stats(arg: str) -> Tuple[str, Dict[str, Any]]:
+    """arg як у /stats -> (заголовок, статистика); day/month/year — з готових знімків."""
+    title = PERIOD_TITLES.get(arg, "Період")
+    if arg in ("day", "month", "year"):
+        return title, await asyncio.to_thread(cached_stats, arg)
+    start, end, label = resolve_period(arg)
+    return title, await storage.stats_for_range(start, end, label)
+
+
+def broker_page(arg: str, title: str, d: Dict[str, Any], page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    ranked = ranked_brokers(d)
+    header = f"🧑‍💼 <b>{title} — по маклерах ({d['label']})</b>"
+    lines = [f"{i}. {broker_line(b, c)}" for i, (b, c) in enumerate(ranked, 1)]
+    pages = paginate_lines(lines, STATS_PAGE_CHARS - len(header) - 40, STATS_PAGE_ROWS)
+    page = max(0, min(page, len(pages) - 1))
+    a, b = pages[page]
+
+    text = header
+    if len(pages) > 1:
+        text += f"\n<i>сторінка {page + 1}/{len(pages)} · маклерів: {len(ranked)}</i>"
+    text += "\n\n" + ("\n".join(lines[a:b]) if lines else "— немає змін статусів")
+
+    rows: List[List[InlineKeyboardButton]] = []
+    buttons = [
+        InlineKeyboardButton(text=f"{i}. {broker}"[:40], callback_data=data)
+        for i, (broker, _) in enumerate(ranked[a:b], a + 1)
+        if (data := _stats_cb("stb", arg, page, broker))
+    ]
+    rows += [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"sts:{arg}:{page - 1}"))
+    if page < len(pages) - 1:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"sts:{arg}:{page + 1}"))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(text="⬅️ Зведення", callback_data=f"sto:{arg}")])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+BROKER_DETAIL_PERIODS = ("day", "week", "month", "quarter", "year")
+
+
+async def broker_detail(broker: str) -> str:
+    lines = [f"🧑‍💼 <b>{esc(broker)}</b> — зміни статусів", ""]
+    for p in BROKER_DETAIL_PERIODS:
+        start, end = _period_bounds(p)
+        counts = await storage.broker_stats(broker, start, end)
+        lines.append(f"<b>{PERIOD_TITLES[p]} ({period_label(p, start)})</b>")
+        lines += [f"  {STATUS[k]}: {counts[k]}" for k in STATUS_ORDER]
+    return "\n".join(lines)
+
+
+@router.message(Command("stats"), flags={"heavy": True})
+async def cmd_stats(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    if len(args) < 2:
+        text = await asyncio.to_thread(format_stats)
+        await message.answer(text, reply_markup=kb_stats_overview(("day", "month", "year")))
+        return
+
+    arg = args[1].strip().lower()
+    try:
+        title, d = await period_stats(arg)
+    except ValueError:
+        await message.answer(f"❗️Використання: /stats [{PERIOD_USAGE}]")
+        return
+
+    await message.answer(format_range_stats(title, d), reply_markup=kb_stats_overview((arg,)))
+
+
+def _parse_stats_cb(data: str) -> Optional[Tuple[str, str, int, str]]:
+    # sts:<period>:<page> | sto:<period> | stb:<period>:<page>:<broker>
+    parts = data.split(":", 3)
+    kind, arg = parts[0], parts[1] if len(parts) > 1 else ""
+    page = parts[2] if len(parts) > 2 else "0"
+    broker = parts[3] if len(parts) > 3 else ""
+    if not arg or not page.isdigit() or (kind == "stb" and not broker):
+        return None
+    return kind, arg, int(page), broker
+
+
+@router.callback_query(F.data.regexp(r"^st[sob]:"), flags={"heavy": True})
+async def cb_stats(call: types.CallbackQuery):
+    parsed = _parse_stats_cb(call.data)
+    if not parsed:
+        await call.answer("Помилка", show_alert=False)
+        return
+    if not is_allowed(call.from_user.id):
+        await call.answer("⛔️ Нема доступу", show_alert=True)
+        return
+    kind, arg, page, broker = parsed
+
+    # запит — тут, під слотом HeavyGate; у фон іде лише редагування повідомлення
+    if kind == "stb":
+        text = await broker_detail(broker)
+        markup = InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="⬅️ До списку", callback_data=f"sts:{arg}:{page}")]]
+        )
+    else:
+        try:
+            title, d = await period_stats(arg)
+        except ValueError:
+            await call.answer("Помилка", show_alert=False)
+            return
+        if kind == "sts":
+            text, markup = broker_page(arg, title, d, page)
+        else:
+            text, markup = format_range_stats(title, d), kb_stats_overview((arg,))
+    await ack(call)
+
+    async def rest():
+        try:
+            await call.message.edit_text(text, reply_markup=markup)
+        except TelegramBadRequest:
+            pass  # повторне натискання: "message is not modified"
+
+    followup(call, rest(), "Статистику")
+
+
+# ---------- FUNNEL ----------
+FUNNEL_DWELL = ("unknown", "active", "reserve")
+
+
+def _percentile(sorted_vals: List[int], q: float) -> int:
+    """Nearest-rank перцентиль по вже відсортованому списку."""
+    idx = max(0, min(len(sorted_vals) - 1, math.ceil(q * len(sorted_vals)) - 1))
+    return sorted_vals[idx]
+
+
+def fmt_duration(seconds: int) -> str:
+    hours = seconds / 3600
+    if hours < 48:
+        return f"{hours:.1f} год"
+    return f"{hours / 24:.1f} дн"
+
+
+def funnel_for_range(start: datetime, end: datetime, label: str) -> Dict[str, Any]:
+    """
+    З матеріалізованих status_durations (без перегляду status_events):
+    - dwell: медіана / p90 часу в статусі для відрізків, що завершились у періоді;
+    - conv: з пропозицій, що стали 🟢 у періоді, скільки потім дійшли до 🟡 / ✅.
+    Ключ "" — уся команда, інші — маклер-власник.
+    """
+    start_ts, end_ts = to_ts(start), to_ts(end)
+    con = db_conn()
+    cur = con.cursor()
+
+    durations: Dict[str, Dict[str, List[int]]] = {}
+    marks = ",".join("?" * len(FUNNEL_DWELL))
+    cur.execute(
+        f"""
+        SELECT broker, status, duration FROM status_durations
+        WHERE left_ts >= ? AND left_ts < ? AND status IN ({marks});
+        """,
+        (start_ts, end_ts, *FUNNEL_DWELL),
+    )
+    for r in cur:
+        for key in ("", r["broker"] or "—"):
+            durations.setdefault(key, {}).setdefault(r["status"], []).append(int(r["duration"]))
+
+    conv: Dict[str, Dict[str, int]] = {}
+    cur.execute(
+        """
+        SELECT a.broker,
+               COUNT(*) AS n,
+               SUM(EXISTS(SELECT 1 FROM status_durations x
+                          WHERE x.offer_id = a.offer_id AND x.status = 'reserve' AND x.entered_ts >= a.entered_ts)) AS reserve,
+               SUM(EXISTS(SELECT 1 FROM status_durations x
+                          WHERE x.offer_id = a.offer_id AND x.status = 'closed' AND x.entered_ts >= a.entered_ts)) AS closed
+        FROM (
+            SELECT offer_id, broker, MIN(entered_ts) AS entered_ts
+            FROM status_durations
+            WHERE status = 'active' AND entered_ts >= ? AND entered_ts < ?
+            GROUP BY offer_id
+        ) a
+        GROUP BY a.broker;
+        """,
+        (start_ts, end_ts),
+    )
+    for r in cur.fetchall():
+        for key in ("", r["broker"] or "—"):
+            c = conv.setdefault(key, {"n": 0, "reserve": 0, "closed": 0})
+            c["n"] += int(r["n"])
+            c["reserve"] += int(r["reserve"] or 0)
+            c["closed"] += int(r["closed"] or 0)
+    con.close()
+
+    dwell: Dict[str, Dict[str, Tuple[int, int, int]]] = {}
+    for key, by_status in durations.items():
+        for st, vals in by_status.items():
+            vals.sort()
+            dwell.setdefault(key, {})[st] = (_percentile(vals, 0.5), _percentile(vals, 0.9), len(vals))
+
+    return {"label": label, "dwell": dwell, "conv": conv}
+
+
+def format_funnel(d: Dict[str, Any]) -> str:
+    def conv_line(c: Optional[Dict[str, int]]) -> str:
+        if not c or not c["n"]:
+            return "—"
+        return (
+            f"🟢→🟡 {100 * c['reserve'] / c['n']:.0f}% · "
+            f"🟢→✅ {100 * c['closed'] / c['n']:.0f}% (n={c['n']})"
+        )
+
+    def dwell_lines(x: Dict[str, Tuple[int, int, int]], indent: str) -> List[str]:
+        return [
+            f"{indent}{STATUS[st]}: {fmt_duration(x[st][0])} / {fmt_duration(x[st][1])} (n={x[st][2]})"
+            for st in FUNNEL_DWELL
+            if st in x
+        ]
+
+    lines = [
+        f"📈 <b>Воронка ({esc(d['label'])})</b>",
+        "",
+        f"<b>Конверсія:</b> {conv_line(d['conv'].get(''))}",
+        "<b>Час у статусі</b> (медіана / p90):",
+    ]
+    lines += dwell_lines(d["dwell"].get("", {}), "") or ["— немає завершених відрізків"]
+
+    brokers = sorted(b for b in set(d["dwell"]) | set(d["conv"]) if b)
+    if brokers:
+        lines += ["", "🧑‍💼 <b>По маклерах:</b>"]
+    for b in brokers:
+        lines.append(f"\n<b>{esc(b)}</b>: {conv_line(d['conv'].get(b))}")
+        lines += dwell_lines(d["dwell"].get(b, {}), "  ")
+    return "\n".join(lines)
+
+
+@router.message(Command("funnel"), flags={"heavy": True})
+async def cmd_funnel(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    try:
+        start, end, label = resolve_period(args[1] if len(args) == 2 else "month")
+    except ValueError:
+        await message.answer(f"❗️Використання: /funnel [{PERIOD_USAGE}]")
+        return
+
+    d = await asyncio.to_thread(funnel_for_range, start, end, label)
+    await message.answer(format_funnel(d))
+
+
+def format_digest(d: Dict[str, Any]) -> str:
+    t = d["total"]
+    lines = [f"📰 <b>Підсумок дня ({d['label']})</b>", ""]
+    for k in STATUS_ORDER:
+        lines.append(f"{STATUS[k]}: {t[k]}")
+
+    if d["per_broker"]:
+        lines += ["", "🧑‍💼 <b>По маклерах:</b>"]
+        for broker, counts in d["per_broker"].items():
+            lines.append(broker_line(broker, counts))
+    else:
+        lines += ["", "— немає змін статусів"]
+    return "\n".join(lines)
+
+
+# =========================
+# SCHEDULER
+# =========================
+class Job:
+    """
+    Фонова задача: або щодня о вказаних годинах (at=["20:00"], APP_TZ),
+    або з інтервалом (every=timedelta). func(bot, slot) — async.
+    """
+
+    def __init__(self, name: str, func, at: Optional[List[str]] = None, every: Optional[timedelta] = None):
+        self.name = name
+        self.func = func
+        self.at = at or []
+        self.every = every
+
+    def latest_slot(self, now: datetime) -> datetime:
+        slots = []
+        for hhmm in self.at:
+            h, m = (int(x) for x in hhmm.split(":", 1))
+            slot = now.replace(hour=h, minute=m, second=0, microsecond=0)
+            if slot > now:
+                slot -= timedelta(days=1)
+            slots.append(slot)
+        return max(slots)
+
+    def due_slot(self, last_run: Optional[datetime], now: datetime) -> Optional[datetime]:
+        """
+        Момент, за який треба відпрацювати зараз, або None.
+        Після простою пропущений слот наздоганяємо один раз (не за кожен день).
+        """
+        if self.every:
+            if last_run is None or now - last_run >= self.every:
+                return now
+            return None
+        latest = self.latest_slot(now)
+        if last_run is not None and last_run < latest:
+            return latest
+        return None
+
+
+def load_job_state() -> Dict[str, datetime]:
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT name, last_run FROM job_state;")
+    out = {}
+    for r in cur.fetchall():
+        try:
+            out[r["name"]] = datetime.fromisoformat(r["last_run"])
+        except (TypeError, ValueError):
+            pass
+    con.close()
+    return out
+
+
+def save_job_state(name: str, last_run: datetime):
+    con = db_conn()
+    con.execute(
+        """
+        INSERT INTO job_state (name, last_run) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET last_run = excluded.last_run;
+        """,
+        (name, last_run.isoformat(timespec="seconds")),
+    )
+    con.commit()
+    con.close()
+
+
+async def scheduler_loop(bot: Bot, jobs: List[Job]):
+    state = await asyncio.to_thread(load_job_state)
+
+    # перший запуск щоденної задачі: лише запам'ятовуємо «зараз», без відправки
+    now = datetime.now(tz=APP_TZ)
+    for job in jobs:
+        if job.at and job.name not in state:
+            state[job.name] = now
+            await asyncio.to_thread(save_job_state, job.name, now)
+
+    async def run(job: Job, slot: datetime):
+        try:
+            await job.func(bot, slot)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("job %s failed", job.name)
+        # фіксуємо навіть після помилки, щоб не спамити повторами кожен тік
+        state[job.name] = slot
+        await asyncio.to_thread(save_job_state, job.name, slot)
+
+    # кожна задача — окремим task: довгий бекап чи архів не затримує дайджест і знімки;
+    # ту саму задачу вдруге не запускаємо, поки не завершився попередній запуск
+    running: Dict[str, asyncio.Task] = {}
+    try:
+        while True:
+            now = datetime.now(tz=APP_TZ)
+            for job in jobs:
+                task = running.get(job.name)
+                if task is not None and not task.done():
+                    continue
+                slot = job.due_slot(state.get(job.name), now)
+                if slot is None:
+                    continue
+                running[job.name] = spawn(run(job, slot))
+            await asyncio.sleep(SCHEDULER_TICK)
+    finally:
+        for task in running.values():
+            task.cancel()
+
+
+async def archive_job(bot: Bot, slot: datetime):
+    moved = await asyncio.to_thread(archive_status_events)
+    if moved:
+        log.info("archived %s status events", moved)
+
+
+async def backup_job(bot: Bot, slot: datetime):
+    path = await make_backup()
+    log.info("backup written: %s", path)
+
+
+async def stats_snapshot_job(bot: Bot, slot: datetime):
+    await asyncio.to_thread(refresh_stats_snapshots)
+
+
+async def digest_job(bot: Bot, slot: datetime):
+    chat_id = group_chat_id()
+    if chat_id is None:
+        return
+    # підсумок за день слоту (після простою — за той день, що пропустили)
+    d = await asyncio.to_thread(stats_for_period, "day", slot)
+    await bot.send_message(chat_id=chat_id, text=format_digest(d))
+
+
+def scheduled_jobs() -> List[Job]:
+    jobs = [
+        Job("stats_snapshot", stats_snapshot_job, every=timedelta(minutes=STATS_SNAPSHOT_MINUTES)),
+        Job("archive", archive_job, every=timedelta(hours=ARCHIVE_EVERY_HOURS)),
+        Job("backup", backup_job, every=timedelta(hours=BACKUP_EVERY_HOURS)),
+    ]
+    jobs.append(Job("rent_sketches", rent_sketch_job, every=timedelta(hours=RENT_SKETCH_REBUILD_HOURS)))
+    jobs.append(Job("draft_gc", gc_job, every=timedelta(minutes=DRAFT_GC_EVERY_MINUTES)))
+    if STALE_AFTER_DAYS > 0:
+        jobs.append(Job("stale_offers", stale_job, every=timedelta(minutes=STALE_EVERY_MINUTES)))
+    if DIGEST_AT:
+        jobs.append(Job("daily_digest", digest_job, at=DIGEST_AT))
+    return jobs
+
+
+# =========================
+# EXPORT (EXCEL)
+# =========================
+def count_export_rows(start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+    """Скільки рядків запише export_to_excel (пропозиції + події, разом з архівом)."""
+    ranged = bool(start and end)
+    params = (to_ts(start), to_ts(end)) if ranged else ()
+    total = 0
+    con = db_conn()
+    try:
+        where = "WHERE created_ts >= ? AND created_ts < ?" if ranged else ""
+        total += con.execute(f"SELECT COUNT(*) FROM offers {where};", params).fetchone()[0]
+        where = "WHERE at_ts >= ? AND at_ts < ?" if ranged else ""
+        total += con.execute(f"SELECT COUNT(*) FROM status_events {where};", params).fetchone()[0]
+    finally:
+        con.close()
+    for path in archive_files(start, end):
+        acon = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            total += acon.execute(f"SELECT COUNT(*) FROM status_events {where};", params).fetchone()[0]
+        finally:
+            acon.close()
+    return total
+
+
+async def export_to_excel(
+    store: Storage,
+    filepath: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """
+    Без меж — все (разом з архівом); з межами — [start, end) по created_ts / at_ts.
+    Рядки читаються курсорами сховища store, потоково.
+    progress(rows) викликається кожні EXPORT_PROGRESS_EVERY рядків; виняток із нього перериває експорт.
+    """
+    if Workbook is None:
+        raise RuntimeError("openpyxl не встановлений")
+
+    done = 0
+
+    def tick():
+        nonlocal done
+        done += 1
+        if progress and done % EXPORT_PROGRESS_EVERY == 0:
+            progress(done)
+
+    wb = Workbook()
+
+    ws = wb.active
+    ws.title = "Offers"
+    ws.append(
+        [
+            "SEQ",
+            "CreatedAt",
+            "Status",
+            "Category",
+            "HousingType",
+            "Street",
+            "City",
+            "District",
+            "Advantages",
+            "Rent",
+            "Deposit",
+            "Commission",
+            "Parking",
+            "MoveInFrom",
+            "ViewingsFrom",
+            "Broker",
+            "BrokerUserId",
+            "PhotosCount",
+            "PublishedChatId",
+            "PublishedMessageId",
+        ]
+    )
+
+    async for r in store.iter_offers(start, end):
+        try:
+            photos = json.loads(r["photos_json"] or "[]")
+        except Exception:
+            photos = []
+        st = (r["current_status"] or "unknown").strip()
+        ws.append(
+            [
+                r["seq"],
+                r["created_at"],
+                STATUS.get(st, st),
+                r["category"],
+                r["housing_type"],
+                r["street"],
+                r["city"],
+                r["district"],
+                r["advantages"],
+                r["rent"],
+                r["deposit"],
+                r["commission"],
+                r["parking"],
+                r["move_in_from"],
+                r["viewings_from"],
+                r["broker_username"],
+                r["broker_user_id"],
+                len(photos),
+                r["published_chat_id"],
+                r["published_message_id"],
+            ]
+        )
+        tick()
+
+    ws2 = wb.create_sheet("StatusEvents")
+    ws2.append(["At", "OfferSEQ", "Status", "Username", "UserId"])
+    # для SQLite — архівні файли + гаряча БД, потоково (без fetchall)
+    async for e in store.iter_status_events(start, end):
+        st = e["status"]
+        ws2.append(
+            [
+                e["at"],
+                e["offer_seq"],
+                STATUS.get(st, st),
+                e["username"],
+                e["user_id"],
+            ]
+        )
+        tick()
+
+    wb.save(filepath)
+    if progress:
+        progress(done)
+
+
+# =========================
+# EXPORT JOBS
+# =========================
+# Задачі живуть у export_jobs: queued -> running -> done | failed | cancelled.
+# Дочірній процес пише прогрес у ту саму БД і там же бачить скасування.
+class ExportCancelled(Exception):
+    pass
+
+
+def export_job_path(job_id: int) -> str:
+    return os.path.join(EXPORT_DIR, f"export_{job_id}.xlsx")
+
+
+def _ts_to_dt(ts: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(ts, tz=APP_TZ) if ts is not None else None
+
+
+def run_export_job(job_id: int, start_ts: Optional[int], end_ts: Optional[int]) -> Optional[str]:
+    """Виконується в ProcessPoolExecutor. Повертає шлях до готового файлу або None, якщо скасовано."""
+    return asyncio.run(_export_job(job_id, _ts_to_dt(start_ts), _ts_to_dt(end_ts)))
+
+
+async def _export_job(job_id: int, start: Optional[datetime], end: Optional[datetime]) -> Optional[str]:
+    # у дочірньому процесі своє сховище (з'єднання не переживають межу процесу)
+    st = SqliteStorage()
+    await st.init()
+    try:
+        return await _export_job_with(st, job_id, start, end)
+    finally:
+        await st.close()
+
+
+async def _export_job_with(st: Storage, job_id: int, start: Optional[datetime], end: Optional[datetime]) -> Optional[str]:
+    total = await st.count_export_rows(start, end)
+
+    def progress(rows: int):
+        con = db_conn()
+        try:
+            con.execute("UPDATE export_jobs SET rows_done = ? WHERE id = ?;", (rows, job_id))
+            con.commit()
+            status = con.execute("SELECT status FROM export_jobs WHERE id = ?;", (job_id,)).fetchone()
+        finally:
+            con.close()
+        if not status or status["status"] == "cancelled":
+            raise ExportCancelled()
+
+    con = db_conn()
+    con.execute("UPDATE export_jobs SET rows_total = ? WHERE id = ?;", (total, job_id))
+    con.commit()
+    con.close()
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = export_job_path(job_id)
+    try:
+        await export_to_excel(st, path, start, end, progress=progress)
+    except BaseException as e:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if isinstance(e, ExportCancelled):
+            return None  # свій клас винятку через межу процесу не передаємо
+        raise
+    return path
+
+
+def submit_export(label: str, start: Optional[datetime], end: Optional[datetime], chat_id: int) -> Tuple[int, bool]:
+    """
+    Ставить експорт у чергу. Такий самий незавершений експорт не дублюється —
+    просто додаємо ще одного отримувача. Повертає (job_id, merged).
+    """
+    start_ts = to_ts(start) if start else None
+    end_ts = to_ts(end) if end else None
+    job_key = f"{start_ts}:{end_ts}"
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        row = con.execute(
+            "SELECT id FROM export_jobs WHERE job_key = ? AND status IN ('queued', 'running') ORDER BY id LIMIT 1;",
+            (job_key,),
+        ).fetchone()
+        merged = row is not None
+        if merged:
+            job_id = int(row["id"])
+        else:
+            cur = con.execute(
+                """
+                INSERT INTO export_jobs (job_key, label, start_ts, end_ts, status, created_at)
+                VALUES (?, ?, ?, ?, 'queued', ?);
+                """,
+                (job_key, label, start_ts, end_ts, now_iso()),
+            )
+            job_id = int(cur.lastrowid)
+        con.execute("INSERT OR IGNORE INTO export_waiters (job_id, chat_id) VALUES (?, ?);", (job_id, chat_id))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    return job_id, merged
+
+
+def set_waiter_message(job_id: int, chat_id: int, message_id: int):
+    con = db_conn()
+    con.execute(
+        "UPDATE export_waiters SET message_id = ? WHERE job_id = ? AND chat_id = ?;",
+        (message_id, job_id, chat_id),
+    )
+    con.commit()
+    con.close()
+
+
+def get_export_job(job_id: int) -> Optional[sqlite3.Row]:
+    con = db_conn()
+    row = con.execute("SELECT * FROM export_jobs WHERE id = ?;", (job_id,)).fetchone()
+    con.close()
+    return row
+
+
+def export_waiters(job_id: int) -> List[sqlite3.Row]:
+    con = db_conn()
+    rows = con.execute("SELECT * FROM export_waiters WHERE job_id = ?;", (job_id,)).fetchall()
+    con.close()
+    return rows
+
+
+def export_queue_position(job_id: int) -> int:
+    con = db_conn()
+    n = con.execute(
+        "SELECT COUNT(*) FROM export_jobs WHERE status IN ('queued', 'running') AND id <= ?;", (job_id,)
+    ).fetchone()[0]
+    con.close()
+    return n
+
+
+def claim_export_job() -> Optional[sqlite3.Row]:
+    """Атомарно бере найстаріший queued-експорт у роботу."""
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        row = con.execute("SELECT * FROM export_jobs WHERE status = 'queued' ORDER BY id LIMIT 1;").fetchone()
+        if row:
+            con.execute("UPDATE export_jobs SET status = 'running' WHERE id = ?;", (row["id"],))
+        con.commit()
+        return row
+    finally:
+        con.close()
+
+
+def finish_export_job(job_id: int, status: str, error: Optional[str] = None):
+    con = db_conn()
+    # скасування, поставлене під час роботи, не перетираємо
+    con.execute(
+        """
+        UPDATE export_jobs SET status = CASE WHEN status = 'cancelled' THEN status ELSE ? END,
+            error = ?, finished_at = ?
+        WHERE id = ?;
+        """,
+        (status, error, now_iso(), job_id),
+    )
+    con.commit()
+    con.close()
+
+
+def cancel_export_waiter(job_id: int, chat_id: int) -> bool:
+    """Прибирає отримувача; якщо більше нікого не лишилось — скасовує задачу. True = скасовано."""
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        con.execute("DELETE FROM export_waiters WHERE job_id = ? AND chat_id = ?;", (job_id, chat_id))
+        left = con.execute("SELECT COUNT(*) FROM export_waiters WHERE job_id = ?;", (job_id,)).fetchone()[0]
+        cancelled = False
+        if left == 0:
+            cur = con.execute(
+                """
+                UPDATE export_jobs SET status = 'cancelled', finished_at = ?
+                WHERE id = ? AND status IN ('queued', 'running');
+                """,
+                (now_iso(), job_id),
+            )
+            cancelled = cur.rowcount > 0
+        con.commit()
+        return cancelled
+    finally:
+        con.close()
+
+
+def requeue_running_exports() -> int:
+    """Після рестарту незавершені задачі повертаються в чергу."""
+    con = db_conn()
+    cur = con.execute("UPDATE export_jobs SET status = 'queued', rows_done = 0 WHERE status = 'running';")
+    con.commit()
+    con.close()
+    return cur.rowcount
+
+
+def kb_export_cancel(job_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Оренда", callback_data="cat:Оренда"),
-                InlineKeyboardButton(text="Продаж", callback_data="cat:Продаж"),
-            ]
-        ]
+        inline_keyboard=[[InlineKeyboardButton(text="✖️ Скасувати", callback_data=f"expc:{job_id}")]]
+    )
+
+
+def export_progress_text(job: sqlite3.Row, position: int = 0) -> str:
+    head = f"📄 Excel експорт: <b>{esc(job['label'] or 'all')}</b>\n"
+    status = job["status"]
+    if status == "queued":
+        return head + f"⏳ У черзі: #{position}"
+    if status == "running":
+        total = int(job["rows_total"] or 0)
+        done = int(job["rows_done"] or 0)
+        if total:
+            return head + f"⚙️ Записано рядків: {done} / {total} ({done * 100 // total}%)"
+        return head + "⚙️ Рахую рядки…"
+    if status == "done":
+        return head + "✅ Готово"
+    if status == "cancelled":
+        return head + "✖️ Скасовано"
+    return head + f"❗️Помилка: {esc(job['error'] or '')}"
+
+
+async def update_export_messages(bot: Bot, job_id: int, final: bool = False, last: str = "") -> str:
+    """Перемальовує прогрес у всіх отримувачів; нічого не робить, якщо текст не змінився з `last`."""
+    job = await asyncio.to_thread(get_export_job, job_id)
+    if not job:
+        return last
+    position = await asyncio.to_thread(export_queue_position, job_id) if job["status"] == "queued" else 0
+    text = export_progress_text(job, position)
+    if text == last:
+        return last
+    markup = None if final else kb_export_cancel(job_id)
+    for w in await asyncio.to_thread(export_waiters, job_id):
+        if not w["message_id"]:
+            continue
+        try:
+            await bot.edit_message_text(
+                chat_id=int(w["chat_id"]), message_id=int(w["message_id"]), text=text, reply_markup=markup
+            )
+        except TelegramBadRequest:
+            pass  # "message is not modified" тощо
+        except Exception as e:
+            log.warning("export %s progress edit failed: %s", job_id, e)
+    return text
+
+
+async def deliver_export(bot: Bot, job: sqlite3.Row, path: str):
+    ts = datetime.now(tz=APP_TZ).strftime("%Y-%m-%d_%H-%M")
+    filename = f"orenda_export_{(job['label'] or 'all').replace('..', '_')}_{ts}.xlsx"
+    for w in await asyncio.to_thread(export_waiters, int(job["id"])):
+        try:
+            await bot.send_document(
+                int(w["chat_id"]),
+                FSInputFile(path, filename=filename),
+                caption=f"📄 Excel експорт: <b>{esc(job['label'] or 'all')}</b>",
+            )
+        except Exception as e:
+            log.warning("export %s delivery to %s failed: %s", job["id"], w["chat_id"], e)
+
+
+_export_pool: Optional[ProcessPoolExecutor] = None
+_export_wakeup = asyncio.Event()
+
+
+def export_pool() -> ProcessPoolExecutor:
+    global _export_pool
+    if _export_pool is None:
+        # spawn: не форкаємо процес з живим event loop і потоками
+        _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _export_pool
+
+
+async def export_worker(bot: Bot):
+    loop = asyncio.get_running_loop()
+    while True:
+        # спершу clear, потім claim: задача, додана між ними, або вже буде в claim, або знову підніме подію
+        _export_wakeup.clear()
+        job = await asyncio.to_thread(claim_export_job)
+        if not job:
+            try:
+                await asyncio.wait_for(_export_wakeup.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id = int(job["id"])
+        fut = loop.run_in_executor(export_pool(), run_export_job, job_id, job["start_ts"], job["end_ts"])
+        shown = ""
+        while not fut.done():
+            shown = await update_export_messages(bot, job_id, last=shown)
+            await asyncio.wait([fut], timeout=EXPORT_POLL_SECONDS)
+
+        try:
+            path = fut.result()
+        except Exception as e:
+            log.exception("export %s failed", job_id)
+            await asyncio.to_thread(finish_export_job, job_id, "failed", str(e)[:300])
+        else:
+            if path is None:
+                await asyncio.to_thread(finish_export_job, job_id, "cancelled")
+                await update_export_messages(bot, job_id, final=True)
+                continue
+            await asyncio.to_thread(finish_export_job, job_id, "done")
+            try:
+                await deliver_export(bot, job, path)
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        await update_export_messages(bot, job_id, final=True)
+
+
+async def export_workers(bot: Bot):
+    await asyncio.to_thread(requeue_running_exports)
+    try:
+        await asyncio.gather(*(export_worker(bot) for _ in range(max(1, EXPORT_WORKERS))))
+    finally:
+        if _export_pool is not None:
+            _export_pool.shutdown(wait=False, cancel_futures=True)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+
+    if Workbook is None:
+        await message.answer("❗️Додай openpyxl в requirements.txt (openpyxl==3.1.5) і перезапусти деплой.")
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    period = "all"
+    if len(args) == 2:
+        period = args[1].strip().lower()
+
+    start = end = None
+    if period != "all":
+        try:
+            start, end, period = resolve_period(period)
+        except ValueError:
+            await message.answer(f"❗️Використання: /export [all|{PERIOD_USAGE}]\nНаприклад: /export month")
+            return
+
+    job_id, merged = await asyncio.to_thread(submit_export, period, start, end, message.chat.id)
+    job = await asyncio.to_thread(get_export_job, job_id)
+    position = await asyncio.to_thread(export_queue_position, job_id)
+    text = export_progress_text(job, position)
+    if merged:
+        text += "\nℹ️ Такий самий експорт уже в роботі — надішлю його результат."
+    msg = await message.answer(text, reply_markup=kb_export_cancel(job_id))
+    await asyncio.to_thread(set_waiter_message, job_id, message.chat.id, msg.message_id)
+    _export_wakeup.set()
+
+
+@router.callback_query(F.data.startswith("expc:"))
+async def cb_export_cancel(call: types.CallbackQuery):
+    parts = call.data.split(":")
+    if len(parts) != 2 or not parts[1].isdigit():
+        await call.answer("Помилка", show_alert=False)
+        return
+    job_id = int(parts[1])
+    cancelled = await asyncio.to_thread(cancel_export_waiter, job_id, call.message.chat.id)
+    await ack(call, "Скасовано" if cancelled else "Гаразд")
+
+    async def rest():
+        try:
+            await call.message.edit_text(
+                export_progress_text(await asyncio.to_thread(get_export_job, job_id)) if cancelled
+                else "✖️ Експорт більше не чекаємо.",
+                reply_markup=None,
+            )
+        except TelegramBadRequest:
+            pass  # повторне натискання: "message is not modified"
+
+    followup(call, rest(), "Скасування експорту")
+
+
+# =========================
+# BACKUP (ADMIN)
+# =========================
+TG_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+
+@router.message(Command("backup"), flags={"heavy": True})
+async def cmd_backup(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    fresh = len(args) == 2 and args[1].strip().lower() == "now"
+
+    path = None if fresh else latest_backup()
+    if not path:
+        await message.answer("⏳ Роблю бекап…")
+        path = await make_backup()
+
+    if os.path.getsize(path) > TG_UPLOAD_LIMIT:
+        await message.answer(f"❗️Бекап завеликий для Telegram: <code>{esc(path)}</code>")
+        return
+
+    name = os.path.basename(path)
+    await message.answer_document(FSInputFile(path, filename=name), caption=f"💾 Бекап БД: <b>{esc(name)}</b>")
+
+
+# =========================
+# BULK STATUS (ADMIN)
+# =========================
+BULK_STATUSES = ("active", "reserve", "removed", "closed")
+BULK_FILTERS = {
+    "status": "current_status",
+    "broker": "broker_username",
+    "city": "city",
+    "category": "category",
+}
+BULK_USAGE = (
+    "❗️Використання: /bulk &lt;status&gt; &lt;номери або фільтри&gt;\n"
+    f"status: {', '.join(BULK_STATUSES)}\n"
+    "Номери: 12 15-40,52\n"
+    "Фільтри: status=active broker=@name city=Bratislava category=Оренда\n"
+    "Наприклад: /bulk closed 100-180 або /bulk removed status=reserve broker=@ivan"
+)
+
+
+def parse_bulk_selector(tokens: List[str]) -> Tuple[str, List[Any]]:
+    """'12 15-40,52 status=active' -> (SQL WHERE, params). ValueError на сміття."""
+    ranges: List[str] = []
+    filters: List[str] = []
+    params_r: List[Any] = []
+    params_f: List[Any] = []
+
+    for tok in tokens:
+        if "=" in tok:
+            key, val = tok.split("=", 1)
+            col = BULK_FILTERS.get(key.strip().lower())
+            val = val.strip()
+            if not col or not val:
+                raise ValueError(tok)
+            if col == "broker_username" and not val.startswith("@"):
+                val = f"@{val}"
+            filters.append(f"{col} = ? COLLATE NOCASE")
+            params_f.append(val)
+            continue
+
+        for part in tok.split(","):
+            part = part.strip().lstrip("#")
+            if not part:
+                continue
+            if "-" in part:
+                a, b = part.split("-", 1)
+                if not (a.isdigit() and b.isdigit()):
+                    raise ValueError(part)
+                ranges.append("seq BETWEEN ? AND ?")
+                params_r += sorted((int(a), int(b)))
+            elif part.isdigit():
+                ranges.append("seq = ?")
+                params_r.append(int(part))
+            else:
+                raise ValueError(part)
+
+    if not ranges and not filters:
+        raise ValueError("empty selector")
+
+    clauses = ["is_published = 1"] + filters
+    if ranges:
+        clauses.append("(" + " OR ".join(ranges) + ")")
+    return " AND ".join(clauses), params_f + params_r
+
+
+def bulk_set_status(where: str, params: List[Any], status: str, username: str, user_id: int) -> List[sqlite3.Row]:
+    """
+    Одна транзакція: вибірка, UPDATE offers і пачка INSERT у status_events.
+    Повертає змінені пропозиції (для оновлення повідомлень у групі).
+    """
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        cur = con.cursor()
+        cur.execute(
+            f"""
+            SELECT id, seq, published_chat_id, published_message_id FROM offers
+            WHERE {where} AND COALESCE(current_status, '') != ?
+            ORDER BY seq ASC;
+            """,
+            (*params, status),
+        )
+        rows = cur.fetchall()
+        if rows:
+            at = now_iso()
+            cur.executemany(
+                """
+                UPDATE offers SET current_status = ?, status_changed_at = ?, status_changed_ts = ?, version = version + 1
+                WHERE id = ?;
+                """,
+                [(status, at, iso_to_ts(at), r["id"]) for r in rows],
+            )
+            cur.executemany(
+                "INSERT INTO status_events (offer_id, at, at_ts, status, username, user_id) VALUES (?, ?, ?, ?, ?, ?);",
+                [(r["id"], at, iso_to_ts(at), status, username, user_id) for r in rows],
+            )
+            record_transitions(cur, [int(r["id"]) for r in rows], status, iso_to_ts(at))
+        con.commit()
+        return rows
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+
+async def refresh_offer_message(bot: Bot, offer_id: int, chat_id: int, message_id: int):
+    """Перемальовує повідомлення пропозиції з актуального стану БД."""
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=offer_text(offer),
+            reply_markup=kb_status_buttons(offer_id, int(offer["version"] or 0)),
+        )
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+async def _bulk_progress(progress: types.Message, futures: List[asyncio.Future], changed: int):
+    total = len(futures)
+    done = failed = 0
+    last_edit = 0.0
+    loop = asyncio.get_running_loop()
+
+    async def show(final: bool = False):
+        head = "✅ Готово." if final else "⏳ Оновлюю повідомлення в групі…"
+        text = f"{head}\nСтатус змінено: {changed}\nПовідомлень: {done}/{total}"
+        if failed:
+            text += f"\n❗️Не вдалося: {failed}"
+        try:
+            await progress.edit_text(text)
+        except Exception:
+            pass
+
+    for fut in asyncio.as_completed(futures):
+        try:
+            await fut
+        except Exception:
+            failed += 1
+        done += 1
+        if loop.time() - last_edit >= 5:
+            last_edit = loop.time()
+            await show()
+    await show(final=True)
+
+
+@router.message(Command("bulk"), flags={"heavy": True})
+async def cmd_bulk(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+
+    args = (message.text or "").split()[1:]
+    if len(args) < 2 or args[0].lower() not in BULK_STATUSES:
+        await message.answer(BULK_USAGE)
+        return
+
+    status = args[0].lower()
+    try:
+        where, params = parse_bulk_selector(args[1:])
+    except ValueError:
+        await message.answer(BULK_USAGE)
+        return
+
+    username = message.from_user.username or str(message.from_user.id)
+    if username and not username.startswith("@"):
+        username = f"@{username}"
+
+    rows = await asyncio.to_thread(bulk_set_status, where, params, status, username, message.from_user.id)
+    if not rows:
+        await message.answer("ℹ️ Немає пропозицій для зміни.")
+        return
+
+    targets = await asyncio.to_thread(get_publications, [int(r["id"]) for r in rows])
+    progress = await message.answer(
+        f"✅ {STATUS[status]}: {len(rows)} пропозицій.\n⏳ Повідомлень у групах у черзі: {len(targets)}"
     )
+    futures = [
+        send_queue.submit(
+            int(p["chat_id"]),
+            lambda p=p: refresh_offer_message(message.bot, int(p["offer_id"]), int(p["chat_id"]), int(p["message_id"])),
+        )
+        for p in targets
+    ]
+    spawn(_bulk_progress(progress, futures, len(rows)))
+
+
+# =========================
+# IMPORT (ADMIN)
+# =========================
+# колонки offers, які можна імпортувати; ключі — нормалізовані заголовки
+# (підходять і назви колонок БД, і заголовки з /export)
+IMPORT_COLUMNS = {
+    "seq": None,  # ігноруємо: номери видаємо самі
+    "createdat": "created_at",
+    "status": "current_status",
+    "currentstatus": "current_status",
+    "category": "category",
+    "housingtype": "housing_type",
+    "street": "street",
+    "city": "city",
+    "district": "district",
+    "advantages": "advantages",
+    "rent": "rent",
+    "deposit": "deposit",
+    "commission": "commission",
+    "parking": "parking",
+    "moveinfrom": "move_in_from",
+    "viewingsfrom": "viewings_from",
+    "broker": "broker_username",
+    "brokerusername": "broker_username",
+    "brokeruserid": "broker_user_id",
+}
+IMPORT_TEXT_FIELDS = [
+    "category", "housing_type", "street", "city", "district", "advantages",
+    "rent", "deposit", "commission", "parking", "move_in_from", "viewings_from",
+]
+_STATUS_BY_LABEL = {v.lower(): k for k, v in STATUS.items()}
+
+
+def _norm_header(h: Any) -> str:
+    return re.sub(r"[^a-z]", "", str(h or "").lower())
+
+
+def _cell_str(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    if isinstance(v, datetime):
+        return v.isoformat(timespec="seconds")
+    return str(v).strip()
+
+
+def iter_import_rows(path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Потоково: (номер рядка у файлі, {колонка offers: значення}). Нічого не тримає в пам'яті."""
+    if path.lower().endswith(".xlsx"):
+        if load_workbook is None:
+            raise RuntimeError("openpyxl не встановлений")
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, None) or []
+            cols = [IMPORT_COLUMNS.get(_norm_header(h)) for h in header]
+            for n, row in enumerate(rows, start=2):
+                if not any(v not in (None, "") for v in row):
+                    continue
+                yield n, {c: v for c, v in zip(cols, row) if c}
+        finally:
+            wb.close()
+        return
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(f, dialect)
+        header = next(reader, None) or []
+        cols = [IMPORT_COLUMNS.get(_norm_header(h)) for h in header]
+        for row in reader:
+            if not any(v.strip() for v in row):
+                continue
+            yield reader.line_num, {c: v for c, v in zip(cols, row) if c}
+
+
+def validate_import_row(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Сирий рядок -> значення для INSERT. ValueError з поясненням, якщо рядок поганий."""
+    out = {k: _cell_str(raw.get(k)) for k in IMPORT_TEXT_FIELDS}
+    if not out["street"] and not out["city"]:
+        raise ValueError("порожні вулиця і місто")
+
+    st = _cell_str(raw.get("current_status")).lower() or "unknown"
+    st = _STATUS_BY_LABEL.get(st, st)
+    if st not in STATUS:
+        raise ValueError(f"невідомий статус '{st}'")
+    out["current_status"] = st
+
+    created = raw.get("created_at")
+    if isinstance(created, datetime):
+        dt = created
+    elif _cell_str(created):
+        try:
+            dt = datetime.fromisoformat(_cell_str(created))
+        except ValueError:
+            raise ValueError(f"погана дата '{_cell_str(created)}'")
+    else:
+        dt = datetime.now(tz=APP_TZ)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=APP_TZ)
+    out["created_at"] = dt.astimezone(APP_TZ).isoformat(timespec="seconds")
+
+    broker = _cell_str(raw.get("broker_username"))
+    if broker and not broker.startswith("@"):
+        broker = f"@{broker}"
+    out["broker_username"] = broker
+
+    uid = _cell_str(raw.get("broker_user_id"))
+    if uid and not uid.lstrip("-").isdigit():
+        raise ValueError(f"поганий broker_user_id '{uid}'")
+    out["broker_user_id"] = int(uid) if uid else None
+
+    out["address_key"] = address_key(out["street"], out["city"], out["housing_type"])
+    return out
+
+
+def _import_batch(con: sqlite3.Connection, batch: List[Dict[str, Any]]) -> int:
+    """Одна транзакція: seq видаємо діапазоном, offers і status_events — пачками."""
+    con.execute("BEGIN IMMEDIATE;")
+    try:
+        cur = con.cursor()
+        first = next_seq(cur)
+        cur.executemany(
+            """
+            INSERT INTO offers (
+                seq, created_at, category, housing_type, street, city, district, advantages,
+                rent, deposit, commission, parking, move_in_from, viewings_from,
+                broker_username, broker_user_id, photos_json, current_status, is_published,
+                address_key, source, status_changed_at, status_changed_ts, created_ts
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '[]', ?, 0, ?, 'import', ?, ?, ?);
+            """,
+            [
+                (
+                    first + i, r["created_at"], *(r[k] for k in IMPORT_TEXT_FIELDS),
+                    r["broker_username"], r["broker_user_id"], r["current_status"], r["address_key"],
+                    r["created_at"], iso_to_ts(r["created_at"]), iso_to_ts(r["created_at"]),
+                )
+                for i, r in enumerate(batch)
+            ],
+        )
+        # початкові події — одним INSERT … SELECT по щойно виданому діапазону seq
+        cur.execute(
+            """
+            INSERT INTO status_events (offer_id, at, at_ts, status, username, user_id)
+            SELECT id, created_at, created_ts, current_status, broker_username, broker_user_id
+            FROM offers WHERE seq BETWEEN ? AND ?;
+            """,
+            (first, first + len(batch) - 1),
+        )
+        cur.execute(
+            """
+            INSERT INTO status_durations (offer_id, broker, status, entered_ts)
+            SELECT id, broker_username, current_status, created_ts
+            FROM offers WHERE seq BETWEEN ? AND ?;
+            """,
+            (first, first + len(batch) - 1),
+        )
+        _sketch_rents(cur, "seq BETWEEN ? AND ?", (first, first + len(batch) - 1))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    return len(batch)
+
+
+def _count_places(places: Counter, batch: List[Dict[str, Any]]):
+    for r in batch:
+        for field in ("street", "city", "district"):
+            places[(field, r[field], r["city"])] += 1
+
+
+def import_offers(path: str) -> Tuple[int, List[Tuple[int, str]], Counter]:
+    """
+    Імпорт файлу пачками по IMPORT_BATCH. Повертає (вставлено, [(рядок, помилка)], місця).
+    Місця {(поле, значення, місто): n} для автопідказок застосовує виклик у event loop —
+    ac_index читають хендлери майстра, тож з потоку імпорту його не чіпаємо.
+    """
+    inserted = 0
+    errors: List[Tuple[int, str]] = []
+    batch: List[Dict[str, Any]] = []
+    places: Counter = Counter()
+
+    con = db_conn()
+    try:
+        for line_no, raw in iter_import_rows(path):
+            try:
+                batch.append(validate_import_row(raw))
+            except ValueError as e:
+                errors.append((line_no, str(e)))
+                continue
+            if len(batch) >= IMPORT_BATCH:
+                inserted += _import_batch(con, batch)
+                _count_places(places, batch)
+                batch = []
+        if batch:
+            inserted += _import_batch(con, batch)
+            _count_places(places, batch)
+    finally:
+        con.close()
+    return inserted, errors, places
+
+
+IMPORT_USAGE = (
+    "📥 Надішли CSV або XLSX файлом з підписом <b>/import</b>.\n"
+    "Перший рядок — заголовки: category, housing_type, street, city, district, advantages, rent, "
+    "deposit, commission, parking, move_in_from, viewings_from, broker_username, broker_user_id, "
+    "status, created_at (підходять і заголовки з /export)."
+)
+
+
+@router.message(Command("import"), F.document, flags={"heavy": True})
+async def cmd_import_document(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+
+    doc = message.document
+    name = (doc.file_name or "").lower()
+    if not name.endswith((".csv", ".xlsx")):
+        await message.answer("❗️Потрібен файл .csv або .xlsx")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await message.answer("❗️Файл завеликий (ліміт Telegram — 20 МБ).")
+        return
+
+    ensure_dirs()
+    path = os.path.join(DATA_DIR, f"import_{doc.file_unique_id}{os.path.splitext(name)[1]}")
+    status_msg = await message.answer("⏳ Імпортую…")
+    try:
+        await message.bot.download(doc, destination=path)
+        inserted, errors, places = await asyncio.to_thread(import_offers, path)
+        for (field, value, city), n in places.items():
+            ac_add(field, value, city, n)
+    except Exception as e:
+        await status_msg.edit_text(f"❗️Імпорт не вдався: {esc(str(e))}")
+        return
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
+    text = f"✅ Імпортовано: <b>{inserted}</b>\n❗️Помилок: <b>{len(errors)}</b>"
+    if errors and len(errors) <= 20:
+        text += "\n\n" + "\n".join(f"рядок {n}: {esc(err)}" for n, err in errors)
+    await status_msg.edit_text(text)
+
+    if len(errors) > 20:
+        report = os.path.join(DATA_DIR, f"import_errors_{doc.file_unique_id}.csv")
+        with open(report, "w", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            w.writerow(["row", "error"])
+            w.writerows(errors)
+        try:
+            await message.answer_document(FSInputFile(report, filename="import_errors.csv"), caption="Помилки імпорту")
+        finally:
+            os.remove(report)
 
-def kb_housing_type() -> InlineKeyboardMarkup:
-    rows = [
-        [
-            InlineKeyboardButton(text="Кімната", callback_data="ht:Кімната"),
-            InlineKeyboardButton(text="1-кімн.", callback_data="ht:1-кімн."),
-        ],
-        [
-            InlineKeyboardButton(text="2-кімн.", callback_data="ht:2-кімн."),
-            InlineKeyboardButton(text="3-кімн.", callback_data="ht:3-кімн."),
-        ],
-        [
-            InlineKeyboardButton(text="Будинок", callback_data="ht:Будинок"),
-            InlineKeyboardButton(text="Студія", callback_data="ht:Студія"),
-        ],
-        [
-            InlineKeyboardButton(text="Інше…", callback_data="ht_other"),
-        ],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
 
+@router.message(Command("import"))
+async def cmd_import(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+    await message.answer(IMPORT_USAGE)
 
-def kb_parking() -> InlineKeyboardMarkup:
-    # кнопки лишаємо + дозволяємо текстом у цьому ж кроці
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Є", callback_data="park:Є"),
-                InlineKeyboardButton(text="Немає", callback_data="park:Немає"),
-            ]
-        ]
-    )
 
+# =========================
+# STALE OFFERS
+# =========================
+def find_stale_offers(limit: int = STALE_BATCH) -> List[sqlite3.Row]:
+    """
+    Опубліковані active/unknown, у яких статус не мінявся STALE_AFTER_DAYS.
+    Діапазон по idx_offers_stale_ts (current_status, status_changed_ts), не скан.
+    """
+    now = datetime.now(tz=APP_TZ)
+    cutoff = to_ts(now - timedelta(days=STALE_AFTER_DAYS))
+    remind = to_ts(now - timedelta(days=STALE_REMIND_DAYS))
 
-def kb_photos_done() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Готово", callback_data="photos_done")]
-        ]
-    )
+    out: List[sqlite3.Row] = []
+    con = db_conn()
+    cur = con.cursor()
+    for st in STALE_STATUSES:
+        cur.execute(
+            """
+            SELECT * FROM offers
+            WHERE current_status = ? AND status_changed_ts < ?
+              AND is_published = 1
+              AND (stale_notified_ts IS NULL OR stale_notified_ts < ?)
+            ORDER BY status_changed_ts ASC
+            LIMIT ?;
+            """,
+            (st, cutoff, remind, limit - len(out)),
+        )
+        out += cur.fetchall()
+        if len(out) >= limit:
+            break
+    con.close()
+    return out
 
 
-def kb_preview_actions() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="📣 Публікувати", callback_data="pub"),
-                InlineKeyboardButton(text="✏️ Редагувати", callback_data="edit"),
-            ],
-            [InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel")],
-        ]
+def expire_offers(offer_ids: List[int], status: str) -> None:
+    """Системний перехід статусу пачкою: одна транзакція, події від SYSTEM_USERNAME."""
+    if not offer_ids:
+        return
+    at = now_iso()
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        con.executemany(
+            """
+            UPDATE offers SET current_status = ?, status_changed_at = ?, status_changed_ts = ?, version = version + 1
+            WHERE id = ?;
+            """,
+            [(status, at, iso_to_ts(at), oid) for oid in offer_ids],
+        )
+        con.executemany(
+            "INSERT INTO status_events (offer_id, at, at_ts, status, username, user_id) VALUES (?, ?, ?, ?, ?, ?);",
+            [(oid, at, iso_to_ts(at), status, SYSTEM_USERNAME, SYSTEM_USER_ID) for oid in offer_ids],
+        )
+        record_transitions(con.cursor(), offer_ids, status, iso_to_ts(at))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+
+def mark_stale_notified(offer_ids: List[int]) -> None:
+    con = db_conn()
+    at = now_iso()
+    con.executemany(
+        "UPDATE offers SET stale_notified_at = ?, stale_notified_ts = ? WHERE id = ?;",
+        [(at, iso_to_ts(at), oid) for oid in offer_ids],
     )
+    con.commit()
+    con.close()
 
 
-def kb_status_buttons(offer_id: int) -> InlineKeyboardMarkup:
-    # статус "Невідома" не робимо кнопкою — це стартовий стан,
-    # далі маклер переводить у потрібний статус
+# статуси з кнопок нагадування; "unknown" сюди не входить — пропозиція лишилась би застарілою
+STALE_REPLY_STATUSES = ("active", "reserve", "removed", "closed")
+
+
+def kb_stale(offer_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="🟢 Актуально", callback_data=f"st:{offer_id}:active"),
-                InlineKeyboardButton(text="🟡 Резерв", callback_data=f"st:{offer_id}:reserve"),
+                InlineKeyboardButton(text="🟢 Ще актуально", callback_data=f"stale:{offer_id}:active"),
+                InlineKeyboardButton(text="🟡 Резерв", callback_data=f"stale:{offer_id}:reserve"),
             ],
             [
-                InlineKeyboardButton(text="⚫️ Знято", callback_data=f"st:{offer_id}:removed"),
-                InlineKeyboardButton(text="✅ Угода закрита", callback_data=f"st:{offer_id}:closed"),
+                InlineKeyboardButton(text="⚫️ Знято", callback_data=f"stale:{offer_id}:removed"),
+                InlineKeyboardButton(text="✅ Угода закрита", callback_data=f"stale:{offer_id}:closed"),
             ],
         ]
     )
 
 
-# =========================
-# FSM
-# =========================
-class OfferFSM(StatesGroup):
-    CATEGORY = State()
-    HOUSING_TYPE = State()
-    HOUSING_TYPE_OTHER = State()
-    STREET = State()
-    CITY = State()
-    DISTRICT = State()
-    ADVANTAGES = State()
-    RENT = State()
-    DEPOSIT = State()
-    COMMISSION = State()
-    PARKING = State()
-    MOVE_IN_FROM = State()
-    VIEWINGS_FROM = State()
-    PHOTOS = State()
-    PREVIEW = State()
-    EDIT_CHOOSE = State()
-    EDIT_VALUE = State()
-
-
-EDIT_FIELDS = [
-    (1, "Категорія", "category"),
-    (2, "Тип житла", "housing_type"),
-    (3, "Вулиця", "street"),
-    (4, "Місто", "city"),
-    (5, "Район", "district"),
-    (6, "Переваги", "advantages"),
-    (7, "Оренда", "rent"),
-    (8, "Депозит", "deposit"),
-    (9, "Комісія", "commission"),
-    (10, "Паркінг", "parking"),
-    (11, "Заселення від", "move_in_from"),
-    (12, "Огляди від", "viewings_from"),
-    (13, "Маклер", "broker_username"),
-]
-
-
-def edit_list_text(seq: int) -> str:
-    lines = [
-        f"✏️ <b>Редагування #{seq:04d}</b>",
-        "Напиши номер пункту 1–13, який хочеш змінити.",
-        "",
-        "<b>Список:</b>",
+def queue_offer_refresh(bot: Bot, offer: sqlite3.Row) -> List[asyncio.Future]:
+    """Ставить у send_queue перемальовування всіх копій пропозиції."""
+    return [
+        send_queue.submit(
+            int(p["chat_id"]),
+            lambda p=p: refresh_offer_message(bot, int(p["offer_id"]), int(p["chat_id"]), int(p["message_id"])),
+        )
+        for p in get_publications([int(offer["id"])])
     ]
-    for num, name, _ in EDIT_FIELDS:
-        lines.append(f"{num}. {name}")
-    return "\n".join(lines)
 
 
-# =========================
-# ROUTER
-# =========================
-router = Router()
-
+async def stale_job(bot: Bot, slot: datetime):
+    """Одна обмежена пачка (STALE_BATCH) за запуск — великий хвіст розходиться поступово."""
+    if STALE_AFTER_DAYS <= 0:
+        return
+    rows = await asyncio.to_thread(find_stale_offers)
+    if not rows:
+        return
 
-@router.message(Command("start"))
-async def cmd_start(message: types.Message):
-    if not is_allowed(message.from_user.id):
-        await message.answer("⛔️ Доступ заборонено.")
+    if STALE_ACTION == "expire":
+        await asyncio.to_thread(expire_offers, [int(r["id"]) for r in rows], STALE_EXPIRE_TO)
+        for r in rows:
+            queue_offer_refresh(bot, r)
+        log.info("expired %s stale offers", len(rows))
         return
 
-    txt = (
-        "👋 Привіт!\n\n"
-        "Команди:\n"
-        "• /new — створити пропозицію\n"
-        "• /stats — статистика (день/місяць/рік)\n"
-        "• /export [all|day|month|year] — Excel\n\n"
-        "Підказка: фото додавай у кінці, заверши кнопкою ✅ Готово або /done."
-    )
-    await message.answer(txt)
+    for r in rows:
+        if not r["broker_user_id"]:
+            continue
+        since = local_day(r["status_changed_ts"]) if r["status_changed_ts"] else "—"
+        text = (
+            f"⏰ Пропозиція #{int(r['seq']):04d} у статусі {STATUS.get(r['current_status'], '❔')} з {esc(since)}.\n"
+            "Вона ще актуальна?\n\n" + offer_text(r)
+        )
+        send_queue.submit(
+            int(r["broker_user_id"]),
+            lambda r=r, text=text: bot.send_message(int(r["broker_user_id"]), text, reply_markup=kb_stale(int(r["id"]))),
+        )
+    await asyncio.to_thread(mark_stale_notified, [int(r["id"]) for r in rows])
 
 
-@router.message(Command("new"))
-async def cmd_new(message: types.Message, state: FSMContext):
-    if not is_allowed(message.from_user.id):
-        await message.answer("⛔️ Доступ заборонено.")
+@router.callback_query(F.data.startswith("stale:"))
+async def cb_stale(call: types.CallbackQuery):
+    parts = call.data.split(":")
+    if len(parts) != 3 or not parts[1].isdigit() or parts[2] not in STALE_REPLY_STATUSES:
+        await call.answer("Помилка", show_alert=False)
+        return
+    if not is_allowed(call.from_user.id):
+        await call.answer("⛔️ Нема доступу", show_alert=True)
         return
 
-    username = message.from_user.username or str(message.from_user.id)
+    offer_id = int(parts[1])
+    status = parts[2]
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        await call.answer("Пропозицію не знайдено", show_alert=False)
+        return
+
+    username = call.from_user.username or str(call.from_user.id)
     if username and not username.startswith("@"):
         username = f"@{username}"
 
-    offer_id = create_offer(broker_username=username, broker_user_id=message.from_user.id)
-    await state.set_data({"offer_id": offer_id})
-    await state.set_state(OfferFSM.CATEGORY)
-
-    await message.answer("Обери категорію:", reply_markup=kb_category())
-
-
-# ---------- CATEGORY ----------
-@router.callback_query(OfferFSM.CATEGORY, F.data.startswith("cat:"))
-async def cb_category(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-
-    category = call.data.split(":", 1)[1].strip()
-    update_offer(offer_id, category=category)
-
-    await state.set_state(OfferFSM.HOUSING_TYPE)
-    await call.message.answer("Обери тип житла:", reply_markup=kb_housing_type())
-    await call.answer()
-
-
-# ---------- HOUSING TYPE ----------
-@router.callback_query(OfferFSM.HOUSING_TYPE, F.data.startswith("ht:"))
-async def cb_housing_type(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-
-    ht = call.data.split(":", 1)[1].strip()
-    update_offer(offer_id, housing_type=ht)
+    await storage.set_status(offer_id, status, username=username, user_id=call.from_user.id)
+    await ack(call, "✅ Оновлено")
+    queue_offer_refresh(call.bot, offer)
 
-    await state.set_state(OfferFSM.STREET)
-    await call.message.answer("📍 Напиши <b>вулицю</b> (або адресу коротко):")
-    await call.answer()
+    async def rest():
+        try:
+            await call.message.edit_text(f"✅ #{int(offer['seq']):04d}: {STATUS[status]}", reply_markup=None)
+        except TelegramBadRequest:
+            pass  # повторне натискання: "message is not modified"
 
+    followup(call, rest(), "Оновлення повідомлення")
 
-@router.callback_query(OfferFSM.HOUSING_TYPE, F.data == "ht_other")
-async def cb_housing_type_other(call: types.CallbackQuery, state: FSMContext):
-    await state.set_state(OfferFSM.HOUSING_TYPE_OTHER)
-    await call.message.answer("🏠 Напиши свій варіант <b>типу житла</b>:")
-    await call.answer()
 
+# =========================
+# DRAFT GC / FSM TTL
+# =========================
+class TTLMemoryStorage(MemoryStorage):
+    """MemoryStorage, що пам'ятає час останнього звернення до кожного ключа і вміє чистити старі."""
 
-@router.message(OfferFSM.HOUSING_TYPE_OTHER)
-async def msg_housing_type_other(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
+    def __init__(self):
+        super().__init__()
+        self.touched: Dict[Any, float] = {}
 
-    ht = (message.text or "").strip()
-    if not ht:
-        await message.answer("Напиши текстом тип житла.")
-        return
+    def _touch(self, key):
+        self.touched[key] = time.monotonic()
 
-    update_offer(offer_id, housing_type=ht)
-    await state.set_state(OfferFSM.STREET)
-    await message.answer("📍 Напиши <b>вулицю</b> (або адресу коротко):")
+    async def set_state(self, key, state=None) -> None:
+        self._touch(key)
+        await super().set_state(key, state)
 
+    async def get_state(self, key):
+        self._touch(key)
+        return await super().get_state(key)
 
-# ---------- TEXT STEPS ----------
-async def _save_and_next_text(message: types.Message, state: FSMContext, field: str, next_state: State, prompt: str):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    val = (message.text or "").strip()
-    update_offer(offer_id, **{field: val})
-    await state.set_state(next_state)
-    await message.answer(prompt)
+    async def set_data(self, key, data) -> None:
+        self._touch(key)
+        await super().set_data(key, data)
 
+    async def get_data(self, key):
+        self._touch(key)
+        return await super().get_data(key)
 
-@router.message(OfferFSM.STREET)
-async def msg_street(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "street", OfferFSM.CITY, "🏙️ Напиши <b>місто</b>:")
+    def sweep(self, ttl_seconds: float) -> Tuple[int, int]:
+        """Видаляє записи без звернень довше ttl. Повертає (кількість, ≈байт даних)."""
+        cutoff = time.monotonic() - ttl_seconds
+        removed = freed = 0
+        for key in [k for k, ts in self.touched.items() if ts < cutoff]:
+            record = self.storage.pop(key, None)
+            self.touched.pop(key, None)
+            if record is None:
+                continue
+            removed += 1
+            freed += sys.getsizeof(record.data) + len(json.dumps(record.data, ensure_ascii=False, default=str))
+        # ключі, створені defaultdict-ом без жодного touch (напр. з інших шляхів)
+        for key in [k for k in self.storage if k not in self.touched]:
+            self._touch(key)
+        return removed, freed
 
+    def offer_ids(self) -> List[int]:
+        """offer_id, з якими зараз працюють майстри (/new, редагування)."""
+        return [int(r.data["offer_id"]) for r in self.storage.values() if r.data.get("offer_id")]
 
-@router.message(OfferFSM.CITY)
-async def msg_city(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "city", OfferFSM.DISTRICT, "🗺️ Напиши <b>район</b>:")
 
+fsm_storage = TTLMemoryStorage()
 
-@router.message(OfferFSM.DISTRICT)
-async def msg_district(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "district", OfferFSM.ADVANTAGES, "✨ Напиши <b>переваги</b> (коротко):")
 
+def gc_drafts(live_ids: Tuple[int, ...] = ()) -> Tuple[int, int]:
+    """
+    Видаляє неопубліковані чернетки з майстра (/new), старші за DRAFT_TTL_HOURS,
+    разом з їх status_events і фото — пачками по DRAFT_GC_BATCH.
+    live_ids — чернетки, які ще відкриті в майстрі (FSM), їх не чіпаємо, хоч би якими старими були.
+    Імпортовані пропозиції (source='import') не чіпаємо. Повертає (offers, events).
+    """
+    cutoff = to_ts(datetime.now(tz=APP_TZ) - timedelta(hours=DRAFT_TTL_HOURS))
+    live = json.dumps(list(live_ids))
+    offers_deleted = events_deleted = 0
+    # залежні рядки — лише поки пропозиція досі чернетка (її могли опублікувати між пачками)
+    still_draft = "offer_id IN (SELECT id FROM offers WHERE id = ? AND is_published = 0)"
 
-@router.message(OfferFSM.ADVANTAGES)
-async def msg_advantages(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "advantages", OfferFSM.RENT, "💶 Напиши <b>оренду</b> (наприклад 350€):")
+    con = db_conn()
+    try:
+        while True:
+            # вибірка й видалення під одним write-lock: між ними ніхто не опублікує
+            con.execute("BEGIN IMMEDIATE;")
+            try:
+                cur = con.cursor()
+                cur.execute(
+                    """
+                    SELECT id FROM offers
+                    WHERE is_published = 0 AND created_ts < ? AND COALESCE(source, 'bot') = 'bot'
+                      AND id NOT IN (SELECT value FROM json_each(?))
+                    LIMIT ?;
+                    """,
+                    (cutoff, live, DRAFT_GC_BATCH),
+                )
+                ids = [(r["id"],) for r in cur.fetchall()]
+                if not ids:
+                    con.rollback()
+                    break
+                cur.executemany(f"DELETE FROM status_events WHERE {still_draft};", ids)
+                events_deleted += cur.rowcount if cur.rowcount > 0 else 0
+                cur.executemany(f"DELETE FROM offer_photos WHERE {still_draft};", ids)
+                cur.executemany(f"DELETE FROM status_durations WHERE {still_draft};", ids)
+                cur.executemany("DELETE FROM offers WHERE id = ? AND is_published = 0;", ids)
+                offers_deleted += cur.rowcount if cur.rowcount > 0 else 0
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+    finally:
+        con.close()
+    return offers_deleted, events_deleted
 
 
-@router.message(OfferFSM.RENT)
-async def msg_rent(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "rent", OfferFSM.DEPOSIT, "🔐 Напиши <b>депозит</b>:")
+async def run_gc() -> str:
+    fsm_removed, fsm_bytes = fsm_storage.sweep(FSM_TTL_HOURS * 3600)
+    offers_deleted, events_deleted = await asyncio.to_thread(gc_drafts, tuple(fsm_storage.offer_ids()))
+    return (
+        f"🧹 FSM: {fsm_removed} станів (≈{fsm_bytes / 1024:.1f} KB)\n"
+        f"🧹 Чернетки: {offers_deleted} пропозицій, {events_deleted} подій статусу"
+    )
 
 
-@router.message(OfferFSM.DEPOSIT)
-async def msg_deposit(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "deposit", OfferFSM.COMMISSION, "🤝 Напиши <b>комісію</b>:")
+async def gc_job(bot: Bot, slot: datetime):
+    report = await run_gc()
+    log.info("gc: %s", report.replace("\n", "; "))
 
 
-@router.message(OfferFSM.COMMISSION)
-async def msg_commission(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    update_offer(offer_id, commission=(message.text or "").strip())
-    await state.set_state(OfferFSM.PARKING)
-    await message.answer(
-        "🚗 Паркінг: обери кнопкою або <b>напиши текстом</b> (наприклад: 'підземний 50€')",
-        reply_markup=kb_parking(),
-    )
+@router.message(Command("gc"), flags={"heavy": True})
+async def cmd_gc(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
+    await message.answer(await run_gc())
 
 
-# Паркінг кнопкою
-@router.callback_query(OfferFSM.PARKING, F.data.startswith("park:"))
-async def cb_parking(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    parking = call.data.split(":", 1)[1].strip()
-    update_offer(offer_id, parking=parking)
+# =========================
+# PROFILER (ADMIN)
+# =========================
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
 
-    await state.set_state(OfferFSM.MOVE_IN_FROM)
-    await call.message.answer("📦 Напиши <b>заселення від</b> (наприклад 'вже' або дата):")
-    await call.answer()
 
+def _frame_stack(frame, limit: int = 128) -> List[str]:
+    """Стек від кореня до листа."""
+    out = []
+    while frame is not None and len(out) < limit:
+        out.append(_frame_label(frame))
+        frame = frame.f_back
+    out.reverse()
+    return out
 
-# Паркінг текстом
-@router.message(OfferFSM.PARKING)
-async def msg_parking_text(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    parking = (message.text or "").strip()
-    if not parking:
-        await message.answer("Напиши текстом паркінг або обери кнопкою.", reply_markup=kb_parking())
-        return
 
-    update_offer(offer_id, parking=parking)
-    await state.set_state(OfferFSM.MOVE_IN_FROM)
-    await message.answer("📦 Напиши <b>заселення від</b> (наприклад 'вже' або дата):")
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
 
 
-@router.message(OfferFSM.MOVE_IN_FROM)
-async def msg_move_in(message: types.Message, state: FSMContext):
-    await _save_and_next_text(message, state, "move_in_from", OfferFSM.VIEWINGS_FROM, "👀 Напиши <b>огляди від</b>:")
+def _task_stack(task: asyncio.Task, limit: int = 128) -> List[str]:
+    """Ланцюжок await-ів задачі (без кадрів самого asyncio): де саме вона зараз чекає."""
+    out = []
+    coro = task.get_coro()
+    while coro is not None and len(out) < limit:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        if not frame.f_code.co_filename.startswith(_ASYNCIO_DIR):
+            out.append(f"{_frame_label(frame)}:{frame.f_lineno}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return out
 
 
-@router.message(OfferFSM.VIEWINGS_FROM)
-async def msg_viewings(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    update_offer(offer_id, viewings_from=(message.text or "").strip())
+class SamplingProfiler:
+    """
+    Знімає стеки всіх потоків через sys._current_frames() кожні PROFILE_INTERVAL
+    і (рідше) ланцюжки await-ів усіх asyncio-задач. Працює в окремому потоці
+    лише між start() і stop(), тож поза профілюванням нічого не коштує.
+    """
 
-    await state.set_state(OfferFSM.PHOTOS)
-    await message.answer("📸 Надішли фото. Коли закінчиш — натисни ✅ Готово або /done.", reply_markup=kb_photos_done())
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = PROFILE_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self.loop_thread = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.tasks: Counter = Counter()
+        self.ticks = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            root = "event-loop" if tid == self.loop_thread else f"thread:{names.get(tid, tid)}"
+            self.stacks[(root, *_frame_stack(frame))] += 1
+        if self.ticks % PROFILE_TASK_EVERY == 0:
+            try:
+                tasks = asyncio.all_tasks(self.loop)
+            except RuntimeError:
+                tasks = set()
+            for t in tasks:
+                stack = _task_stack(t)
+                if stack:
+                    self.tasks[(f"task:{t.get_name()}", *stack)] += 1
+        self.ticks += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        """Формат collapsed stacks (flamegraph.pl, speedscope): 'a;b;c N'."""
+        lines = [";".join(stack) + f" {n}" for stack, n in self.stacks.most_common()]
+        lines += [";".join(stack) + f" {n}" for stack, n in self.tasks.most_common()]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top: int = PROFILE_TOP) -> str:
+        loop_total = sum(n for st, n in self.stacks.items() if st[0] == "event-loop")
+        self_time: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, n in self.stacks.items():
+            if stack[0] != "event-loop" or len(stack) < 2:
+                continue
+            self_time[stack[-1]] += n
+            for fn in set(stack[1:]):
+                inclusive[fn] += n
+        waits: Counter = Counter()
+        for stack, n in self.tasks.items():
+            waits[stack[-1]] += n
+
+        def pct(n: int, total: int) -> str:
+            return f"{n * 100 / total:.1f}%" if total else "0%"
+
+        lines = [f"🔥 <b>Профіль</b>: {self.ticks} знімків, event loop — {loop_total}"]
+        lines.append("\n<b>Event loop, self:</b>")
+        lines += [f"{pct(n, loop_total)} <code>{esc(fn)}</code>" for fn, n in self_time.most_common(top)]
+        # кадри, що є в кожному знімку (run_forever і т.п.), нічого не кажуть
+        inclusive = Counter({fn: n for fn, n in inclusive.items() if n < loop_total})
+        lines.append("\n<b>Event loop, inclusive:</b>")
+        lines += [f"{pct(n, loop_total)} <code>{esc(fn)}</code>" for fn, n in inclusive.most_common(top)]
+        if waits:
+            total = sum(waits.values())
+            lines.append("\n<b>Де чекають asyncio-задачі:</b>")
+            lines += [f"{pct(n, total)} <code>{esc(fn)}</code>" for fn, n in waits.most_common(top // 2)]
+        return "\n".join(lines)
 
 
-# ---------- PHOTOS ----------
-@router.message(OfferFSM.PHOTOS, F.photo)
-async def msg_photo(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
+_profile_lock = asyncio.Lock()
 
-    file_id = message.photo[-1].file_id
-    add_photo(offer_id, file_id)
 
-    offer = get_offer(offer_id)
-    try:
-        photos = json.loads(offer["photos_json"] or "[]")
-    except Exception:
-        photos = []
-    await message.answer(f"📸 Фото додано ({len(photos)}). Натисни ✅ Готово або /done.", reply_markup=kb_photos_done())
+@router.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
 
+    args = (message.text or "").split()
+    if len(args) != 2 or not args[1].isdigit() or not 1 <= int(args[1]) <= PROFILE_MAX_SECONDS:
+        await message.answer(f"Використання: /profile &lt;секунди 1..{PROFILE_MAX_SECONDS}&gt;")
+        return
+    if _profile_lock.locked():
+        await message.answer("⏳ Профілювання вже триває.")
+        return
 
-@router.message(OfferFSM.PHOTOS, Command("done"))
-async def cmd_done_photos(message: types.Message, state: FSMContext):
-    await finish_photos_and_preview(message, state)
+    seconds = int(args[1])
+    async with _profile_lock:
+        await message.answer(f"🔥 Профілюю {seconds} с…")
+        prof = SamplingProfiler(asyncio.get_running_loop())
+        prof.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(prof.stop)
+
+        ensure_dirs()
+        ts = datetime.now(tz=APP_TZ).strftime("%Y-%m-%d_%H-%M-%S")
+        filename = f"profile_{ts}.collapsed.txt"
+        filepath = os.path.join(DATA_DIR, filename)
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write(prof.collapsed())
+        try:
+            await message.answer(prof.summary()[:4000])
+            await message.answer_document(
+                FSInputFile(filepath, filename=filename),
+                caption="Collapsed stacks: flamegraph.pl або https://www.speedscope.app",
+            )
+        finally:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
 
 
-@router.callback_query(OfferFSM.PHOTOS, F.data == "photos_done")
-async def cb_done_photos(call: types.CallbackQuery, state: FSMContext):
-    await finish_photos_and_preview(call.message, state)
-    await call.answer()
+# =========================
+# USERS (ADMIN)
+# =========================
+USER_USAGE = (
+    "❗️Використання: /user &lt;user_id&gt; &lt;admin|broker|off&gt; [@username]\n"
+    "Наприклад: /user 123456789 broker @ivan"
+)
 
 
-@router.message(OfferFSM.PHOTOS)
-async def msg_photos_other(message: types.Message, state: FSMContext):
-    t = (message.text or "").strip().lower()
-    if t in ("готово", "done"):
-        await finish_photos_and_preview(message, state)
+@router.message(Command("user"))
+async def cmd_user(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
         return
-    await message.answer("📸 Надішли фото або натисни ✅ Готово (/done).", reply_markup=kb_photos_done())
 
+    args = (message.text or "").split()[1:]
+    if len(args) < 2 or not args[0].isdigit() or args[1].lower() not in ROLES + ("off",):
+        await message.answer(USER_USAGE)
+        return
 
-async def finish_photos_and_preview(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    offer = get_offer(offer_id)
-    if not offer:
-        await message.answer("❗️Пропозицію не знайдено.")
-        await state.clear()
+    user_id = int(args[0])
+    role = args[1].lower()
+    if role == "off" and user_id == message.from_user.id:
+        await message.answer("❗️Не можна вимкнути самого себе.")
         return
 
-    await state.set_state(OfferFSM.PREVIEW)
+    username = args[2] if len(args) > 2 else None
+    if username and not username.startswith("@"):
+        username = f"@{username}"
 
-    try:
-        photos = json.loads(offer["photos_json"] or "[]")
-    except Exception:
-        photos = []
+    await asyncio.to_thread(set_user_role, user_id, None if role == "off" else role, username)
+    await message.answer(f"✅ <code>{user_id}</code>: {esc(role)}")
 
-    if photos:
-        media = [types.InputMediaPhoto(media=p) for p in photos[:10]]
-        await message.answer_media_group(media=media)
 
-    await message.answer(offer_text(offer), reply_markup=kb_preview_actions())
-    await message.answer("👉 Це фінальний вигляд. Обери дію:", reply_markup=kb_preview_actions())
+@router.message(Command("users"))
+async def cmd_users(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔️ Лише для адміністраторів.")
+        return
 
+    rows = await asyncio.to_thread(list_users)
+    if not rows:
+        await message.answer("Користувачів ще немає — бот відкритий для всіх.")
+        return
+    lines = ["👥 <b>Користувачі</b>"]
+    for r in rows:
+        mark = "" if r["active"] else " (вимкнено)"
+        lines.append(f"<code>{r['user_id']}</code> {esc(r['username'] or '')} — {esc(r['role'])}{mark}")
+    await message.answer("\n".join(lines))
 
-# ---------- PREVIEW ACTIONS ----------
-@router.callback_query(OfferFSM.PREVIEW, F.data == "cancel")
-async def cb_cancel(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data.get("offer_id")
-    offer = get_offer(offer_id) if offer_id else None
 
-    if offer and int(offer["is_published"] or 0) == 0:
-        # якщо скасовано до публікації — прибираємо і offer, і status_events
-        con = db_conn()
-        cur = con.cursor()
-        cur.execute("DELETE FROM status_events WHERE offer_id = ?;", (offer_id,))
-        cur.execute("DELETE FROM offers WHERE id = ?;", (offer_id,))
-        con.commit()
-        con.close()
+# =========================
+# RENT MARKET
+# =========================
+# Ринок = опубліковані ботом + імпортовані пропозиції.
+MARKET_WHERE = "(is_published = 1 OR source = 'import')"
+RENT_MULTIPLIERS = {"k": 1000, "к": 1000, "тис": 1000}
 
-    await state.clear()
-    await call.message.answer("❌ Скасовано.")
-    await call.answer()
 
+def parse_rent(text: Optional[str]) -> Optional[float]:
+    """'1 200€ + енергії' -> 1200.0, '650,50' -> 650.5, '1.2k' -> 1200.0; без числа — None."""
+    m = re.search(
+        r"(\d{1,3}(?:[ \u00a0'.,]\d{3})+|\d+)(?:[.,](\d{1,2}))?(?!\d)\s*(k|к|тис)?",
+        (text or "").lower(),
+    )
+    if not m:
+        return None
+    value = float(re.sub(r"\D", "", m.group(1)) + "." + (m.group(2) or "0"))
+    value *= RENT_MULTIPLIERS.get(m.group(3) or "", 1)
+    return value if 0 < value < 10_000_000 else None
 
-@router.callback_query(OfferFSM.PREVIEW, F.data == "edit")
-async def cb_edit(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    offer = get_offer(offer_id)
-    if not offer:
-        await call.message.answer("❗️Пропозицію не знайдено.")
-        await state.clear()
-        await call.answer()
-        return
 
-    await state.set_state(OfferFSM.EDIT_CHOOSE)
-    await call.message.answer(edit_list_text(int(offer["seq"])))
-    await call.answer()
+class RentSketch:
+    """
+    KLL-скетч квантилів: рівні-компактори, елемент рівня h важить 2**h.
+    Коли рівень переповнюється, він сортується і в наступний іде кожен другий
+    (з випадковим зсувом). Розмір ~O(k), скетчі різних груп зливаються merge().
+    """
 
+    C = 2 / 3
+
+    def __init__(self, k: int = RENT_SKETCH_K):
+        self.k = k
+        self.n = 0
+        self.levels: List[List[float]] = [[]]
+
+    def _capacity(self, h: int) -> int:
+        depth = len(self.levels) - h - 1
+        return max(2, int(math.ceil(self.k * self.C ** depth)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                items = sorted(self.levels[h])
+                keep = [items.pop()] if len(items) % 2 else []
+                self.levels[h + 1].extend(items[random.randint(0, 1)::2])
+                self.levels[h] = keep
+            h += 1
+
+    def update(self, x: float):
+        self.levels[0].append(x)
+        self.n += 1
+        if len(self.levels[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other: "RentSketch"):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, items in enumerate(other.levels):
+            self.levels[h].extend(items)
+        self.n += other.n
+        self._compress()
+
+    def _weighted(self) -> List[Tuple[float, int]]:
+        return sorted((x, 1 << h) for h, items in enumerate(self.levels) for x in items)
+
+    def quantile(self, q: float) -> Optional[float]:
+        items = self._weighted()
+        if not items:
+            return None
+        target = q * sum(w for _, w in items)
+        acc = 0
+        for x, w in items:
+            acc += w
+            if acc >= target:
+                return x
+        return items[-1][0]
+
+    def rank(self, x: float) -> float:
+        """Частка значень, менших за x (0..1)."""
+        items = self._weighted()
+        total = sum(w for _, w in items)
+        if not total:
+            return 0.0
+        return sum(w for v, w in items if v < x) / total
+
+    def to_json(self) -> str:
+        return json.dumps({"k": self.k, "n": self.n, "levels": [[round(x, 2) for x in lv] for lv in self.levels]})
+
+    @classmethod
+    def from_json(cls, raw: str) -> "RentSketch":
+        d = json.loads(raw)
+        sk = cls(int(d.get("k") or RENT_SKETCH_K))
+        sk.n = int(d.get("n") or 0)
+        sk.levels = d.get("levels") or [[]]
+        return sk
+
+
+def sketch_key(offer) -> Tuple[str, str, str, str]:
+    return (
+        norm_text(offer["city"]),
+        norm_text(offer["district"]),
+        norm_text(offer["housing_type"]),
+        norm_text(offer["category"]),
+    )
 
-@router.callback_query(OfferFSM.PREVIEW, F.data == "pub")
-async def cb_publish(call: types.CallbackQuery, state: FSMContext):
-    if not GROUP_CHAT_ID_RAW:
-        await call.message.answer("❗️Не задано GROUP_CHAT_ID / GROUP_ID в Railway (Variables).")
-        await call.answer()
-        return
 
-    try:
-        group_id = int(GROUP_CHAT_ID_RAW)
-    except Exception:
-        await call.message.answer("❗️GROUP_CHAT_ID має бути числом (наприклад -1001234567890).")
-        await call.answer()
-        return
+def _sketch_rents(cur: sqlite3.Cursor, where: str, params: tuple) -> int:
+    """Додає в скетчі ще не враховані ринкові пропозиції (в поточній транзакції). Повертає кількість."""
+    cur.execute(
+        f"""
+        SELECT id, city, district, housing_type, category, rent FROM offers
+        WHERE {where} AND rent_sketched = 0 AND {MARKET_WHERE};
+        """,
+        params,
+    )
+    groups: Dict[Tuple[str, str, str, str], List[float]] = {}
+    ids = []
+    for r in cur.fetchall():
+        ids.append((r["id"],))
+        value = parse_rent(r["rent"])
+        if value is not None and norm_text(r["city"]):
+            groups.setdefault(sketch_key(r), []).append(value)
+    for key, values in groups.items():
+        cur.execute(
+            "SELECT sketch FROM rent_sketches WHERE city = ? AND district = ? AND housing_type = ? AND category = ?;",
+            key,
+        )
+        row = cur.fetchone()
+        sk = RentSketch.from_json(row["sketch"]) if row else RentSketch()
+        for v in values:
+            sk.update(v)
+        cur.execute(
+            """
+            INSERT INTO rent_sketches (city, district, housing_type, category, n, sketch) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(city, district, housing_type, category) DO UPDATE SET n = excluded.n, sketch = excluded.sketch;
+            """,
+            (*key, sk.n, sk.to_json()),
+        )
+    cur.executemany("UPDATE offers SET rent_sketched = 1 WHERE id = ?;", ids)
+    return len(ids)
 
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    offer = get_offer(offer_id)
-    if not offer:
-        await call.message.answer("❗️Пропозицію не знайдено.")
-        await state.clear()
-        await call.answer()
-        return
 
-    if int(offer["is_published"] or 0) == 1:
-        await call.message.answer("ℹ️ Уже опубліковано.")
-        await call.answer()
+def sketch_offer_rents(offer_ids: List[int]):
+    if not offer_ids:
         return
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        _sketch_rents(con.cursor(), f"id IN ({','.join('?' * len(offer_ids))})", tuple(offer_ids))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
 
+
+def rebuild_rent_sketches() -> int:
+    """Перераховує всі скетчі з нуля: так підхоплюються правки rent і видалені пропозиції."""
+    con = db_conn()
     try:
-        photos = json.loads(offer["photos_json"] or "[]")
+        con.execute("BEGIN IMMEDIATE;")
+        cur = con.cursor()
+        cur.execute("DELETE FROM rent_sketches;")
+        cur.execute("UPDATE offers SET rent_sketched = 0 WHERE rent_sketched = 1;")
+        n = _sketch_rents(cur, "1 = 1", ())
+        con.commit()
+        return n
     except Exception:
-        photos = []
+        con.rollback()
+        raise
+    finally:
+        con.close()
 
-    if photos:
-        media = [types.InputMediaPhoto(media=p) for p in photos[:10]]
-        await call.bot.send_media_group(chat_id=group_id, media=media)
 
-    msg = await call.bot.send_message(
-        chat_id=group_id,
-        text=offer_text(offer),
-        reply_markup=kb_status_buttons(offer_id),
+async def rent_sketch_job(bot: Bot, slot: datetime):
+    n = await asyncio.to_thread(rebuild_rent_sketches)
+    log.info("rent sketches rebuilt from %s offers", n)
+
+
+def load_market(
+    city: str, district: Optional[str] = None, housing_type: Optional[str] = None, category: Optional[str] = None
+) -> Optional[RentSketch]:
+    """Злитий скетч усіх груп, що підходять (None-поля = будь-які)."""
+    conds, params = ["city = ?"], [norm_text(city)]
+    for col, val in (("district", district), ("housing_type", housing_type), ("category", category)):
+        if val is not None:
+            conds.append(f"{col} = ?")
+            params.append(norm_text(val))
+    con = db_conn()
+    rows = con.execute(f"SELECT sketch FROM rent_sketches WHERE {' AND '.join(conds)};", params).fetchall()
+    con.close()
+    if not rows:
+        return None
+    sk = RentSketch()
+    for r in rows:
+        sk.merge(RentSketch.from_json(r["sketch"]))
+    return sk
+
+
+def fmt_money(x: float) -> str:
+    return f"{x:,.0f}".replace(",", " ") + "€"
+
+
+def market_line(sk: RentSketch) -> str:
+    return (
+        f"медіана <b>{fmt_money(sk.quantile(0.5))}</b> "
+        f"(p25 {fmt_money(sk.quantile(0.25))}, p75 {fmt_money(sk.quantile(0.75))}, n={sk.n})"
     )
 
-    update_offer(
-        offer_id,
-        is_published=1,
-        published_chat_id=group_id,
-        published_message_id=msg.message_id,
+
+def market_position_text(offer: sqlite3.Row) -> Optional[str]:
+    """Де rent нової пропозиції відносно ринку: район → місто з тим самим типом → місто."""
+    value = parse_rent(offer["rent"])
+    if value is None or not norm_text(offer["city"]):
+        return None
+    city, district, housing_type = ((offer[k] or "").strip() for k in ("city", "district", "housing_type"))
+    levels = (
+        (district, housing_type, f"{city} · {district}, {housing_type}"),
+        (None, housing_type, f"{city}, {housing_type}"),
+        (None, None, city),
     )
+    for district, housing_type, title in levels:
+        if district is not None and not norm_text(district):
+            continue
+        sk = load_market(offer["city"], district, housing_type, offer["category"])
+        if sk and sk.n >= RENT_MIN_SAMPLES:
+            pct = round(sk.rank(value) * 100)
+            return (
+                f"💹 Ринок ({esc(title)}): {market_line(sk)}\n"
+                f"Ця пропозиція {fmt_money(value)} — дорожча за {pct}% схожих."
+            )
+    return None
+
+
+def prices_overview(category: str, limit: int = 15) -> List[Tuple[str, RentSketch]]:
+    """Міста за кількістю пропозицій у скетчах (злиття всіх районів і типів)."""
+    con = db_conn()
+    rows = con.execute("SELECT city, sketch FROM rent_sketches WHERE category = ?;", (norm_text(category),)).fetchall()
+    con.close()
+    by_city: Dict[str, RentSketch] = {}
+    for r in rows:
+        by_city.setdefault(r["city"], RentSketch()).merge(RentSketch.from_json(r["sketch"]))
+    return sorted(by_city.items(), key=lambda kv: -kv[1].n)[:limit]
 
-    await call.message.answer(f"✅ Пропозицію #{int(offer['seq']):04d} опубліковано в групу.")
-    await state.clear()
-    await call.answer()
 
+PRICES_USAGE = (
+    "Використання: /prices [місто[, район[, тип житла[, категорія]]]]\n"
+    "Наприклад: /prices Bratislava, Petržalka, 2-кімн.\n"
+    "Район «*» — будь-який."
+)
 
-# ---------- EDIT FLOW ----------
-@router.message(OfferFSM.EDIT_CHOOSE)
-async def msg_edit_choose(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    offer = get_offer(offer_id)
-    if not offer:
-        await message.answer("❗️Пропозицію не знайдено.")
-        await state.clear()
-        return
 
-    text = (message.text or "").strip()
-    if not text.isdigit():
-        await message.answer("Напиши номер пункту 1–13 (наприклад 2).")
+@router.message(Command("prices"))
+async def cmd_prices(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
         return
 
-    num = int(text)
-    field_map = {n: (name, key) for n, name, key in EDIT_FIELDS}
-    if num not in field_map:
-        await message.answer("Невірний номер. Напиши 1–13.")
+    args = (message.text or "").split(maxsplit=1)
+    parts = [p.strip() for p in args[1].split(",")] if len(args) == 2 else []
+    if len(parts) > 4 or any(not p for p in parts):
+        await message.answer(PRICES_USAGE)
         return
 
-    name, key = field_map[num]
-    await state.update_data({"edit_field_key": key, "edit_field_name": name})
-
-    if key == "category":
-        await state.set_state(OfferFSM.CATEGORY)
-        await message.answer("Обери категорію:", reply_markup=kb_category())
+    if not parts:
+        rows = await asyncio.to_thread(prices_overview, "Оренда")
+        if not rows:
+            await message.answer("ℹ️ Ще немає даних про ціни.")
+            return
+        lines = ["💹 <b>Оренда по містах</b>"]
+        lines += [f"• {esc(city)}: {market_line(sk)}" for city, sk in rows]
+        lines.append("\n" + PRICES_USAGE)
+        await message.answer("\n".join(lines))
         return
 
-    if key == "housing_type":
-        await state.set_state(OfferFSM.HOUSING_TYPE)
-        await message.answer("Обери тип житла:", reply_markup=kb_housing_type())
+    city, district, housing_type, category = (parts + [None] * 4)[:4]
+    if district == "*":
+        district = None
+    sk = await asyncio.to_thread(load_market, city, district, housing_type, category or "Оренда")
+    title = ", ".join(p for p in (city, district, housing_type, category or "Оренда") if p)
+    if not sk or not sk.n:
+        await message.answer(f"ℹ️ Немає даних для: {esc(title)}")
         return
+    await message.answer(f"💹 <b>{esc(title)}</b>\n{market_line(sk)}")
 
-    if key == "parking":
-        await state.set_state(OfferFSM.PARKING)
-        await message.answer("🚗 Паркінг: обери кнопкою або напиши текстом.", reply_markup=kb_parking())
-        return
 
-    await state.set_state(OfferFSM.EDIT_VALUE)
-    await message.answer(f"✏️ Впиши нове значення для <b>{esc(name)}</b>:")
+# =========================
+# INLINE SEARCH
+# =========================
+class TTLCache:
+    """Маленький LRU з TTL: ключ -> значення, найстаріші витісняються при переповненні."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+_inline_latest: Dict[int, str] = {}
+
+
+def fts_query(text: str) -> str:
+    """'2-кімн Petržalka' -> '"2"* "кімн"* "petržalka"*' (усі слова, по префіксу)."""
+    tokens = re.findall(r"\w+", (text or "").lower())
+    return " ".join(f'"{t}"*' for t in tokens[:8])
+
+
+def search_offer_ids(text: str, limit: int = INLINE_MAX_RESULTS) -> List[int]:
+    """Пошук по offers_fts (або останні пропозиції для порожнього запиту)."""
+    marks = ",".join("?" * len(INLINE_STATUSES))
+    q = fts_query(text)
+    con = db_conn()
+    cur = con.cursor()
+    if q:
+        cur.execute(
+            f"""
+            SELECT o.id FROM offers_fts f
+            JOIN offers o ON o.id = f.rowid
+            WHERE offers_fts MATCH ? AND o.is_published = 1 AND o.current_status IN ({marks})
+            ORDER BY f.rank, o.seq DESC
+            LIMIT ?;
+            """,
+            (q, *INLINE_STATUSES, limit),
+        )
+    else:
+        cur.execute(
+            f"""
+            SELECT id FROM offers
+            WHERE is_published = 1 AND current_status IN ({marks})
+            ORDER BY seq DESC
+            LIMIT ?;
+            """,
+            (*INLINE_STATUSES, limit),
+        )
+    ids = [int(r["id"]) for r in cur.fetchall()]
+    con.close()
+    return ids
 
 
-@router.message(OfferFSM.EDIT_VALUE)
-async def msg_edit_value(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    offer_id = data["offer_id"]
-    key = data.get("edit_field_key")
+def get_offers(offer_ids: List[int]) -> List[sqlite3.Row]:
+    """Рядки offers у порядку offer_ids."""
+    if not offer_ids:
+        return []
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute(f"SELECT * FROM offers WHERE id IN ({','.join('?' * len(offer_ids))});", offer_ids)
+    by_id = {int(r["id"]): r for r in cur.fetchall()}
+    con.close()
+    return [by_id[i] for i in offer_ids if i in by_id]
 
-    offer = get_offer(offer_id)
-    if not offer or not key:
-        await message.answer("❗️Немає даних для редагування.")
-        await state.clear()
+
+def first_photo(offer: sqlite3.Row) -> Optional[str]:
+    try:
+        photos = json.loads(offer["photos_json"] or "[]")
+    except Exception:
+        photos = []
+    return photos[0] if photos else None
+
+
+def inline_result(offer: sqlite3.Row):
+    text = offer_text(offer)
+    title = f"#{int(offer['seq']):04d} {offer['housing_type'] or ''} — {offer['city'] or ''}".strip()
+    description = " · ".join(x for x in (offer["street"], offer["district"], offer["rent"]) if x)
+    photo = first_photo(offer)
+    if photo and len(text) <= 1024:  # ліміт підпису до фото
+        return types.InlineQueryResultCachedPhoto(
+            id=f"o{offer['id']}",
+            photo_file_id=photo,
+            title=title,
+            description=description,
+            caption=text,
+        )
+    return types.InlineQueryResultArticle(
+        id=f"o{offer['id']}",
+        title=title,
+        description=description,
+        input_message_content=types.InputTextMessageContent(message_text=text),
+    )
+
+
+@router.inline_query()
+async def inline_search(query: types.InlineQuery):
+    if not is_allowed(query.from_user.id):
+        await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
         return
 
-    val = (message.text or "").strip()
+    # дебаунс: поки користувач друкує, відповідаємо лише на останній запит
+    _inline_latest[query.from_user.id] = query.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if _inline_latest.get(query.from_user.id) != query.id:
+        return
+    _inline_latest.pop(query.from_user.id, None)
+
+    text = " ".join((query.query or "").split()).lower()
+    ids = inline_cache.get(text)
+    if ids is None:
+        ids = await asyncio.to_thread(search_offer_ids, text)
+        inline_cache.put(text, ids)
+
+    offset = int(query.offset) if (query.offset or "").isdigit() else 0
+    page_ids = ids[offset:offset + INLINE_PAGE]
+    rows = await asyncio.to_thread(get_offers, page_ids)
+    next_offset = str(offset + INLINE_PAGE) if offset + INLINE_PAGE < len(ids) else ""
+
+    await query.answer(
+        [inline_result(r) for r in rows],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=next_offset,
+    )
 
-    if key == "broker_username":
-        if val and not val.startswith("@"):
-            val = f"@{val}"
 
-    update_offer(offer_id, **{key: val})
+# =========================
+# PUBLISH TARGETS
+# =========================
+def parse_publish_targets(raw: str) -> List[Tuple[int, Dict[str, set]]]:
+    """'-1001; -1002 city=Bratislava|Trnava' -> [(-1001, {}), (-1002, {'city': {'bratislava', 'trnava'}})]."""
+    out = []
+    for item in raw.split(";"):
+        parts = item.split()
+        if not parts:
+            continue
+        try:
+            chat_id = int(parts[0])
+        except ValueError:
+            log.warning("PUBLISH_TARGETS: bad chat id %r", parts[0])
+            continue
+        filters: Dict[str, set] = {}
+        for cond in parts[1:]:
+            key, _, vals = cond.partition("=")
+            key = key.strip().lower()
+            if key not in PUBLISH_TARGET_KEYS or not vals:
+                log.warning("PUBLISH_TARGETS: bad filter %r", cond)
+                continue
+            filters.setdefault(key, set()).update(norm_text(v) for v in vals.split("|") if v.strip())
+        out.append((chat_id, filters))
+    return out
 
-    offer2 = get_offer(offer_id)
-    await state.set_state(OfferFSM.PREVIEW)
 
-    await message.answer("✅ Оновлено. Ось новий вигляд:")
-    await message.answer(offer_text(offer2), reply_markup=kb_preview_actions())
+PUBLISH_TARGETS = parse_publish_targets(PUBLISH_TARGETS_RAW)
 
 
-# ---------- STATUS BUTTONS (GROUP) ----------
-@router.callback_query(F.data.startswith("st:"))
-async def cb_status(call: types.CallbackQuery):
-    parts = call.data.split(":")
-    if len(parts) != 3:
-        await call.answer("Помилка", show_alert=False)
-        return
+def publish_targets_for(offer: sqlite3.Row) -> List[int]:
+    if not PUBLISH_TARGETS:
+        chat_id = group_chat_id()
+        return [chat_id] if chat_id is not None else []
+    out = []
+    for chat_id, filters in PUBLISH_TARGETS:
+        if all(norm_text(offer[key]) in vals for key, vals in filters.items()) and chat_id not in out:
+            out.append(chat_id)
+    return out
 
-    offer_id = int(parts[1])
-    status = parts[2]
 
-    if status not in STATUS:
-        await call.answer("Невірний статус", show_alert=False)
-        return
+def record_publication(offer_id: int, chat_id: int, message_id: int, album_ids: List[int]):
+    con = db_conn()
+    con.execute(
+        """
+        INSERT INTO publications (offer_id, chat_id, message_id, album_message_ids) VALUES (?, ?, ?, ?)
+        ON CONFLICT(offer_id, chat_id) DO UPDATE SET
+            message_id = excluded.message_id, album_message_ids = excluded.album_message_ids;
+        """,
+        (offer_id, chat_id, message_id, json.dumps(album_ids)),
+    )
+    con.executemany(
+        "INSERT OR REPLACE INTO publication_messages (chat_id, message_id, offer_id) VALUES (?, ?, ?);",
+        [(chat_id, mid, offer_id) for mid in [message_id, *album_ids]],
+    )
+    con.commit()
+    con.close()
+
+
+def get_publications(offer_ids: List[int]) -> List[sqlite3.Row]:
+    if not offer_ids:
+        return []
+    con = db_conn()
+    cur = con.cursor()
+    cur.execute(
+        f"SELECT * FROM publications WHERE offer_id IN ({','.join('?' * len(offer_ids))});",
+        offer_ids,
+    )
+    rows = cur.fetchall()
+    con.close()
+    return rows
+
 
-    if not is_allowed(call.from_user.id):
-        await call.answer("⛔️ Нема доступу", show_alert=True)
-        return
+async def _with_retry(make_call):
+    """Один повтор після RetryAfter — для паралельних відправок поза send_queue."""
+    try:
+        return await make_call()
+    except TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        return await make_call()
 
-    offer = get_offer(offer_id)
-    if not offer:
-        await call.answer("Пропозицію не знайдено", show_alert=False)
-        return
 
-    username = call.from_user.username or str(call.from_user.id)
-    if username and not username.startswith("@"):
-        username = f"@{username}"
+async def publish_to(bot: Bot, chat_id: int, offer: sqlite3.Row, photos: List[str]) -> Tuple[int, List[int]]:
+    album_ids: List[int] = []
+    if photos:
+        media = [types.InputMediaPhoto(media=p) for p in photos[:10]]
+        album = await _with_retry(lambda: bot.send_media_group(chat_id=chat_id, media=media))
+        album_ids = [m.message_id for m in album]
+
+    msg = await _with_retry(
+        lambda: bot.send_message(
+            chat_id=chat_id,
+            text=offer_text(offer),
+            reply_markup=kb_status_buttons(int(offer["id"]), int(offer["version"] or 0)),
+        )
+    )
+    await asyncio.to_thread(record_publication, int(offer["id"]), chat_id, msg.message_id, album_ids)
+    return msg.message_id, album_ids
 
-    set_status(offer_id, status, username=username, user_id=call.from_user.id)
 
-    offer2 = get_offer(offer_id)
+async def publish_everywhere(bot: Bot, offer: sqlite3.Row, targets: List[int]) -> List[Tuple[int, Any]]:
+    """Паралельно (не більше PUBLISH_CONCURRENCY) у всі цілі; [(chat_id, результат або Exception)]."""
     try:
-        await call.bot.edit_message_text(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=offer_text(offer2),
-            reply_markup=kb_status_buttons(offer_id),
-        )
+        photos = json.loads(offer["photos_json"] or "[]")
     except Exception:
-        pass
+        photos = []
+    sem = asyncio.Semaphore(PUBLISH_CONCURRENCY)
+
+    async def one(chat_id: int):
+        async with sem:
+            return await publish_to(bot, chat_id, offer, photos)
+
+    results = await asyncio.gather(*(one(c) for c in targets), return_exceptions=True)
+    for chat_id, r in zip(targets, results):
+        if isinstance(r, Exception):
+            log.warning("publish offer %s to %s failed: %s", offer["id"], chat_id, r)
+    return list(zip(targets, results))
+
 
-    await call.answer("✅ Оновлено", show_alert=False)
+async def refresh_all_copies(bot: Bot, offer_id: int, skip: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+    """
+    Перемальовує всі копії пропозиції (крім skip) через send_queue — з тим самим
+    темпом по чатах, що й /bulk. Повертає (ok, failed).
+    """
+    pubs = [
+        p for p in await asyncio.to_thread(get_publications, [offer_id])
+        if (int(p["chat_id"]), int(p["message_id"])) != skip
+    ]
+    if not pubs:
+        return 0, 0
+    futures = [
+        send_queue.submit(
+            int(p["chat_id"]),
+            lambda p=p: refresh_offer_message(bot, offer_id, int(p["chat_id"]), int(p["message_id"])),
+        )
+        for p in pubs
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = 0
+    for p, r in zip(pubs, results):
+        if isinstance(r, Exception):
+            failed += 1
+            log.warning("refresh offer %s in %s failed: %s", offer_id, p["chat_id"], r)
+    return len(pubs) - failed, failed
 
 
 # =========================
-# STATS
+# GROUP REPLY COMMANDS
 # =========================
-def _period_bounds(period: str) -> Tuple[datetime, datetime]:
-    now = datetime.now(tz=APP_TZ)
-    if period == "day":
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1)
-        return start, end
-    if period == "month":
-        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        if start.month == 12:
-            end = start.replace(year=start.year + 1, month=1)
-        else:
-            end = start.replace(month=start.month + 1)
-        return start, end
-    if period == "year":
-        start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-        end = start.replace(year=start.year + 1)
-        return start, end
-    raise ValueError("Unknown period")
+# Відповіддю на пропозицію (текст або будь-яке фото альбому) у групі:
+# /active /reserve /removed /closed, /rent <сума>, /history
+REPLY_STATUS_COMMANDS = ("active", "reserve", "removed", "closed")
+REPLY_COMMANDS = (*REPLY_STATUS_COMMANDS, "rent", "history")
+HISTORY_LIMIT = 15
 
 
-def stats_for_period(period: str) -> Dict[str, Any]:
-    start, end = _period_bounds(period)
-    start_iso = start.isoformat(timespec="seconds")
-    end_iso = end.isoformat(timespec="seconds")
-
+def offer_by_message(chat_id: int, message_id: int) -> Optional[int]:
+    """Пошук по первинному ключу (chat_id, message_id) — B-дерево, без сканування."""
     con = db_conn()
-    cur = con.cursor()
+    row = con.execute(
+        "SELECT offer_id FROM publication_messages WHERE chat_id = ? AND message_id = ?;",
+        (chat_id, message_id),
+    ).fetchone()
+    con.close()
+    return int(row["offer_id"]) if row else None
 
-    cur.execute(
-        """
-        SELECT status, COUNT(*) as cnt
-        FROM status_events
-        WHERE at >= ? AND at < ?
-        GROUP BY status;
-        """,
-        (start_iso, end_iso),
-    )
-    rows = cur.fetchall()
-    total = {k: 0 for k in STATUS_ORDER}
-    for r in rows:
-        st = r["status"]
-        if st in total:
-            total[st] = int(r["cnt"])
 
-    cur.execute(
-        """
-        SELECT username, status, COUNT(*) as cnt
-        FROM status_events
-        WHERE at >= ? AND at < ?
-        GROUP BY username, status
-        ORDER BY username ASC;
-        """,
-        (start_iso, end_iso),
-    )
-    rows2 = cur.fetchall()
-    per_broker: Dict[str, Dict[str, int]] = {}
-    for r in rows2:
-        u = r["username"] or "—"
-        st = r["status"]
-        if st not in STATUS:
-            continue
-        per_broker.setdefault(u, {k: 0 for k in STATUS_ORDER})
-        per_broker[u][st] = int(r["cnt"])
+def offer_history(offer_id: int, limit: int = HISTORY_LIMIT) -> List[sqlite3.Row]:
+    """Останні події пропозиції: гаряча БД, а якщо мало — архівні файли від новіших до старіших."""
+    query = """
+        SELECT at, status, username FROM status_events
+        WHERE offer_id = ? ORDER BY at_ts DESC, id DESC LIMIT ?;
+    """
+    con = db_conn()
+    try:
+        rows = con.execute(query, (offer_id, limit)).fetchall()
+        created = con.execute("SELECT created_ts FROM offers WHERE id = ?;", (offer_id,)).fetchone()
+    finally:
+        con.close()
+    if len(rows) >= limit or not created:
+        return rows
 
-    con.close()
+    since = datetime.fromtimestamp(created["created_ts"] or 0, tz=APP_TZ)
+    for path in reversed(archive_files(since)):
+        acon = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+        acon.row_factory = sqlite3.Row
+        try:
+            rows += acon.execute(query, (offer_id, limit - len(rows))).fetchall()
+        finally:
+            acon.close()
+        if len(rows) >= limit:
+            break
+    return rows
 
-    label = {
-        "day": start.strftime("%Y-%m-%d"),
-        "month": start.strftime("%Y-%m"),
-        "year": start.strftime("%Y"),
-    }[period]
 
-    return {"label": label, "total": total, "per_broker": per_broker}
+def format_history(offer: Any, rows: List[sqlite3.Row]) -> str:
+    lines = [f"🕓 <b>Історія #{int(offer['seq']):04d}</b>"]
+    for r in rows:
+        lines.append(f"{esc((r['at'] or '')[:16].replace('T', ' '))} — {STATUS.get(r['status'], '❔')} {esc(r['username'] or '')}")
+    if len(rows) == HISTORY_LIMIT:
+        lines.append(f"(останні {HISTORY_LIMIT})")
+    return "\n".join(lines)
 
 
-def format_stats() -> str:
-    day = stats_for_period("day")
-    month = stats_for_period("month")
-    year = stats_for_period("year")
+@router.message(Command(*REPLY_COMMANDS), F.reply_to_message)
+async def cmd_reply_offer(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        return
 
-    def block(title: str, d: Dict[str, Any]) -> str:
-        t = d["total"]
-        return (
-            f"<b>{title} ({d['label']})</b>\n"
-            f"{STATUS['unknown']}: {t['unknown']}\n"
-            f"{STATUS['active']}: {t['active']}\n"
-            f"{STATUS['reserve']}: {t['reserve']}\n"
-            f"{STATUS['removed']}: {t['removed']}\n"
-            f"{STATUS['closed']}: {t['closed']}\n"
-        )
+    offer_id = await asyncio.to_thread(offer_by_message, message.chat.id, message.reply_to_message.message_id)
+    if offer_id is None:
+        await message.reply("ℹ️ Відповідай командою на повідомлення з пропозицією.")
+        return
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        await message.reply("❗️Пропозицію не знайдено.")
+        return
 
-    def broker_block(title: str, d: Dict[str, Any]) -> str:
-        lines = [f"🧑‍💼 <b>{title} — по маклерах ({d['label']})</b>"]
-        if not d["per_broker"]:
-            lines.append("— немає змін статусів")
-            return "\n".join(lines)
+    parts = (message.text or "").split(maxsplit=1)
+    cmd = parts[0].lstrip("/").split("@", 1)[0].lower()
+    arg = parts[1].strip() if len(parts) == 2 else ""
 
-        for broker, counts in d["per_broker"].items():
-            lines.append(f"\n<b>{esc(broker)}</b>")
-            lines.append(f"  {STATUS['unknown']}: {counts['unknown']}")
-            lines.append(f"  {STATUS['active']}: {counts['active']}")
-            lines.append(f"  {STATUS['reserve']}: {counts['reserve']}")
-            lines.append(f"  {STATUS['removed']}: {counts['removed']}")
-            lines.append(f"  {STATUS['closed']}: {counts['closed']}")
-        return "\n".join(lines)
+    if cmd == "history":
+        rows = await asyncio.to_thread(offer_history, offer_id)
+        await message.reply(format_history(offer, rows))
+        return
 
-    parts = [
-        "📊 <b>Статистика (зміни статусів)</b>\n",
-        block("День", day),
-        block("Місяць", month),
-        block("Рік", year),
-        "",
-        broker_block("День", day),
-        "",
-        broker_block("Місяць", month),
-        "",
-        broker_block("Рік", year),
-    ]
-    return "\n".join(parts)
+    username = message.from_user.username or str(message.from_user.id)
+    if username and not username.startswith("@"):
+        username = f"@{username}"
 
+    if cmd == "rent":
+        if not arg:
+            await message.reply("Використання: відповідь на пропозицію <code>/rent 400€</code>")
+            return
+        async with offer_lock(offer_id):
+            await storage.update_offer(offer_id, rent=arg, rent_sketched=0)
+        # нове значення — у скетч одразу; старе з нього прибере найближчий rebuild_rent_sketches
+        await asyncio.to_thread(sketch_offer_rents, [offer_id])
+        await message.reply(f"✅ #{int(offer['seq']):04d}: оренда {esc(arg)}")
+        spawn(refresh_all_copies(message.bot, offer_id))
+        return
 
-@router.message(Command("stats"))
-async def cmd_stats(message: types.Message):
-    if not is_allowed(message.from_user.id):
-        await message.answer("⛔️ Доступ заборонено.")
+    committed = await storage.set_status(offer_id, cmd, username=username, user_id=message.from_user.id)
+    if committed is None:
+        # без expected_version None означає лише, що пропозиції вже немає
+        await message.reply("❗️Пропозицію не знайдено.")
         return
-    await message.answer(format_stats())
+    await message.reply(f"✅ #{int(offer['seq']):04d}: {STATUS[cmd]}")
+    spawn(refresh_all_copies(message.bot, offer_id))
 
 
 # =========================
-# EXPORT (EXCEL)
+# SUBSCRIPTIONS
 # =========================
-def export_to_excel(filepath: str, period: str = "all") -> None:
-    if Workbook is None:
-        raise RuntimeError("openpyxl не встановлений")
+SUB_USAGE = (
+    "❗️Використання: /subscribe city=Братислава category=Оренда type=2-кімн. rent=800 parking\n"
+    "Будь-яку умову можна пропустити; значення з пробілами — в лапках: city=\"Нове Место\"."
+)
+SUB_KEYS = {"city": "city", "category": "category", "type": "housing_type", "rent": "rent_max"}
+PARKING_NONE = {"", "немає", "нема", "ні", "no", "none"}
 
-    start_iso = None
-    end_iso = None
-    if period in ("day", "month", "year"):
-        start_dt, end_dt = _period_bounds(period)
-        start_iso = start_dt.isoformat(timespec="seconds")
-        end_iso = end_dt.isoformat(timespec="seconds")
 
-    con = db_conn()
-    cur = con.cursor()
+def parse_subscription(args: str) -> Dict[str, Any]:
+    """'city=Trnava rent=800 parking' -> {'city': 'trnava', 'rent_max': 800.0, 'parking': 1}. ValueError на сміття."""
+    try:
+        tokens = shlex.split(args)
+    except ValueError as e:
+        raise ValueError(str(e))
+    sub: Dict[str, Any] = {"city": "", "category": "", "housing_type": "", "rent_max": None, "parking": 0}
+    for tok in tokens:
+        key, sep, val = tok.partition("=")
+        key = key.strip().lower()
+        if not sep and key in ("parking", "паркінг"):
+            sub["parking"] = 1
+            continue
+        if key not in SUB_KEYS or not val.strip():
+            raise ValueError(tok)
+        if key == "rent":
+            rent = parse_rent(val)
+            if rent is None:
+                raise ValueError(tok)
+            sub["rent_max"] = rent
+        else:
+            sub[SUB_KEYS[key]] = norm_text(val)
+    if not any(sub.values()):
+        raise ValueError("empty")
+    return sub
 
-    if start_iso and end_iso:
-        cur.execute(
-            "SELECT * FROM offers WHERE created_at >= ? AND created_at < ? ORDER BY seq ASC;",
-            (start_iso, end_iso),
-        )
-    else:
-        cur.execute("SELECT * FROM offers ORDER BY seq ASC;")
-    offers = cur.fetchall()
 
-    if start_iso and end_iso:
-        cur.execute(
+def has_parking(value: Optional[str]) -> bool:
+    return norm_text(value) not in PARKING_NONE
+
+
+def add_subscription(user_id: int, sub: Dict[str, Any], query: str) -> Optional[int]:
+    """None — у користувача вже SUB_MAX_PER_USER підписок."""
+    con = db_conn()
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        n = con.execute("SELECT COUNT(*) FROM subscriptions WHERE user_id = ?;", (user_id,)).fetchone()[0]
+        if n >= SUB_MAX_PER_USER:
+            con.rollback()
+            return None
+        cur = con.execute(
             """
-            SELECT se.*, o.seq AS offer_seq
-            FROM status_events se
-            LEFT JOIN offers o ON o.id = se.offer_id
-            WHERE se.at >= ? AND se.at < ?
-            ORDER BY se.at ASC;
+            INSERT INTO subscriptions (user_id, city, category, housing_type, rent_max, parking, query, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
             """,
-            (start_iso, end_iso),
-        )
-    else:
-        cur.execute(
-            """
-            SELECT se.*, o.seq AS offer_seq
-            FROM status_events se
-            LEFT JOIN offers o ON o.id = se.offer_id
-            ORDER BY se.at ASC;
-            """
+            (user_id, sub["city"], sub["category"], sub["housing_type"], sub["rent_max"], sub["parking"],
+             query, now_iso()),
         )
-    events = cur.fetchall()
+        con.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'subscriptions_version';")
+        con.commit()
+        return int(cur.lastrowid)
+    finally:
+        con.close()
+
+
+def delete_subscription(user_id: int, sub_id: Optional[int] = None) -> int:
+    """sub_id=None — усі підписки користувача. Повертає кількість видалених."""
+    con = db_conn()
+    try:
+        if sub_id is None:
+            cur = con.execute("DELETE FROM subscriptions WHERE user_id = ?;", (user_id,))
+        else:
+            cur = con.execute("DELETE FROM subscriptions WHERE id = ? AND user_id = ?;", (sub_id, user_id))
+        if cur.rowcount:
+            con.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'subscriptions_version';")
+        con.commit()
+        return cur.rowcount
+    finally:
+        con.close()
+
+
+def list_subscriptions(user_id: int) -> List[sqlite3.Row]:
+    con = db_conn()
+    rows = con.execute("SELECT * FROM subscriptions WHERE user_id = ? ORDER BY id;", (user_id,)).fetchall()
     con.close()
+    return rows
 
-    wb = Workbook()
 
-    ws = wb.active
-    ws.title = "Offers"
-    ws.append(
-        [
-            "SEQ",
-            "CreatedAt",
-            "Status",
-            "Category",
-            "HousingType",
-            "Street",
-            "City",
-            "District",
-            "Advantages",
-            "Rent",
-            "Deposit",
-            "Commission",
-            "Parking",
-            "MoveInFrom",
-            "ViewingsFrom",
-            "Broker",
-            "BrokerUserId",
-            "PhotosCount",
-            "PublishedChatId",
-            "PublishedMessageId",
-        ]
-    )
+class SubscriptionIndex:
+    """
+    Підписки в пам'яті, розкладені по кошиках (місто, категорія); '' — «будь-яке».
+    У кошику записи відсортовані за rent_max (без ліміту — inf), тож підписки,
+    які пропускають оренду r, — це суфікс від bisect_left(r). Пропозиція дивиться
+    щонайбільше 4 кошики, тип житла й паркінг перевіряються лише для кандидатів.
+    Як і RoleCache, перечитується лише коли змінилась meta.subscriptions_version.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.buckets: Dict[Tuple[str, str], Tuple[List[float], List[Tuple[int, int, str, int]]]] = {}
 
-    for r in offers:
+    def refresh(self, force: bool = False) -> bool:
+        con = db_conn()
         try:
-            photos = json.loads(r["photos_json"] or "[]")
-        except Exception:
-            photos = []
-        st = (r["current_status"] or "unknown").strip()
-        ws.append(
-            [
-                r["seq"],
-                r["created_at"],
-                STATUS.get(st, st),
-                r["category"],
-                r["housing_type"],
-                r["street"],
-                r["city"],
-                r["district"],
-                r["advantages"],
-                r["rent"],
-                r["deposit"],
-                r["commission"],
-                r["parking"],
-                r["move_in_from"],
-                r["viewings_from"],
-                r["broker_username"],
-                r["broker_user_id"],
-                len(photos),
-                r["published_chat_id"],
-                r["published_message_id"],
-            ]
-        )
+            cur = con.cursor()
+            cur.execute("SELECT value FROM meta WHERE key = 'subscriptions_version';")
+            row = cur.fetchone()
+            version = int(row["value"]) if row else 0
+            if not force and version == self.version:
+                return False
+            cur.execute(
+                """
+                SELECT id, user_id, city, category, housing_type, rent_max, parking FROM subscriptions
+                ORDER BY city, category, rent_max IS NULL, rent_max;
+                """
+            )
+            buckets: Dict[Tuple[str, str], Tuple[List[float], List[Tuple[int, int, str, int]]]] = {}
+            for r in cur:
+                limits, subs = buckets.setdefault((r["city"], r["category"]), ([], []))
+                limits.append(math.inf if r["rent_max"] is None else float(r["rent_max"]))
+                subs.append((int(r["id"]), int(r["user_id"]), r["housing_type"], int(r["parking"])))
+            self.buckets = buckets
+            self.version = version
+            return True
+        finally:
+            con.close()
+
+    def match(self, offer: sqlite3.Row) -> Dict[int, List[int]]:
+        """{user_id: [id підписок]} для пропозиції."""
+        city, category = norm_text(offer["city"]), norm_text(offer["category"])
+        housing_type = norm_text(offer["housing_type"])
+        parking = has_parking(offer["parking"])
+        rent = parse_rent(offer["rent"])
+        rent = math.inf if rent is None else rent
+
+        out: Dict[int, List[int]] = {}
+        for key in {(city, category), (city, ""), ("", category), ("", "")}:
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+            limits, subs = bucket
+            for sub_id, user_id, sub_type, sub_parking in subs[bisect.bisect_left(limits, rent):]:
+                if (sub_type and sub_type != housing_type) or (sub_parking and not parking):
+                    continue
+                out.setdefault(user_id, []).append(sub_id)
+        return out
+
+
+subscription_index = SubscriptionIndex()
+
+
+def match_subscriptions(offer: sqlite3.Row) -> Dict[int, List[int]]:
+    subscription_index.refresh()
+    return subscription_index.match(offer)
+
+
+def format_subscription(r: sqlite3.Row) -> str:
+    return f"<code>{int(r['id'])}</code>: {esc(r['query'] or '')}"
+
+
+async def notify_subscribers(bot: Bot, offer_id: int) -> int:
+    """Одне повідомлення на користувача через send_queue, хоч би скільки його підписок збіглось."""
+    offer = await storage.get_offer(offer_id)
+    if not offer:
+        return 0
+    matches = await asyncio.to_thread(match_subscriptions, offer)
+    owner = int(offer["broker_user_id"] or 0)
+    text = "🔔 <b>Нова пропозиція за твоєю підпискою</b>\n\n" + offer_text(offer)
+    sent = 0
+    for user_id in matches:
+        if user_id == owner or not is_allowed(user_id):
+            continue
+        send_queue.submit(user_id, lambda user_id=user_id: bot.send_message(user_id, text))
+        sent += 1
+    if sent:
+        log.info("offer %s: %s subscriber notifications queued", offer_id, sent)
+    return sent
 
-    ws2 = wb.create_sheet("StatusEvents")
-    ws2.append(["At", "OfferSEQ", "Status", "Username", "UserId"])
-    for e in events:
-        st = e["status"]
-        ws2.append(
-            [
-                e["at"],
-                e["offer_seq"],
-                STATUS.get(st, st),
-                e["username"],
-                e["user_id"],
-            ]
-        )
 
-    wb.save(filepath)
+@router.message(Command("subscribe"))
+async def cmd_subscribe(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
+        return
 
+    args = (message.text or "").split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer(SUB_USAGE)
+        return
+    try:
+        sub = parse_subscription(args[1])
+    except ValueError:
+        await message.answer(SUB_USAGE)
+        return
 
-@router.message(Command("export"))
-async def cmd_export(message: types.Message):
+    sub_id = await asyncio.to_thread(add_subscription, message.from_user.id, sub, args[1].strip())
+    if sub_id is None:
+        await message.answer(f"❗️Не більше {SUB_MAX_PER_USER} підписок. Видали зайві: /unsubscribe &lt;id&gt;")
+        return
+    await message.answer(f"🔔 Підписку <code>{sub_id}</code> збережено. Список: /subscriptions")
+
+
+@router.message(Command("subscriptions"))
+async def cmd_subscriptions(message: types.Message):
     if not is_allowed(message.from_user.id):
         await message.answer("⛔️ Доступ заборонено.")
         return
 
-    if Workbook is None:
-        await message.answer("❗️Додай openpyxl в requirements.txt (openpyxl==3.1.5) і перезапусти деплой.")
+    rows = await asyncio.to_thread(list_subscriptions, message.from_user.id)
+    if not rows:
+        await message.answer("ℹ️ Підписок немає. Додати: /subscribe")
         return
+    lines = ["🔔 <b>Твої підписки</b>", ""] + [format_subscription(r) for r in rows]
+    lines += ["", "Видалити: /unsubscribe &lt;id&gt; або /unsubscribe all"]
+    await message.answer("\n".join(lines))
 
-    args = (message.text or "").split(maxsplit=1)
-    period = "all"
-    if len(args) == 2:
-        period = args[1].strip().lower()
 
-    if period not in ("all", "day", "month", "year"):
-        await message.answer("❗️Використання: /export [all|day|month|year]\nНаприклад: /export month")
+@router.message(Command("unsubscribe"))
+async def cmd_unsubscribe(message: types.Message):
+    if not is_allowed(message.from_user.id):
+        await message.answer("⛔️ Доступ заборонено.")
         return
 
-    ensure_dirs()
-    ts = datetime.now(tz=APP_TZ).strftime("%Y-%m-%d_%H-%M")
-    filename = f"orenda_export_{period}_{ts}.xlsx"
-    filepath = os.path.join(DATA_DIR, filename)
+    args = (message.text or "").split(maxsplit=1)
+    arg = args[1].strip().lower() if len(args) == 2 else ""
+    if arg != "all" and not arg.isdigit():
+        await message.answer("❗️Використання: /unsubscribe &lt;id&gt; | all")
+        return
 
-    try:
-        export_to_excel(filepath, period=period)
-        doc = FSInputFile(filepath, filename=filename)
-        await message.answer_document(doc, caption=f"📄 Excel експорт: <b>{period}</b>")
-    finally:
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
+    n = await asyncio.to_thread(delete_subscription, message.from_user.id, None if arg == "all" else int(arg))
+    await message.answer(f"✅ Видалено підписок: {n}." if n else "ℹ️ Такої підписки немає.")
 
 
 # =========================
@@ -1159,17 +5927,40 @@ async def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не заданий")
 
+    logging.basicConfig(level=logging.INFO)
     init_db()
+    await storage.init()
+    role_cache.refresh(force=True)
+    if "admin" not in role_cache.roles.values():
+        # /user, /export, /backup, /bulk — лише для адмінів; без них ролі ніхто не видасть
+        log.warning("no active admin in users: set ADMIN_USER_IDS=<telegram id> and restart")
+    subscription_index.refresh(force=True)
+    load_autocomplete()
+    update_dedup.floor = update_dedup.persisted = load_update_watermark()
 
     bot = Bot(
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
 
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(update_dedup)
     dp.include_router(router)
 
-    await dp.start_polling(bot)
+    tasks = [
+        asyncio.create_task(scheduler_loop(bot, scheduled_jobs())),
+        asyncio.create_task(send_queue.run()),
+        asyncio.create_task(role_refresh_loop()),
+        asyncio.create_task(update_watermark_loop()),
+        asyncio.create_task(export_workers(bot)),
+    ]
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await flush_update_watermark()
+        await storage.close()
 
 
 if __name__ == "__main__":
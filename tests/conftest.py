@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# bot.py читає конфіг під час імпорту
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
@@ -0,0 +1,30 @@
+"""Архів status_events у файлах по роках."""
+import bot
+
+
+def test_history_reads_archived_events(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(bot, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(bot, "ARCHIVE_AFTER_DAYS", 365)
+    bot.init_db()
+
+    offer_id = bot.create_offer("@a", 1)
+    old = [("2023-05-01T10:00:00+00:00", "active"), ("2024-02-01T10:00:00+00:00", "reserve")]
+    con = bot.db_conn()
+    con.execute("UPDATE offers SET created_ts = ? WHERE id = ?;", (bot.iso_to_ts(old[0][0]), offer_id))
+    con.execute("UPDATE status_events SET at = ?, at_ts = ? WHERE offer_id = ?;",
+                ("2023-04-30T10:00:00+00:00", bot.iso_to_ts("2023-04-30T10:00:00+00:00"), offer_id))
+    con.executemany(
+        "INSERT INTO status_events (offer_id, at, at_ts, status, username, user_id) VALUES (?, ?, ?, ?, '@a', 1);",
+        [(offer_id, at, bot.iso_to_ts(at), st) for at, st in old],
+    )
+    con.commit()
+    con.close()
+    bot.set_status(offer_id, "closed", "@b", 2)
+
+    assert bot.archive_status_events() == 3
+    assert len(bot.archive_files()) == 2
+
+    history = bot.offer_history(offer_id)
+    assert [r["status"] for r in history] == ["closed", "reserve", "active", "unknown"]
+    assert [r["status"] for r in bot.offer_history(offer_id, limit=2)] == ["closed", "reserve"]
@@ -0,0 +1,63 @@
+"""Онлайн-бекап SQLite під час записів."""
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+
+import bot
+
+
+def test_backup_finishes_while_writes_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "database.db"))
+    monkeypatch.setattr(bot, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(bot, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    bot.init_db()
+
+    offer_id = bot.create_offer("@a", 1)
+    con = bot.db_conn()
+    con.executemany(
+        "INSERT INTO offers (seq, created_at, advantages, current_status, is_published) VALUES (?, '', ?, 'active', 1);",
+        [(1000 + i, "x" * 2000) for i in range(8000)],
+    )
+    con.commit()
+    con.close()
+
+    stop = threading.Event()
+    clicks = 0
+
+    def writer():
+        nonlocal clicks
+        statuses = ("active", "reserve")
+        while not stop.is_set():
+            bot.set_status(offer_id, statuses[clicks % 2], "@a", 1)
+            clicks += 1
+            time.sleep(0.005)
+
+    result = {}
+    backup = threading.Thread(target=lambda: result.update(path=bot.backup_db()))
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        backup.start()
+        # покроковий backup на живій БД перезапускався після кожного кліку і не закінчувався
+        backup.join(timeout=30)
+        finished = not backup.is_alive()
+    finally:
+        stop.set()
+        t.join()
+        backup.join()
+
+    assert finished
+    assert clicks > 0
+    path = result["path"]
+
+    with tarfile.open(path) as tar:
+        tar.extractall(tmp_path / "restored")
+    restored = sqlite3.connect(tmp_path / "restored" / "database.db")
+    try:
+        assert restored.execute("PRAGMA integrity_check;").fetchone()[0] == "ok"
+        assert restored.execute("SELECT COUNT(*) FROM offers;").fetchone()[0] == 8001
+    finally:
+        restored.close()
+    assert os.listdir(bot.BACKUP_DIR) == [os.path.basename(path)]
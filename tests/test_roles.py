@@ -0,0 +1,25 @@
+"""Права з таблиці users через RoleCache."""
+import bot
+
+
+def test_access_fails_closed(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(bot, "ADMIN_USER_IDS", set())
+    monkeypatch.setattr(bot, "ALLOWED_USER_IDS", set())
+    monkeypatch.setattr(bot, "role_cache", bot.RoleCache())
+    bot.init_db()
+    bot.role_cache.refresh(force=True)
+
+    # порожня таблиця — нікого не пускаємо
+    assert not bot.is_allowed(1)
+
+    bot.set_user_role(1, "admin")
+    bot.set_user_role(2, "broker")
+    assert bot.is_allowed(1) and bot.is_admin(1)
+    assert bot.is_allowed(2) and not bot.is_admin(2)
+    assert not bot.is_allowed(3)
+
+    # деактивували всіх — бот не відкривається
+    bot.set_user_role(1, None)
+    bot.set_user_role(2, None)
+    assert not bot.is_allowed(1) and not bot.is_allowed(3)
@@ -0,0 +1,186 @@
+"""Перевірки інтерфейсу Storage на SqliteStorage."""
+import asyncio
+import contextlib
+import json
+from datetime import timedelta
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """Фабрика: `async with backend() as store` — свіже порожнє сховище в поточному event loop."""
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "test.db"))
+    bot.init_db()
+
+    @contextlib.asynccontextmanager
+    async def make():
+        store = bot.SqliteStorage()
+        await store.init()
+        try:
+            yield store
+        finally:
+            await store.close()
+    return make
+
+
+async def count_rows(store, table: str, offer_id: int) -> int:
+    con = bot.db_conn()
+    try:
+        return con.execute(f"SELECT COUNT(*) FROM {table} WHERE offer_id = ?;", (offer_id,)).fetchone()[0]
+    finally:
+        con.close()
+
+
+def run(backend, body):
+    async def main():
+        async with backend() as store:
+            await body(store)
+    asyncio.run(main())
+
+
+def test_storage_requires_every_method():
+    class Partial(bot.Storage):
+        async def get_offer(self, offer_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_create_get_update(backend):
+    async def body(store):
+        a = await store.create_offer("@a", 1)
+        b = await store.create_offer("@b", 2)
+        offer = await store.get_offer(a)
+        assert offer["current_status"] == "unknown"
+        assert offer["is_published"] == 0
+        assert (await store.get_offer(b))["seq"] == offer["seq"] + 1
+
+        await store.update_offer(a, city="Trnava", rent="700€")
+        offer = await store.get_offer(a)
+        assert (offer["city"], offer["rent"]) == ("Trnava", "700€")
+        with pytest.raises(ValueError):
+            await store.update_offer(a, **{"city = 'x', seq": 1})
+        assert await store.get_offer(10_000) is None
+
+    run(backend, body)
+
+
+def test_set_status_compare_and_swap(backend):
+    async def body(store):
+        offer_id = await store.create_offer("@a", 1)
+        seen = (await store.get_offer(offer_id))["version"]
+
+        first = await store.set_status(offer_id, "active", "@a", 1, expected_version=seen)
+        assert first is not None and first["current_status"] == "active"
+        assert first["version"] == seen + 1
+
+        # другий клік з тією ж (застарілою) версією не проходить
+        assert await store.set_status(offer_id, "reserve", "@b", 2, expected_version=seen) is None
+        assert (await store.get_offer(offer_id))["current_status"] == "active"
+
+        # два паралельні кліки з однією версією — рівно один переможець
+        seen = first["version"]
+        results = await asyncio.gather(
+            store.set_status(offer_id, "reserve", "@a", 1, expected_version=seen),
+            store.set_status(offer_id, "closed", "@b", 2, expected_version=seen),
+        )
+        assert sum(r is not None for r in results) == 1
+
+        assert await store.set_status(offer_id, "bogus", "@a", 1) is None
+        assert await store.set_status(10_000, "active", "@a", 1) is None
+        # unknown + active + переможець
+        assert await count_rows(store, "status_events", offer_id) == 3
+        # відкритий лише останній відрізок status_durations
+        assert await count_rows(store, "status_durations", offer_id) == 3
+
+    run(backend, body)
+
+
+def test_add_photo_concurrent(backend):
+    async def body(store):
+        offer_id = await store.create_offer("@a", 1)
+        await asyncio.gather(*(store.add_photo(offer_id, f"file{i}", f"uniq{i}") for i in range(20)))
+        photos = json.loads((await store.get_offer(offer_id))["photos_json"])
+        assert sorted(photos) == sorted(f"file{i}" for i in range(20))
+        assert await count_rows(store, "offer_photos", offer_id) == 20
+
+        await store.add_photo(10_000, "ghost", "ghost")
+        assert await count_rows(store, "offer_photos", 10_000) == 0
+
+    run(backend, body)
+
+
+def test_delete_draft(backend):
+    async def body(store):
+        draft = await store.create_offer("@a", 1)
+        await store.add_photo(draft, "f", "u")
+        published = await store.create_offer("@a", 1)
+        await store.add_photo(published, "f2", "u2")
+        await store.update_offer(published, is_published=1)
+
+        await store.delete_draft(draft)
+        await store.delete_draft(published)
+
+        assert await store.get_offer(draft) is None
+        for table in ("status_events", "status_durations", "offer_photos"):
+            assert await count_rows(store, table, draft) == 0
+            assert await count_rows(store, table, published) == 1
+        assert await store.get_offer(published) is not None
+
+    run(backend, body)
+
+
+def test_stats_and_broker_stats(backend):
+    async def body(store):
+        a = await store.create_offer("@a", 1)
+        b = await store.create_offer("@b", 2)
+        await store.set_status(a, "active", "@a", 1)
+        await store.set_status(b, "active", "@b", 2)
+        await store.set_status(b, "closed", "@b", 2)
+
+        start, end = bot._period_bounds("day")
+        d = await store.stats_for_range(start, end, "today")
+        assert d["label"] == "today"
+        assert d["total"] == {"unknown": 2, "active": 2, "reserve": 0, "removed": 0, "closed": 1}
+        assert list(d["per_broker"]) == ["@a", "@b"]
+        assert d["per_broker"]["@b"]["closed"] == 1
+
+        assert await store.broker_stats("@b", start, end) == {
+            "unknown": 1, "active": 1, "reserve": 0, "removed": 0, "closed": 1,
+        }
+        assert sum((await store.broker_stats("@nobody", start, end)).values()) == 0
+
+        past = await store.stats_for_range(start - timedelta(days=7), start - timedelta(days=6), "past")
+        assert sum(past["total"].values()) == 0 and past["per_broker"] == {}
+
+    run(backend, body)
+
+
+def test_cursor_iteration(backend):
+    async def body(store):
+        ids = [await store.create_offer("@a", 1) for _ in range(25)]
+        for offer_id in ids[:10]:
+            await store.set_status(offer_id, "active", "@a", 1)
+
+        seqs = [r["seq"] async for r in store.iter_offers()]
+        assert len(seqs) == 25 and seqs == sorted(seqs)
+
+        events = [r async for r in store.iter_status_events()]
+        assert len(events) == 35
+        assert {e["status"] for e in events} == {"unknown", "active"}
+        assert all(e["offer_seq"] is not None for e in events)
+
+        start, end = bot._period_bounds("day")
+        assert len([r async for r in store.iter_offers(start, end)]) == 25
+        assert [r async for r in store.iter_offers(start - timedelta(days=2), start - timedelta(days=1))] == []
+        assert await store.count_export_rows() == 60
+        assert await store.count_export_rows(start, end) == 60
+
+        # ранній вихід з ітерації не тримає з'єднання/потік
+        async for _ in store.iter_offers():
+            break
+
+    run(backend, body)